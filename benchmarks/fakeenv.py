@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+A fake, self-contained DAVAI-env environment (HOME, user config, Vortex cache config,
+experiment) in a temporary directory, for benchmarking without the actual machine setup.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import shutil
+import tempfile
+import subprocess
+
+DAVAI_ENV_REPO = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DAVAI_ENV_SRC = os.path.join(DAVAI_ENV_REPO, 'src')
+DAVAI_ENV_BIN = os.path.join(DAVAI_ENV_REPO, 'bin')
+
+FAKE_HOST = 'benchhost'
+FAKE_USER_CONFIG = """[hosts]
+host = {host}
+
+[paths]
+experiments = {root}/davai/experiments
+logs = {root}/davai/logs
+default_mtooldir = {root}/mtool
+IAL_repository = {root}/IAL
+IAL_bundle_repository = {root}/IAL-bundle
+davai_tests_mirrors = {root}/mirrors
+
+[defaults]
+davai_tests_origin = {root}/DAVAI-tests.git
+
+[packages]
+vortex = {root}/vortex
+"""
+
+
+def _write(filename, content):
+    d = os.path.dirname(filename)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    with io.open(filename, 'w') as f:
+        f.write(content)
+
+
+class FakeEnv(object):
+    """
+    Fake DAVAI-env environment, to be used as a context manager:
+
+    >>> with FakeEnv() as env:
+    ...     subprocess.check_call(['davai-config', 'show'], env=env.environ)
+    """
+
+    def __init__(self, root=None, keep=False):
+        self._tmp = root is None
+        self.root = tempfile.mkdtemp(prefix='davai_bench.') if root is None else os.path.abspath(root)
+        self.keep = keep
+        self.home = os.path.join(self.root, 'home')
+        self.vortex = os.path.join(self.root, 'vortex')
+        self.marketplace = os.path.join(self.root, 'marketplace')
+        self.xpid = 'dv-0001-{}@{}'.format(FAKE_HOST, 'bench')
+        self.xp_path = os.path.join(self.root, 'davai', 'experiments', self.xpid, 'davai', 'nrv')
+
+    def __enter__(self):
+        self.setup()
+        return self
+
+    def __exit__(self, *exc):
+        if self._tmp and not self.keep:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    @property
+    def environ(self):
+        """Environment variables to run DAVAI-env within the fake environment."""
+        env = dict(os.environ)
+        env['HOME'] = self.home
+        env['PYTHONPATH'] = os.pathsep.join([DAVAI_ENV_SRC] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+        env['PATH'] = os.pathsep.join([DAVAI_ENV_BIN, env.get('PATH', '')])
+        env['MTOOLDIR'] = os.path.join(self.root, 'mtool')
+        return env
+
+    def setup(self):
+        """Create the fake tree."""
+        _write(os.path.join(self.home, '.davairc', 'user_config.ini'),
+               FAKE_USER_CONFIG.format(host=FAKE_HOST, root=self.root))
+        # Vortex: cache config and a stub mkjob
+        _write(os.path.join(self.vortex, 'conf', 'cache-{}.ini'.format(FAKE_HOST)),
+               "[marketplace-vortex]\nexternalconf_davai_path = {}\n".format(
+                   os.path.join(self.vortex, 'conf', 'davai-cache.ini')))
+        _write(os.path.join(self.vortex, 'conf', 'davai-cache.ini'),
+               "[marketplace_xp]\nrootdir = {}\n".format(self.marketplace))
+        _write(os.path.join(self.vortex, 'bin', 'mkjob.py'),
+               "import sys\nprint('mkjob stub:', ' '.join(sys.argv[1:]))\n")
+        for d in ('experiments', 'logs'):
+            os.makedirs(os.path.join(self.root, 'davai', d), exist_ok=True)
+        os.makedirs(os.path.join(self.root, 'mtool'), exist_ok=True)
+        os.makedirs(self.marketplace, exist_ok=True)
+        # a minimal experiment
+        _write(os.path.join(self.xp_path, 'conf', 'davai_nrv.ini'),
+               "[DEFAULT]\ncompiling_system = gmkpack\ndavai_server = http://localhost\n")
+        _write(os.path.join(self.xp_path, 'conf', 'NRV.yaml'),
+               "forecasts:\n  - standalone.arpege\n  - standalone.arome\n")
+        _write(os.path.join(self.xp_path, 'conf', 'sources.yaml'),
+               "IAL_git_ref: bench\nIAL_repository: {}/IAL\n".format(self.root))
+        if not os.path.exists(os.path.join(self.xp_path, 'vortex')):
+            os.symlink(self.vortex, os.path.join(self.xp_path, 'vortex'))
+
+    @property
+    def davai_tests_origin(self):
+        return os.path.join(self.root, 'DAVAI-tests.git')
+
+    def make_davai_tests_origin(self, version='bench', jobs=20):
+        """
+        Create a local bare repository standing for the DAVAI-tests origin, with tag *version*
+        and an NRV usecase of *jobs* jobs.
+        """
+        work = os.path.join(self.root, 'DAVAI-tests.work')
+        _write(os.path.join(work, 'conf', 'NRV.yaml'),
+               'forecasts:\n' + ''.join('  - standalone.job{:04}\n'.format(i) for i in range(jobs)))
+        _write(os.path.join(work, 'conf', '{}.ini'.format(FAKE_HOST)),
+               "[DEFAULT]\ncompiling_system = gmkpack\ndavai_server = http://localhost\n")
+        _write(os.path.join(work, 'src', 'tasks', '__init__.py'), '')
+        _write(os.path.join(work, 'src', 'davai_taskutil', '__init__.py'), '')
+        git = ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', '-C', work]
+        for cmd in (['init', '-q'], ['add', '.'], ['commit', '-q', '-m', 'bench'], ['tag', version]):
+            subprocess.check_call(git + cmd, stdout=subprocess.DEVNULL)
+        subprocess.check_call(['git', 'clone', '-q', '--bare', work, self.davai_tests_origin])
+        shutil.rmtree(work)
+        return self.davai_tests_origin
+
+    def make_shelf(self, name, size, files=16):
+        """Create a synthetic shelf *name* in marketplace cache, of *size* bytes in *files* files."""
+        directory = os.path.join(self.marketplace, 'vortex', 'davai', 'shelves', name)
+        block = os.urandom(64 * 1024)
+        per_file = size // files
+        for i in range(files):
+            filename = os.path.join(directory, 'sub{}'.format(i % 4), 'file{:04}'.format(i))
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with io.open(filename, 'wb') as f:
+                # half random, half zeros: about as compressible as real data
+                written = 0
+                while written < per_file:
+                    chunk = block if (written // len(block)) % 2 == 0 else bytes(len(block))
+                    chunk = chunk[:per_file - written]
+                    f.write(chunk)
+                    written += len(chunk)
+        return directory
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Startup-time benchmark of DAVAI-env: import time of the modules and end-to-end time of each
+command in bin/, measured within a fake environment (cf. fakeenv.py).
+Exits with non-zero status if a median time exceeds the budget.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fakeenv import FakeEnv, DAVAI_ENV_BIN
+
+MODULES = ('davai_env', 'davai_env.experiment', 'davai_env.shelf')
+# arguments with which to call commands; default is '-h'
+COMMANDS_ARGS = {'davai-config': ['show'],
+                 'davai-cwd_is_xp': ['-s'],
+                 'davai-help': []}
+
+
+def _time(cmd, env, cwd, repeat):
+    """Run *cmd* *repeat* times; return sorted elapsed times (s)."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call(cmd, env=env, cwd=cwd,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return sorted(times)
+
+
+def measures(env, repeat=5):
+    """Measure startup times within fake environment *env*."""
+    results = {}
+    # warm up: first call writes config snapshot
+    subprocess.check_call([sys.executable, '-c', 'import davai_env'], env=env.environ,
+                          stdout=subprocess.DEVNULL)
+    results['python'] = _time([sys.executable, '-c', 'pass'], env.environ, env.xp_path, repeat)
+    for m in MODULES:
+        results['import ' + m] = _time([sys.executable, '-c', 'import ' + m],
+                                       env.environ, env.xp_path, repeat)
+    for c in sorted(os.listdir(DAVAI_ENV_BIN)):
+        cmd = [os.path.join(DAVAI_ENV_BIN, c)] + COMMANDS_ARGS.get(c, ['-h'])
+        results[c] = _time(cmd, env.environ, env.xp_path, repeat)
+    return results
+
+
+def main(repeat=5, budget=None, json_output=None):
+    with FakeEnv() as env:
+        results = measures(env, repeat=repeat)
+    over_budget = []
+    print("{:<40} {:>10} {:>10}".format('', 'median(ms)', 'min(ms)'))
+    for k, times in results.items():
+        median = 1000 * times[len(times) // 2]
+        print("{:<40} {:>10.1f} {:>10.1f}".format(k, median, 1000 * times[0]))
+        if budget is not None and k != 'python' and median > budget:
+            over_budget.append(k)
+    if json_output:
+        with io.open(json_output, 'w') as o:
+            json.dump({k: {'median': t[len(t) // 2], 'min': t[0], 'times': t} for k, t in results.items()},
+                      o, indent=2)
+    if over_budget:
+        print("Over budget ({} ms): {}".format(budget, ', '.join(over_budget)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--repeat',
+                        type=int,
+                        default=5,
+                        help="Number of runs of each measure")
+    parser.add_argument('-b', '--budget',
+                        type=float,
+                        default=None,
+                        help="Budget in ms for the median time of each import/command")
+    parser.add_argument('-o', '--json_output',
+                        default=None,
+                        help="Write results in this JSON file")
+    args = parser.parse_args()
+    sys.exit(main(repeat=args.repeat,
+                  budget=args.budget,
+                  json_output=args.json_output))
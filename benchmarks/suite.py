@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Offline benchmark suite of DAVAI-env, within a fake environment (cf. fakeenv.py): creation of experiments
+from a local DAVAI-tests origin, launch of jobs in dry mode, shelves tar export/import at several sizes,
+and startup time of commands. Results are written as JSON, and two results files can be compared.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import sys
+import json
+import time
+import socket
+import argparse
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from fakeenv import FakeEnv, DAVAI_ENV_REPO
+import startup
+
+DEFAULT_SHELF_SIZES = ('16M', '64M')
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence stdout of the benchmarked code."""
+    stdout = sys.stdout
+    with io.open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def _timed(func, repeat, setup=None):
+    """Run *func* *repeat* times (after *setup*, untimed); return sorted elapsed times (s)."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        with _quiet():
+            func()
+        times.append(time.time() - start)
+    return sorted(times)
+
+
+def worker(root, repeat, shelf_sizes, jobs):
+    """In-process benchmarks, to be run within the fake environment (HOME, config) rooted at *root*."""
+    import shutil
+    from davai_env.experiment import XPmaker, ThisXP
+    from davai_env.shelf import Shelf
+    from davai_env.util import parse_size
+    env = FakeEnv(root=root)
+    results = {}
+    origin = env.davai_tests_origin
+    sources = {'IAL_git_ref': 'bench', 'IAL_repository': os.path.join(root, 'IAL')}
+    xps = []
+
+    def new_xp():
+        xps.append(XPmaker.new_xp(sources, 'bench', davai_tests_origin=origin, usecase='NRV'))
+    results['new_xp'] = _timed(new_xp, repeat)
+
+    # jobs launching, in dry mode
+    os.chdir(xps[-1].xp_path)
+    results['launch_jobs (dry, {} jobs)'.format(jobs)] = _timed(
+        lambda: ThisXP().launch_jobs(drymode=True), repeat)
+    results['launch_jobs (dry, batch, {} jobs)'.format(jobs)] = _timed(
+        lambda: ThisXP().launch_jobs(drymode=True, batch=True), repeat)
+
+    # shelves
+    out_dir = os.path.join(root, 'tarfiles')
+    os.makedirs(out_dir, exist_ok=True)
+    for size in shelf_sizes:
+        name = 'bench{}@bench'.format(size)
+        mkt_dir = env.make_shelf(name, parse_size(size))
+        for codec in (None, 'gzip'):
+            label = '{} {}'.format(size, codec or 'tar')
+            results['mkt2tar ' + label] = _timed(
+                lambda: Shelf(name).mkt2tar(out_dir=out_dir, codec=codec), repeat)
+            tarfile = os.path.join(out_dir, os.path.basename(Shelf(name).tarfile))
+            if codec is not None:
+                tarfile = tarfile.replace('.tar', '.tgz')
+            results['tar2mkt ' + label] = _timed(
+                lambda: Shelf(tarfile).tar2mkt(),
+                repeat,
+                setup=lambda: shutil.rmtree(mkt_dir, ignore_errors=True))
+    return results
+
+
+def run(repeat=3, shelf_sizes=DEFAULT_SHELF_SIZES, jobs=50, startup_repeat=3, keep=False):
+    """Run the whole suite in a fresh fake environment; return results {benchmark: sorted times}."""
+    with FakeEnv(keep=keep) as env:
+        env.make_davai_tests_origin(jobs=jobs)
+        results_file = os.path.join(env.root, 'worker_results.json')
+        subprocess.check_call([sys.executable, os.path.realpath(__file__), '--worker', env.root,
+                               '-n', str(repeat), '--jobs', str(jobs), '-o', results_file,
+                               '--shelf_sizes'] + list(shelf_sizes),
+                              env=env.environ, cwd=env.root)
+        with io.open(results_file, 'r') as f:
+            results = {k: r['times'] for k, r in json.load(f)['results'].items()}
+        for k, times in startup.measures(env, repeat=startup_repeat).items():
+            results['startup ' + k] = times
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', '-C', DAVAI_ENV_REPO, 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0],
+            'cpus': os.cpu_count()}
+
+
+def dump(results, json_output, meta=None):
+    with io.open(json_output, 'w') as o:
+        json.dump({'meta': meta or {},
+                   'results': {k: {'median': t[len(t) // 2], 'min': t[0], 'times': t} for k, t in results.items()}},
+                  o, indent=2)
+
+
+def print_results(results):
+    print("{:<48} {:>10} {:>10}".format('', 'median(ms)', 'min(ms)'))
+    for k, times in results.items():
+        print("{:<48} {:>10.1f} {:>10.1f}".format(k, 1000 * times[len(times) // 2], 1000 * times[0]))
+
+
+def compare(reference, candidate, threshold=0.1):
+    """
+    Compare two results files (medians); return the number of regressions beyond *threshold* (relative).
+    """
+    results = []
+    for filename in (reference, candidate):
+        with io.open(filename, 'r') as f:
+            results.append(json.load(f))
+    ref, cand = results[0]['results'], results[1]['results']
+    print("reference: {} ({})".format(reference, results[0]['meta'].get('commit')))
+    print("candidate: {} ({})".format(candidate, results[1]['meta'].get('commit')))
+    print("{:<48} {:>10} {:>10} {:>8}".format('', 'ref(ms)', 'cand(ms)', 'ratio'))
+    regressions = 0
+    for k in sorted(set(ref) | set(cand)):
+        if k not in ref or k not in cand:
+            print("{:<48} {:>10} {:>10}".format(k, '-' if k not in ref else '{:.1f}'.format(1000 * ref[k]['median']),
+                                                '-' if k not in cand else '{:.1f}'.format(1000 * cand[k]['median'])))
+            continue
+        ratio = cand[k]['median'] / max(ref[k]['median'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' <- slower'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = ' faster'
+        print("{:<48} {:>10.1f} {:>10.1f} {:>8.2f}{}".format(k, 1000 * ref[k]['median'], 1000 * cand[k]['median'],
+                                                             ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--repeat',
+                        type=int,
+                        default=3,
+                        help="Number of runs of each benchmark")
+    parser.add_argument('--shelf_sizes',
+                        nargs='+',
+                        default=DEFAULT_SHELF_SIZES,
+                        help="Sizes of the synthetic shelves (suffixes K, M, G)")
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=50,
+                        help="Number of jobs in the usecase of the fake DAVAI-tests")
+    parser.add_argument('-o', '--json_output',
+                        default=None,
+                        help="Write results in this JSON file")
+    parser.add_argument('-k', '--keep',
+                        action='store_true',
+                        help="Keep the fake environment (for inspection)")
+    parser.add_argument('-c', '--compare',
+                        nargs=2,
+                        metavar=('REFERENCE', 'CANDIDATE'),
+                        default=None,
+                        help="Compare two results files instead of running the suite; " +
+                             "exits with non-zero status if the candidate is slower beyond threshold")
+    parser.add_argument('-t', '--threshold',
+                        type=float,
+                        default=0.1,
+                        help="Relative slowdown beyond which a benchmark is reported as a regression")
+    parser.add_argument('--worker',
+                        default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+    elif args.worker:
+        dump(worker(args.worker, args.repeat, args.shelf_sizes, args.jobs), args.json_output)
+    else:
+        results = run(repeat=args.repeat, shelf_sizes=args.shelf_sizes, jobs=args.jobs, keep=args.keep)
+        print_results(results)
+        if args.json_output:
+            dump(results, args.json_output, meta=metadata())
@@ -12,6 +12,8 @@ import configparser
 import socket
 import io
 import subprocess
+import json
+import tempfile
 
 _package_rootdir = os.path.dirname(os.path.dirname(os.path.realpath(__path__[0])))  # realpath to resolve symlinks
 __version__ = io.open(os.path.join(_package_rootdir, 'VERSION'), 'r').read().strip()
@@ -27,6 +29,7 @@ DAVAI_XPID_RE = re.compile('^' + DAVAI_XPID_SYNTAX.replace('{xpid_num:04}', '\d+
 CONFIG_BASE_FILE = os.path.join(__this_repo__, 'conf', 'base.ini')
 CONFIG_USER_FILE = os.path.join(DAVAI_RC_DIR, 'user_config.ini')
 CONFIG_TEMPLATE_USER_FILE = os.path.join(__this_repo__, 'templates', 'user_config.ini')
+CONFIG_SNAPSHOT_FILE = os.path.join(DAVAI_RC_DIR, '.config_snapshot.json')
 
 
 def guess_host():
@@ -34,7 +37,12 @@ def guess_host():
     Guess host from (by order of resolution):
       - presence as 'host' in section [hosts] of base and user config
       - resolution from socket.gethostname() through RE patterns of base and user config
+
+    Once guessed, the host is memorized.
     """
+    global _host
+    if _host:
+        return _host
     host = config.get('hosts', 'host', fallback=None)
     if not host:
         socket_hostname = socket.gethostname()
@@ -47,28 +55,79 @@ def guess_host():
                           "nor guess from hostname ({}) and keys '*host*_re_pattern' " +
                           "in section 'hosts' of same config files.").format(
             CONFIG_USER_FILE, CONFIG_BASE_FILE, socket_hostname))
+    _host = host
     return host
 
 
+# CONFIG SNAPSHOT
+def _config_snapshot_key(host_file):
+    """Key of validity of a config snapshot: config files with their mtimes, and hostname."""
+    return {'hostname': socket.gethostname(),
+            'files': [[f, os.path.getmtime(f) if os.path.exists(f) else None]
+                      for f in (CONFIG_BASE_FILE, host_file, CONFIG_USER_FILE)]}
+
+def _load_config_snapshot():
+    """Return snapshot of the resolved config if it is still valid, None otherwise."""
+    try:
+        with io.open(CONFIG_SNAPSHOT_FILE, 'r') as s:
+            snapshot = json.load(s)
+        if snapshot['key'] == _config_snapshot_key(snapshot['host_file']):
+            return snapshot
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+def _write_config_snapshot():
+    """Write snapshot of the resolved config, if possible."""
+    if not os.path.isdir(DAVAI_RC_DIR):
+        return
+    resolved = io.StringIO()
+    config.write(resolved)
+    snapshot = {'key': _config_snapshot_key(CONFIG_HOST_FILE),
+                'host': _host,
+                'host_file': CONFIG_HOST_FILE,
+                'config': resolved.getvalue()}
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='.config_snapshot.', dir=DAVAI_RC_DIR)
+        with io.open(fd, 'w') as s:
+            json.dump(snapshot, s)
+        os.replace(tmp, CONFIG_SNAPSHOT_FILE)
+    except (IOError, OSError):
+        pass
+
+
 # CONFIG
+_host = None
 config = configparser.ConfigParser()
-config.read(CONFIG_BASE_FILE)
-# read user config a first time to help guessing host
-if os.path.exists(CONFIG_USER_FILE):
-    config.read(CONFIG_USER_FILE)
-# then complete config with host config file
-CONFIG_HOST_FILE = os.path.join(__this_repo__, 'conf', '{}.ini'.format(guess_host()))
-if os.path.exists(CONFIG_HOST_FILE):
-    config.read(CONFIG_HOST_FILE)
-# and read again user config so that it overwrites host config
-if os.path.exists(CONFIG_USER_FILE):
-    config.read(CONFIG_USER_FILE)
+_snapshot = _load_config_snapshot()
+CONFIG_FROM_SNAPSHOT = _snapshot is not None
+if CONFIG_FROM_SNAPSHOT:
+    config.read_string(_snapshot['config'])
+    _host = _snapshot['host']
+    CONFIG_HOST_FILE = _snapshot['host_file']
+else:
+    config.read(CONFIG_BASE_FILE)
+    # read user config a first time to help guessing host
+    if os.path.exists(CONFIG_USER_FILE):
+        config.read(CONFIG_USER_FILE)
+    # then complete config with host config file
+    CONFIG_HOST_FILE = os.path.join(__this_repo__, 'conf', '{}.ini'.format(guess_host()))
+    if os.path.exists(CONFIG_HOST_FILE):
+        config.read(CONFIG_HOST_FILE)
+    # and read again user config so that it overwrites host config
+    if os.path.exists(CONFIG_USER_FILE):
+        config.read(CONFIG_USER_FILE)
+    _write_config_snapshot()
+del _snapshot
 
 def show_config():
     """Show current config."""
     print("Configuration, from:")
     for c in (CONFIG_BASE_FILE, CONFIG_HOST_FILE, CONFIG_USER_FILE):
         print(" - {}".format(c))
+    if CONFIG_FROM_SNAPSHOT:
+        print("(read from up-to-date snapshot: '{}')".format(CONFIG_SNAPSHOT_FILE))
+    else:
+        print("(parsed from files, snapshot not used)")
     print("-" * 80)
     config.write(sys.stdout)
 
@@ -88,10 +147,16 @@ def preset_user_config_file(prompt=None):
 
 
 # INITIALIZATION
+_initialized = False
+
 def initialized():
     """
     Make sure Davai env is initialized for user.
+    Done only once, at first need, rather than at import.
     """
+    global _initialized
+    if _initialized:
+        return
     # import inside function because of circular dependency
     from .util import expandpath
     # Setup directories
@@ -108,3 +173,4 @@ def initialized():
         os.makedirs(DAVAI_RC_DIR)
     # User config
     preset_user_config_file()
+    _initialized = True
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Cache of the builds made by experiments, keyed on the resolved sources (commit, local changes or bundle
+contents), the build configuration and the host: an experiment testing already built sources can reuse
+the existing pack instead of building it again.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import re
+import json
+import time
+import fnmatch
+import hashlib
+import subprocess
+
+from . import config, DAVAI_RC_DIR
+from .util import dump_json_atomically, expandpath, locked
+
+BUILD_CACHE_FILE = os.path.join(DAVAI_RC_DIR, 'build_cache.json')
+#: defaults of config [build_cache]: sections and DEFAULT keys of the XP config which the build depends on
+DEFAULT_CONF_SECTIONS = 'gmkpack, gitref2pack, pack2bin'
+DEFAULT_CONF_KEYS = 'compiling_system, compilation_flavour*'
+#: default of config [build_cache][packs_directory]: gmkpack's $HOMEPACK, or its own default
+DEFAULT_PACKS_DIRECTORY = '$HOME/pack'
+#: default of config [build_cache][pack_name]: name of the pack of one compilation flavour
+DEFAULT_PACK_NAME = '{IAL_git_ref}.{compilation_flavour}'
+_flavour_re = re.compile(r'[\w.+-]+')
+
+
+def _hash(*items):
+    h = hashlib.sha256()
+    for item in items:
+        h.update(item if isinstance(item, bytes) else json.dumps(item, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _git(repository, *args):
+    return subprocess.check_output(['git', '-C', repository] + list(args), stderr=subprocess.DEVNULL)
+
+
+def resolve_sources(sources_to_test):
+    """
+    Resolved identity of the sources to be built, as a dict; None if they cannot be resolved.
+    For a Git reference, this is its commit, plus the local changes if the reference is checked out
+    (as they are exported to the pack too); for a bundle, the contents of the bundle file.
+    """
+    if 'IAL_git_ref' in sources_to_test:
+        repository = expandpath(sources_to_test.get('IAL_repository', config['paths']['IAL_repository']))
+        try:
+            commit = _git(repository, 'rev-parse', '{}^{{commit}}'.format(sources_to_test['IAL_git_ref']))
+            commit = commit.decode('utf-8').strip()
+            head = _git(repository, 'rev-parse', 'HEAD').decode('utf-8').strip()
+            changes = _git(repository, 'diff', 'HEAD') if head == commit else b''
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        resolved = {'IAL_commit': commit}
+        if changes:
+            resolved['local_changes'] = _hash(changes)
+        return resolved
+    bundle_file = sources_to_test.get('IAL_bundle_file')
+    if bundle_file is None and 'IAL_bundle' in sources_to_test:
+        repository = expandpath(sources_to_test.get('IAL_bundle_repository',
+                                                    config['paths']['IAL_bundle_repository']))
+        bundle_file = os.path.join(repository, sources_to_test['IAL_bundle'])
+    if bundle_file is not None and os.path.isfile(expandpath(bundle_file)):
+        with io.open(expandpath(bundle_file), 'rb') as b:
+            return {'IAL_bundle': _hash(b.read())}
+    return None
+
+
+def build_conf(conf):
+    """Part of the XP config (configparser) which the build depends on, as a dict."""
+    sections = [s.strip() for s in config.get('build_cache', 'conf_sections', fallback=DEFAULT_CONF_SECTIONS).split(',')]
+    patterns = [k.strip() for k in config.get('build_cache', 'conf_keys', fallback=DEFAULT_CONF_KEYS).split(',')]
+    defaults = conf.defaults()
+    resolved = {'DEFAULT': {k: v for k, v in defaults.items() if any(fnmatch.fnmatch(k, p) for p in patterns)}}
+    for s in sections:
+        if conf.has_section(s):
+            # own keys of the section only: other DEFAULT keys do not matter to the build
+            resolved[s] = {k: conf.get(s, k, raw=True) for k in conf.options(s)
+                           if k not in defaults or conf.get(s, k, raw=True) != defaults[k]}
+    return resolved
+
+
+def packs_directory():
+    """Directory in which the packs are built (config [build_cache][packs_directory], or $HOMEPACK)."""
+    return expandpath(config.get('build_cache', 'packs_directory', fallback='') or
+                      os.environ.get('HOMEPACK', DEFAULT_PACKS_DIRECTORY))
+
+
+def build_packs(sources_to_test, conf):
+    """
+    Packs made by the build of *sources_to_test* with the XP config *conf*, as {flavour: path}: one per
+    compilation flavour ([gmkpack][compilation_flavours] of the XP config, or its compilation_flavour),
+    named after config [build_cache][pack_name] in the packs directory.
+    None if they cannot be determined (the build is then not cacheable).
+    """
+    values = dict(conf.items('gmkpack', raw=True) if conf.has_section('gmkpack') else conf.defaults().items())
+    values.update({k: str(v) for k, v in sources_to_test.items()})
+    flavours = _flavour_re.findall(values.get('compilation_flavours') or values.get('compilation_flavour') or '')
+    template = config.get('build_cache', 'pack_name', fallback=DEFAULT_PACK_NAME)
+    try:
+        return {f: os.path.join(packs_directory(), template.format(**dict(values, compilation_flavour=f)))
+                for f in flavours} or None
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+def link_packs(packs, to_packs):
+    """Link the existing *packs* ({flavour: path}) as *to_packs*, where these do not exist yet."""
+    for flavour, pack in sorted(to_packs.items()):
+        source = packs.get(flavour)
+        if source is None or os.path.realpath(pack) == os.path.realpath(source):
+            continue
+        if os.path.lexists(pack):
+            print("Pack '{}' already exists: not replaced by a link to '{}'.".format(pack, source))
+        else:
+            print("Link pack '{}' -> '{}'".format(pack, source))
+            os.symlink(source, pack)
+
+
+class BuildCache(object):
+    """Index of successful builds: {key: {'xpid':, 'date':, 'sources':, 'host':, 'packs':}}."""
+
+    def __init__(self, filename=BUILD_CACHE_FILE):
+        self.filename = filename
+
+    @property
+    def enabled(self):
+        return config.getboolean('build_cache', 'enabled', fallback=True)
+
+    @staticmethod
+    def key(sources_to_test, conf, host):
+        """Key of a build; None if the sources cannot be resolved (the build is then not cacheable)."""
+        sources = resolve_sources(sources_to_test)
+        if sources is None:
+            return None
+        return _hash(sources, build_conf(conf), host)
+
+    def _load(self):
+        try:
+            with io.open(self.filename, 'r') as c:
+                return json.load(c)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def lookup(self, key):
+        """Entry of a previous build with this *key*, if any."""
+        if key is None or not self.enabled:
+            return None
+        return self._load().get(key)
+
+    @staticmethod
+    def packs_exist(entry):
+        """Whether the packs of a previous build are still there; unknown packs are taken as missing."""
+        packs = entry.get('packs')
+        return isinstance(packs, dict) and len(packs) > 0 and all(os.path.isdir(p) for p in packs.values())
+
+    def record(self, key, xpid, sources_to_test, host, packs=None):
+        """Record a successful build, which made *packs* ({flavour: path})."""
+        if key is None or not self.enabled:
+            return
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        with locked(self.filename):
+            entries = self._load()
+            entries[key] = {'xpid': xpid,
+                            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                            'sources': {k: v for k, v in sources_to_test.items() if k.startswith('IAL')},
+                            'host': host,
+                            'packs': {f: os.path.realpath(p) for f, p in (packs or {}).items()}}
+            dump_json_atomically(entries, self.filename, indent=1, sort_keys=True, default=str)
+
+    def forget(self, key):
+        """Forget a build, e.g. because its pack has been removed."""
+        with locked(self.filename):
+            entries = self._load()
+            if entries.pop(key, None) is not None:
+                dump_json_atomically(entries, self.filename, indent=1, sort_keys=True, default=str)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Campaigns of experiments: a matrix of experiments (several IAL Git references x usecases),
+created (and possibly run) concurrently, with a bounded number of workers.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config, guess_host, DAVAI_RC_DIR
+from .util import dump_json_atomically
+from .experiment import XPmaker
+
+CAMPAIGNS_DIR = os.path.join(DAVAI_RC_DIR, 'campaigns')
+DEFAULT_WORKERS = 4
+
+
+class Campaign(object):
+    """A matrix of experiments: one per (IAL Git reference, usecase)."""
+
+    def __init__(self, IAL_git_refs, usecases, davai_tests_version,
+                 davai_tests_origin=config['defaults']['davai_tests_origin'],
+                 IAL_repository=config['paths']['IAL_repository'],
+                 host=None,
+                 workers=DEFAULT_WORKERS):
+        """
+        :param IAL_git_refs: IFS-Arpege-LAM Git references to be tested
+        :param usecases: usecases to be tested for each reference
+        :param davai_tests_version: version of the DAVAI-tests to be used
+        :param davai_tests_origin: origin repository of the DAVAI-tests to be cloned
+        :param IAL_repository: repository in which to find the Git references
+        :param host: host machine (guessed if not provided)
+        :param workers: maximum number of experiments created (or run) simultaneously
+        """
+        assert workers >= 1, "workers must be >= 1"
+        self.matrix = [(ref, usecase) for ref in IAL_git_refs for usecase in usecases]
+        assert self.matrix, "Empty campaign: no Git reference or no usecase"
+        self.davai_tests_version = davai_tests_version
+        self.davai_tests_origin = davai_tests_origin
+        self.IAL_repository = IAL_repository
+        self.host = host or guess_host()
+        self.workers = workers
+        self.name = 'campaign_{}'.format(time.strftime('%Y%m%d%H%M%S'))
+
+    @property
+    def manifest_file(self):
+        return os.path.join(CAMPAIGNS_DIR, self.name + '.json')
+
+    def _one(self, ref, usecase, xpid, run, **run_options):
+        """Create (and run) the experiment of one point of the matrix; return its record."""
+        record = {'IAL_git_ref': ref, 'usecase': usecase, 'xpid': xpid,
+                  'xp_path': None, 'status': None, 'error': None}
+        start = time.time()
+        try:
+            xp = XPmaker.new_xp({'IAL_git_ref': ref, 'IAL_repository': self.IAL_repository, 'comment': ref},
+                                self.davai_tests_version,
+                                davai_tests_origin=self.davai_tests_origin,
+                                usecase=usecase,
+                                host=self.host,
+                                xpid=xpid)
+            xp.write_genesis('{} (campaign {})'.format(ref, self.name))
+            record['xp_path'] = xp.xp_path
+            record['status'] = 'created'
+            if run:
+                xp.run(**run_options)
+                record['status'] = 'launched'
+        except Exception as e:
+            record['status'] = 'failed'
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+            traceback.print_exc()
+        record['elapsed'] = time.time() - start
+        return record
+
+    def launch(self, run=False, **run_options):
+        """
+        Create the experiments of the campaign, *workers* at a time; XPIDs are reserved as one block,
+        so that the experiments of a campaign are numbered consecutively.
+
+        :param run: also run each experiment once created (cf. ThisXP.run())
+        :param run_options: options of ThisXP.run(); batch mode is only allowed with a single worker,
+            as it changes the environment and working directory of the whole process
+        :return: records of the experiments, in the order of the matrix
+        """
+        if run and run_options.get('batch') and self.workers > 1 and len(self.matrix) > 1:
+            raise ValueError("Batch mode cannot be used when running experiments concurrently: use a single worker.")
+        xpids = XPmaker.reserve_xpids(len(self.matrix), host=self.host)
+        print("Campaign '{}': {} experiment(s), {} to {}".format(self.name, len(self.matrix), xpids[0], xpids[-1]))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._one, ref, usecase, xpid, run, **run_options)
+                       for (ref, usecase), xpid in zip(self.matrix, xpids)]
+            records = [f.result() for f in futures]
+        self.write(records)
+        return records
+
+    def write(self, records):
+        """Write the manifest of the campaign."""
+        if not os.path.isdir(CAMPAIGNS_DIR):
+            os.makedirs(CAMPAIGNS_DIR)
+        dump_json_atomically({'name': self.name,
+                              'davai_tests_version': self.davai_tests_version,
+                              'davai_tests_origin': self.davai_tests_origin,
+                              'host': self.host,
+                              'experiments': records},
+                             self.manifest_file, indent=2)
+
+    def report(self, records):
+        print("{:<30} {:<5} {:<26} {:<9} {:>8}".format('IAL_git_ref', 'use', 'xpid', 'status', 'time(s)'))
+        for r in records:
+            print("{:<30} {:<5} {:<26} {:<9} {:>8.1f}".format(r['IAL_git_ref'], r['usecase'], r['xpid'],
+                                                               r['status'], r['elapsed']))
+            if r['error']:
+                print("    " + r['error'])
+        print("Manifest: {}".format(self.manifest_file))
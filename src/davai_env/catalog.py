@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Catalog of the shelves present in the marketplace cache (sizes, last use, pinning),
+and eviction of the least recently used shelves to keep the cache under a size budget.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import time
+import shutil
+import contextlib
+
+from .util import dump_json_atomically, locked, format_size
+
+CATALOG_FILENAME = '.catalog.json'
+
+
+def _tree_mtime(directory):
+    """Last modification of the tree of directories of *directory* (as files are written or replaced there)."""
+    mtime = os.path.getmtime(directory)
+    for d, _, _ in os.walk(directory):
+        mtime = max(mtime, os.path.getmtime(d))
+    return mtime
+
+
+def _inodes(directory):
+    """Files of *directory*, as {inode: size}, inodes as 'dev:ino' (a file linked several times counted once)."""
+    files = {}
+    for d, _, filenames in os.walk(directory):
+        for f in filenames:
+            st = os.lstat(os.path.join(d, f))
+            files['{}:{}'.format(st.st_dev, st.st_ino)] = st.st_size
+    return files
+
+
+def _shares(entries):
+    """
+    Size of each shelf of *entries*, a file shared by several of them (deduplicated) counted for its share
+    in each, so that the sizes add up to the actual disk usage; and the number of shelves sharing each file.
+    """
+    users = {}
+    for e in entries.values():
+        for inode in e['files']:
+            users[inode] = users.get(inode, 0) + 1
+    sizes = {name: sum(size // users[inode] for inode, size in e['files'].items())
+             for name, e in entries.items()}
+    return sizes, users
+
+
+class ShelvesCatalog(object):
+    """
+    On-disk index of the shelves in marketplace cache, updated incrementally:
+    by the shelves actions themselves, and for the shelves which tree changed since last indexed.
+    Files are indexed by inode, so that the files shared by shelves are counted once.
+    """
+
+    def __init__(self, rootdir, object_store=None):
+        """
+        :param rootdir: directory of the shelves in marketplace cache
+        :param object_store: content-addressed store of files, to be pruned after eviction
+        """
+        self.rootdir = rootdir
+        self.filename = os.path.join(rootdir, CATALOG_FILENAME)
+        self.object_store = object_store
+
+    def _load(self):
+        if os.path.exists(self.filename):
+            with io.open(self.filename, 'r') as c:
+                return json.load(c)
+        return {}
+
+    @contextlib.contextmanager
+    def _editing(self):
+        """Load catalog for edition, under lock, and save it afterwards."""
+        if not os.path.exists(self.rootdir):
+            os.makedirs(self.rootdir)
+        with locked(self.filename):
+            entries = self._load()
+            yield entries
+            dump_json_atomically(entries, self.filename, indent=1, sort_keys=True)
+
+    def _index(self, entries, name, now=None):
+        """(Re-)Index shelf *name*."""
+        directory = os.path.join(self.rootdir, name)
+        e = entries.setdefault(name, {'pinned': False, 'last_used': now or time.time()})
+        e['tree_mtime'] = _tree_mtime(directory)
+        e['files'] = _inodes(directory)
+        e['size'] = sum(e['files'].values())
+        e.pop('dir_mtime', None)  # former versions
+        e['evicted'] = False
+        return e
+
+    def register(self, name):
+        """Register (or update) shelf *name*, which has just been brought into cache."""
+        with self._editing() as entries:
+            self._index(entries, name).update(last_used=time.time())
+
+    def touch(self, *names):
+        """Mark shelves *names* as used now."""
+        with self._editing() as entries:
+            for name in names:
+                if os.path.isdir(os.path.join(self.rootdir, name)):
+                    if name not in entries or 'files' not in entries[name]:
+                        self._index(entries, name)
+                    entries[name]['last_used'] = time.time()
+
+    def pin(self, name, pinned=True):
+        """Pin (or unpin) shelf *name*: a pinned shelf is never evicted."""
+        with self._editing() as entries:
+            if name not in entries:
+                self._index(entries, name)
+            entries[name]['pinned'] = pinned
+
+    def _refresh(self, entries):
+        present = set()
+        for name in os.listdir(self.rootdir):
+            directory = os.path.join(self.rootdir, name)
+            if name.startswith('.') or not os.path.isdir(directory):
+                continue
+            present.add(name)
+            e = entries.get(name)
+            if e is None or e.get('evicted') or 'files' not in e or _tree_mtime(directory) != e['tree_mtime']:
+                # last use unknown for shelves not brought in by davai-shelf: take their last access
+                self._index(entries, name, now=os.stat(directory).st_atime)
+        for name, e in entries.items():
+            if name not in present:
+                e['evicted'] = True
+                e['files'] = {}
+        return entries
+
+    def refresh(self):
+        """Update catalog for the shelves which appeared, changed or vanished since last indexed."""
+        with self._editing() as entries:
+            return self._refresh(entries)
+
+    def entries(self):
+        """Catalog entries, refreshed."""
+        return self.refresh()
+
+    def gc(self, budget, dry_run=False):
+        """
+        Evict least recently used, unpinned shelves until the cache fits in *budget* bytes.
+        Return the list of evicted shelves.
+        """
+        evicted = []
+        with self._editing() as entries:
+            present = {n: e for n, e in self._refresh(entries).items() if not e['evicted']}
+            sizes, users = _shares(present)
+            inodes_size = {inode: size for e in present.values() for inode, size in e['files'].items()}
+            total = sum(inodes_size.values())
+            candidates = sorted([n for n, e in present.items() if not e['pinned']],
+                                key=lambda n: present[n]['last_used'])
+            for name in candidates:
+                if total <= budget:
+                    break
+                print("{} '{}' ({}, last used {})".format('Would evict' if dry_run else 'Evict', name,
+                                                          format_size(sizes[name]),
+                                                          time.ctime(present[name]['last_used'])))
+                # only the files not shared with the remaining shelves are freed
+                for inode in present[name]['files']:
+                    users[inode] -= 1
+                    if users[inode] == 0:
+                        total -= inodes_size[inode]
+                if not dry_run:
+                    shutil.rmtree(os.path.join(self.rootdir, name))
+                    entries[name]['evicted'] = True
+                    entries[name]['files'] = {}
+                evicted.append(name)
+            if total > budget:
+                print("Cache size ({}) still over budget ({}): remaining shelves are pinned.".format(
+                      format_size(total), format_size(budget)))
+        if evicted and not dry_run and self.object_store is not None:
+            self.object_store.prune()
+        if evicted:
+            print("Evicted shelves can be recovered with: davai-shelf arch2mkt <shelf> -a <archive>")
+        return evicted
+
+    def print_list(self):
+        """Print the shelves in cache."""
+        entries = self.entries()
+        sizes, _ = _shares({n: e for n, e in entries.items() if not e['evicted']})
+        print("{:<50} {:>10} {:>26} {}".format('shelf', 'size', 'last used', ''))
+        for name, e in sorted(entries.items(), key=lambda i: i[1]['last_used'], reverse=True):
+            flags = ('pinned ' if e['pinned'] else '') + ('evicted' if e['evicted'] else '')
+            print("{:<50} {:>10} {:>26} {}".format(name, format_size(sizes.get(name, e['size'])),
+                                                   time.ctime(e['last_used']), flags))
+        print("Total in cache: {}".format(format_size(sum(sizes.values()))))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Garbage collection of experiments and their logs, according to age, count and size policies;
+experiments marked as references are protected. Trees are deleted with bounded parallelism,
+not to overload the metadata servers of parallel filesystems.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config, DAVAI_XPID_RE
+from .util import format_size, parse_size
+from .inventory import XPInventory, find_xps
+from .transfer import tree_size
+
+REFERENCE_MARKER = '.reference'
+DEFAULT_WORKERS = 8
+
+
+def parallel_rmtree(directory, workers=DEFAULT_WORKERS):
+    """
+    Remove a tree: files are unlinked (by directory) on a pool of *workers* threads,
+    then directories are removed bottom-up. Symbolic links are removed, not followed.
+    """
+    if os.path.islink(directory) or not os.path.isdir(directory):
+        if os.path.lexists(directory):
+            os.remove(directory)
+        return
+    directories = []
+
+    def unlink_all(d, names):
+        for n in names:
+            os.remove(os.path.join(d, n))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for d, dirnames, filenames in os.walk(directory):
+            links = [n for n in dirnames if os.path.islink(os.path.join(d, n))]
+            dirnames[:] = [n for n in dirnames if n not in links]
+            if filenames or links:
+                futures.append(executor.submit(unlink_all, d, filenames + links))
+            directories.append(d)
+        for f in futures:
+            f.result()
+    for d in reversed(directories):
+        os.rmdir(d)
+
+
+class GarbageCollector(object):
+    """Select experiments (and their logs) to be deleted, according to policies, and delete them."""
+
+    def __init__(self, older_than=None, keep_last=None, max_size=None, workers=None, orphan_logs=False):
+        """
+        :param older_than: delete experiments inactive for more than this number of days
+        :param keep_last: keep only this number of most recently active experiments
+        :param max_size: delete least recently active experiments until the total size fits (bytes)
+        :param workers: number of threads deleting (or sizing) trees
+        :param orphan_logs: also delete the logs of experiments which do not exist anymore
+        """
+        self.older_than = older_than
+        self.keep_last = keep_last
+        self.max_size = max_size
+        self.orphan_logs = orphan_logs
+        self.workers = workers or DEFAULT_WORKERS
+        self.inventory = XPInventory()
+
+    @staticmethod
+    def is_reference(xp_path):
+        return os.path.exists(os.path.join(xp_path, REFERENCE_MARKER))
+
+    @staticmethod
+    def protect(xp_path, protected=True):
+        """Mark (or unmark) an experiment as a reference, never to be collected."""
+        marker = os.path.join(xp_path, REFERENCE_MARKER)
+        if protected:
+            with io.open(marker, 'a'):
+                pass
+        elif os.path.exists(marker):
+            os.remove(marker)
+
+    def _orphan_logs(self, xpids):
+        """Logs directories of experiments which do not exist anymore."""
+        logs_rootdir = self.inventory.logs_rootdir
+        if not os.path.isdir(logs_rootdir):
+            return []
+        return sorted(os.path.join(logs_rootdir, d) for d in os.listdir(logs_rootdir)
+                      if DAVAI_XPID_RE.match(d) and d not in xpids)
+
+    def plan(self):
+        """
+        List the experiments with the decision about them, least recently active first:
+        dicts with keys xpid, paths, last_activity, size, reference, reason (None if kept).
+        Experiments which last activity is unknown are never selected by age, and taken as the most recent.
+        """
+        records = self.inventory.refresh()
+        xps = find_xps(self.inventory.experiments_rootdir)
+        candidates = []
+        for r in sorted(records.values(), key=lambda r: (r['last_activity'] or float('inf'), r['xpid'])):
+            candidates.append({'xpid': r['xpid'],
+                               'paths': [os.path.join(self.inventory.experiments_rootdir, r['xpid']),
+                                         os.path.join(self.inventory.logs_rootdir, r['xpid'])],
+                               'last_activity': r['last_activity'],
+                               'reference': self.is_reference(xps[r['xpid']]),
+                               'size': None,
+                               'reason': None})
+        if self.max_size is not None:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                sizes = executor.map(lambda c: sum(tree_size(p) for p in c['paths'] if os.path.isdir(p)),
+                                     candidates)
+                for c, size in zip(candidates, sizes):
+                    c['size'] = size
+        now = time.time()
+        if self.older_than is not None:
+            for c in candidates:
+                if c['last_activity'] and now - c['last_activity'] > self.older_than * 86400:
+                    c['reason'] = 'older than {} days'.format(self.older_than)
+        if self.keep_last is not None:
+            for c in candidates[:max(len(candidates) - self.keep_last, 0)]:
+                c['reason'] = c['reason'] or 'not in last {}'.format(self.keep_last)
+        if self.max_size is not None:
+            total = sum(c['size'] for c in candidates if c['reason'] is None or c['reference'])
+            for c in candidates:
+                if total <= self.max_size:
+                    break
+                if c['reason'] is None and not c['reference']:
+                    c['reason'] = 'over {}'.format(format_size(self.max_size))
+                    total -= c['size']
+        for c in candidates:
+            if c['reference'] and c['reason'] is not None:
+                c['reason'] = 'protected ({})'.format(c['reason'])
+        orphans = [{'xpid': os.path.basename(p), 'paths': [p], 'last_activity': os.path.getmtime(p),
+                    'reference': False, 'size': None, 'reason': 'orphan logs'}
+                   for p in (self._orphan_logs(set(records)) if self.orphan_logs else [])]
+        return orphans + candidates
+
+    @staticmethod
+    def to_delete(plan):
+        return [c for c in plan if c['reason'] is not None and not c['reference']]
+
+    def report(self, plan):
+        print("{:<26} {:<24} {:>8}  {}".format('xpid', 'last activity', 'size', 'decision'))
+        for c in plan:
+            print("{:<26} {:<24} {:>8}  {}".format(
+                  c['xpid'], time.ctime(c['last_activity']) if c['last_activity'] else 'unknown',
+                  '-' if c['size'] is None else format_size(c['size']),
+                  ('keep (reference)' if c['reference'] else 'keep') if c['reason'] is None else
+                  (c['reason'] if c['reference'] else 'delete: ' + c['reason'])))
+        to_delete = self.to_delete(plan)
+        sizes = [c['size'] for c in to_delete if c['size'] is not None]
+        print("{} experiment(s) or logs to delete{}.".format(
+              len(to_delete), ', {}'.format(format_size(sum(sizes))) if sizes else ''))
+
+    def collect(self, dry_run=True):
+        """Report the plan and, unless *dry_run*, delete the selected experiments and logs."""
+        plan = self.plan()
+        self.report(plan)
+        if dry_run:
+            print("Dry run: nothing deleted (use --delete to actually delete).")
+            return plan
+        cwd = os.path.realpath(os.getcwd())
+        for c in self.to_delete(plan):
+            if any(cwd.startswith(os.path.realpath(p) + os.sep) or cwd == os.path.realpath(p)
+                   for p in c['paths']):
+                print("Skip '{}': current directory is inside.".format(c['xpid']))
+                continue
+            start = time.time()
+            for p in c['paths']:
+                if os.path.lexists(p):
+                    parallel_rmtree(p, workers=self.workers)
+            print("Deleted '{}' ({:.1f}s)".format(c['xpid'], time.time() - start))
+        self.inventory.refresh()
+        return plan
+
+
+def collect_xps(older_than=None, keep_last=None, max_size=None, workers=None, delete=False, orphan_logs=False,
+                **_):
+    """Collect experiments according to policies (defaults from config [gc])."""
+    gc_config = config['gc'] if config.has_section('gc') else {}
+    if older_than is None and gc_config.get('older_than'):
+        older_than = float(gc_config['older_than'])
+    if keep_last is None and gc_config.get('keep_last'):
+        keep_last = int(gc_config['keep_last'])
+    if max_size is None and gc_config.get('max_size'):
+        max_size = gc_config['max_size']
+    if workers is None and gc_config.get('workers'):
+        workers = int(gc_config['workers'])
+    assert any(p is not None for p in (older_than, keep_last, max_size)), \
+        "At least one policy must be given: age (--older_than), count (--keep_last) or size (--max_size)"
+    if max_size is not None:
+        max_size = parse_size(max_size)
+    gc = GarbageCollector(older_than=older_than, keep_last=keep_last, max_size=max_size, workers=workers,
+                          orphan_logs=orphan_logs)
+    return gc.collect(dry_run=not delete)
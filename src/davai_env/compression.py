@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Parallel, streaming compression: the stream is split into blocks compressed independently on a pool
+of threads, and written in order as concatenated gzip members (readable by any gzip tool)
+or zstd frames (faster, requires the optional *zstandard* package).
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import zlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+#: codecs and the extension of the compressed tarfiles
+CODECS = {'gzip': '.tgz',
+          'zstd': '.tar.zst'}
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Codec 'zstd' requires the 'zstandard' package to be installed.")
+    return zstandard
+
+
+def codec_of(filename):
+    """Codec of a compressed tarfile, guessed from its extension; None if not compressed."""
+    for codec, ext in CODECS.items():
+        if filename.endswith(ext):
+            return codec
+    if filename.endswith('.tar.gz'):
+        return 'gzip'
+
+
+class ParallelBlockWriter(object):
+    """
+    Write-only file-like object, compressing what is written by blocks, on a pool of threads.
+    Memory use is bounded by about 2 x workers x block_size.
+    """
+
+    def __init__(self, fileobj, codec='gzip', level=6,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 workers=None):
+        """
+        :param fileobj: binary file object in which to write the compressed stream
+        :param codec: 'gzip' or 'zstd'
+        :param level: compression level
+        :param block_size: size of the (uncompressed) blocks compressed independently
+        :param workers: number of compression threads (defaults to the number of CPUs)
+        """
+        assert codec in CODECS, "Unknown codec: '{}'".format(codec)
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        if codec == 'zstd':
+            self._zstd_params = _zstandard().ZstdCompressionParameters.from_level(level)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.block_offsets = []  # offsets of the compressed blocks in output
+        self.closed = False
+
+    def _compress(self, block):
+        if self.codec == 'gzip':
+            c = zlib.compressobj(self.level, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+            return c.compress(block) + c.flush()
+        else:
+            return _zstandard().ZstdCompressor(compression_params=self._zstd_params).compress(block)
+
+    def _write_out(self, wait_all=False):
+        """Write compressed blocks in order, as soon as they are available."""
+        while self._pending and (wait_all or self._pending[0].done() or
+                                 len(self._pending) >= 2 * self.workers):
+            compressed = self._pending.popleft().result()
+            self.block_offsets.append(self.bytes_out)
+            self.fileobj.write(compressed)
+            self.bytes_out += len(compressed)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(self._compress, bytes(block)))
+        self._write_out()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer:
+            self._submit(self._buffer)
+            self._buffer = bytearray()
+        self._write_out(wait_all=True)
+        self._executor.shutdown()
+        self.fileobj.flush()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_decompressed(filename):
+    """Open a compressed tarfile for sequential reading of its decompressed stream."""
+    if codec_of(filename) == 'zstd':
+        return _zstandard().ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True,
+                                                             read_across_frames=True)
+    else:
+        import gzip
+        return gzip.open(filename, 'rb')
@@ -12,16 +12,31 @@ import os
 import getpass
 import io
 import re
+import fnmatch
 import subprocess
+import shutil
 import configparser
 import yaml
+import json
 import time
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from . import config, guess_host, initialized
-from . import DAVAI_XPID_SYNTAX, DAVAI_XP_COUNTER
-from .util import expandpath, set_default_mtooldir, vconf2usecase, usecase2vconf
+from . import DAVAI_XPID_SYNTAX, DAVAI_XP_COUNTER, CONFIG_HOST_FILE, CONFIG_USER_FILE
+from .util import (expandpath, set_default_mtooldir, vconf2usecase, usecase2vconf,
+                   dump_json_atomically, write_atomically, git_head, locked)
+from .mirror import DavaiTestsMirror
+from .summaries import SummariesReader, summaries_stack_dir, task_succeeded
+from .trace import Tracer
+from .buildcache import BuildCache, build_packs, link_packs
+from .jobarray import JobArrayPlan, scheduler as array_scheduler
+from .pycache import SharedBytecode, imports_env, load_imports
+from .prefetch import needed_shelves, ShelvesPrefetcher
 
-initialized()
+# C-accelerated YAML loader if available
+_yaml_loader = getattr(yaml, 'CLoader', yaml.Loader)
 
 
 class XPmaker(object):
@@ -29,88 +44,200 @@ class XPmaker(object):
     experiments_rootdir = expandpath(config['paths']['experiments'])
 
     @staticmethod
-    def next_xp_num():
-        """Get number of next Experiment."""
-        if not os.path.exists(DAVAI_XP_COUNTER):
+    def reserve_xp_nums(count=1):
+        """
+        Reserve a block of *count* consecutive experiment numbers, atomically: the counter is read
+        and incremented under a lock, so that concurrent creations never get the same number.
+        """
+        assert count >= 1, "count must be >= 1"
+        if not os.path.isdir(os.path.dirname(DAVAI_XP_COUNTER)):
+            os.makedirs(os.path.dirname(DAVAI_XP_COUNTER))
+        with locked(DAVAI_XP_COUNTER):
             num = 0
-        else:
-            with io.open(DAVAI_XP_COUNTER, 'r') as f:
-                num = int(f.readline())
-        next_num = num + 1
-        with io.open(DAVAI_XP_COUNTER, 'w') as f:
-            f.write(str(next_num))
-        return next_num
+            if os.path.exists(DAVAI_XP_COUNTER):
+                with io.open(DAVAI_XP_COUNTER, 'r') as f:
+                    num = int(f.readline().strip() or 0)
+            write_atomically(str(num + count), DAVAI_XP_COUNTER)
+        return list(range(num + 1, num + count + 1))
 
     @classmethod
-    def _new_XPID(cls, host):
-        return DAVAI_XPID_SYNTAX.format(xpid_num=cls.next_xp_num(),
+    def next_xp_num(cls):
+        """Get number of next Experiment."""
+        return cls.reserve_xp_nums(1)[0]
+
+    @staticmethod
+    def _XPID(xpid_num, host):
+        return DAVAI_XPID_SYNTAX.format(xpid_num=xpid_num,
                                         host=host,
                                         user=getpass.getuser())
 
+    @classmethod
+    def _new_XPID(cls, host):
+        return cls._XPID(cls.next_xp_num(), host)
+
+    @classmethod
+    def reserve_xpids(cls, count, host=None):
+        """Reserve a block of *count* XPIDs, e.g. for a campaign of experiments."""
+        if host is None:
+            host = guess_host()
+        return [cls._XPID(num, host) for num in cls.reserve_xp_nums(count)]
+
+    @classmethod
+    def _XP_path(cls, xpid, usecase):
+        return os.path.join(cls.experiments_rootdir, xpid, 'davai', usecase2vconf(usecase))
+
     @classmethod
     def _new_XP_path(cls, host, usecase):
-        return os.path.join(cls.experiments_rootdir, cls._new_XPID(host), 'davai', usecase2vconf(usecase))
+        return cls._XP_path(cls._new_XPID(host), usecase)
 
     @staticmethod
     def _setup_XP_path(xp_path):
-        assert not os.path.exists(xp_path), "XP path: '{}' already exists".format(xp_path)
-        os.makedirs(xp_path)
+        try:
+            os.makedirs(xp_path)
+        except OSError:
+            if os.path.exists(xp_path):
+                raise AssertionError("XP path: '{}' already exists".format(xp_path))
+            raise
         print("XP path created : {}".format(xp_path))
 
     @classmethod
     def new_xp(cls, sources_to_test, davai_tests_version,
                davai_tests_origin=config['defaults']['davai_tests_origin'],
                usecase=config['defaults']['usecase'],
-               host=guess_host()):
+               host=None,
+               xpid=None):
         """
         Create a new experiment.
+        The current working directory is left unchanged: this can be called concurrently from threads.
 
         :param sources_to_test: information about the sources to be tested, provided as a dict
         :param davai_tests_version: version of the DAVAI-tests to be used
         :param davai_tests_origin: origin repository of the DAVAI-tests to be cloned
         :param usecase: type of set of tests to be prepared
-        :param host: host machine
+        :param host: host machine (guessed if not provided)
+        :param xpid: XPID previously reserved (cf. reserve_xpids()); a new one if not provided
         """
 
         assert usecase in ('NRV', 'ELP'), "Usecase not implemented yet: " + usecase
-        xp_path = cls._new_XP_path(host, usecase)
+        initialized()
+        if host is None:
+            host = guess_host()
+        if xpid is None:
+            xp_path = cls._new_XP_path(host, usecase)
+        else:
+            xp_path = cls._XP_path(xpid, usecase)
         cls._setup_XP_path(xp_path)
-        # now XP path is created, we move in for the continuation of the experiment setup
-        os.chdir(xp_path)
-        xp = ThisXP(new=True)
-        xp.setup(sources_to_test, davai_tests_version,
-                 davai_tests_origin=davai_tests_origin,
-                 usecase=usecase,
-                 host=host)
+        xp = ThisXP(xp_path, new=True)
+        with xp.tracer.span('new_xp', usecase=usecase, host=host, davai_tests_version=davai_tests_version):
+            xp.setup(sources_to_test, davai_tests_version,
+                     davai_tests_origin=davai_tests_origin,
+                     usecase=usecase,
+                     host=host)
         return xp
 
 
+#: the working directory and environment are process-wide: in-process mkjob runs (which change them) are
+#: serialized, and must not run concurrently with other experiments of the same process (cf. Campaign)
+_cwd_lock = threading.Lock()
+
+
+class _InProcessMkjob(object):
+    """Run the mkjob script several times within the current interpreter, compiling it only once."""
+
+    def __init__(self, script, cwd=None):
+        self.script = os.path.abspath(script)
+        self.cwd = cwd
+        with io.open(self.script, 'r') as s:
+            self.code = compile(s.read(), self.script, 'exec')
+
+    def preload(self, modules=('vortex',)):
+        """Import ahead the heavy modules mkjob relies upon, if they can be found."""
+        vortexpath = os.path.dirname(os.path.dirname(self.script))
+        for p in (vortexpath, os.path.join(vortexpath, 'src'), os.path.join(vortexpath, 'site')):
+            if p not in sys.path:
+                sys.path.append(p)
+        for m in modules:
+            try:
+                importlib.import_module(m)
+            except ImportError:
+                pass
+
+    def __call__(self, args, env=None):
+        """
+        Run mkjob with command-line *args*, as would `python3 mkjob.py *args` from within *cwd*,
+        with extra environment variables *env*.
+        """
+        with _cwd_lock:
+            argv = sys.argv
+            path = list(sys.path)
+            cwd = os.getcwd()
+            environ = dict(os.environ)
+            sys.argv = [self.script] + list(args)
+            sys.path.insert(0, os.path.dirname(self.script))
+            try:
+                os.environ.update(env or {})
+                if self.cwd is not None:
+                    os.chdir(self.cwd)
+                exec(self.code, {'__name__': '__main__', '__file__': self.script})
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise subprocess.CalledProcessError(e.code, sys.argv)
+            finally:
+                os.chdir(cwd)
+                os.environ.clear()
+                os.environ.update(environ)
+                sys.argv = argv
+                sys.path[:] = path
+                sys.stdout.flush()
+
+
 class ThisXP(object):
-    """Handles the existing experiment determined by the current working directory."""
+    """
+    Handles an existing experiment, given by its path or determined by the current working directory.
+    All files of the experiment are accessed through its path, and subprocesses are run from within it:
+    the working directory of the process is never changed.
+    """
 
     davai_tests_dir = 'DAVAI-tests'
+    mkjob = os.path.join('vortex', 'bin', 'mkjob.py')
     sources_to_test_file = os.path.join('conf', 'sources.yaml')
+    state_file = '.state.json'
+    imports_file = '.imports.json'
     sources_to_test_minimal_keys = (set(('IAL_git_ref',)),
                                     set(('IAL_bundle',)),
                                     set(('IAL_bundle_file',))
                                     )
 
-    def __init__(self, new=False):
-        self.xp_path = os.getcwd()
+    def __init__(self, xp_path=None, new=False):
+        """
+        :param xp_path: path of the experiment (defaults to the current working directory)
+        :param new: the experiment is being created
+        """
+        self.xp_path = os.path.abspath(xp_path if xp_path is not None else os.getcwd())
         self.xpid = os.path.basename(os.path.dirname(os.path.dirname(self.xp_path)))
         self.vapp = os.path.basename(os.path.dirname(self.xp_path))
         self.vconf = os.path.basename(self.xp_path)
         self.usecase = vconf2usecase(self.vconf)
         self.general_config_file = os.path.join('conf','{}_{}.ini'.format(self.vapp, self.vconf))
+        self._mkjob_lock = threading.Lock()
+        self._processes = set()
+        self._processes_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._env = {}
+        self.tracer = Tracer.for_xp(self.xp_path)
         if not new:
             self.assert_cwd_is_an_xp()
 
+    def _path(self, *relative):
+        """Absolute path of *relative* within the experiment."""
+        return os.path.join(self.xp_path, *relative)
+
 # setup --------------------------------------------------------------------------------------------------------------
 
     def setup(self, sources_to_test, davai_tests_version,
               davai_tests_origin=config['defaults']['davai_tests_origin'],
               usecase=config['defaults']['usecase'],
-              host=guess_host()):
+              host=None):
         """
         Setup the experiment (at creation time).
 
@@ -118,26 +245,35 @@ class ThisXP(object):
         :param davai_tests_version: version of the DAVAI-tests to be used
         :param davai_tests_origin: remote repository of the DAVAI-tests to be cloned
         :param usecase: type of set of tests to be prepared
-        :param host: host machine
+        :param host: host machine (guessed if not provided)
         """
+        if host is None:
+            host = guess_host()
         # set DAVAI-tests repo
-        self._setup_DAVAI_tests(davai_tests_origin, davai_tests_version)
-        self._setup_tasks()
-        self._setup_packages()
-        self._setup_logs()
+        with self.tracer.span('setup DAVAI-tests', origin=davai_tests_origin, version=davai_tests_version):
+            self._setup_DAVAI_tests(davai_tests_origin, davai_tests_version)
+        with self.tracer.span('setup links'):
+            self._setup_tasks()
+            self._setup_packages()
+            self._setup_logs()
+        with self.tracer.span('setup imports'):
+            self._setup_imports()
         # configuration files
-        os.makedirs('conf')
-        self._setup_conf_sources(sources_to_test)
-        self._setup_conf_usecase(usecase)
-        self._setup_conf_general(host)
+        with self.tracer.span('setup conf'):
+            os.makedirs(self._path('conf'))
+            self._setup_conf_sources(sources_to_test)
+            self._setup_conf_usecase(usecase)
+            self._setup_conf_general(host)
+        with self.tracer.span('setup state'):
+            self._setup_state()
         self._setup_final_prompt()
 
     @staticmethod
-    def _checkout_davai_tests(gitref):
-        """Check that requested tests version exists, and switch to it."""
+    def _checkout_davai_tests(gitref, repository=None):
+        """Check that requested tests version exists in *repository* (default: cwd), and switch to it."""
         remote = 'origin'
         remote_gitref = '{}/{}'.format(remote, gitref)
-        branches = subprocess.check_output(['git', 'branch'], stderr=None).decode('utf-8').split('\n')
+        branches = subprocess.check_output(['git', 'branch'], stderr=None, cwd=repository).decode('utf-8').split('\n')
         head = [line.strip() for line in branches if line.startswith('*')][0][2:]
         detached = re.match('\(HEAD detached at (?P<ref>.*)\)$', head)
         if detached:
@@ -147,7 +283,7 @@ class ThisXP(object):
             try:
                 # A: is it a local branch ?
                 cmd = ['git', 'show-ref', '--verify', 'refs/heads/{}'.format(gitref)]
-                subprocess.check_call(cmd,
+                subprocess.check_call(cmd, cwd=repository,
                                       stderr=subprocess.DEVNULL,
                                       stdout=subprocess.DEVNULL)
             except subprocess.CalledProcessError:
@@ -156,7 +292,7 @@ class ThisXP(object):
                 # B: maybe it is a remote branch ?
                 cmd = ['git', 'show-ref', '--verify', 'refs/remotes/{}/{}'.format(remote, gitref)]
                 try:
-                    subprocess.check_call(cmd,
+                    subprocess.check_call(cmd, cwd=repository,
                                           stderr=subprocess.DEVNULL,
                                           stdout=subprocess.DEVNULL)
                 except subprocess.CalledProcessError:
@@ -172,18 +308,39 @@ class ThisXP(object):
             # remote question has been sorted
             print("Switch DAVAI-tests repo from current HEAD '{}' to '{}'".format(head, gitref))
             try:
-                subprocess.check_call(['git', 'checkout', gitref, '-q'])
+                subprocess.check_call(['git', 'checkout', gitref, '-q'], cwd=repository)
             except subprocess.CalledProcessError:
                 print("Have you updated your DAVAI-tests repository (command: davai-update) ?")
                 raise
 
     def _setup_DAVAI_tests(self, remote, version):
-        """Clone and checkout required version of the DAVAI-tests."""
-        subprocess.check_call(['git', 'clone', remote, self.davai_tests_dir])
-        os.chdir(self.davai_tests_dir)
-        subprocess.check_call(['git', 'fetch', 'origin', version, '-q'])
-        self._checkout_davai_tests(version)
-        os.chdir(self.xp_path)
+        """
+        Clone and checkout required version of the DAVAI-tests.
+        The clone is made from a shared local mirror of the remote, if enabled.
+        """
+        fetch_from = 'origin'
+        davai_tests_dir = self._path(self.davai_tests_dir)
+        mirror = DavaiTestsMirror.for_origin(remote)
+        if mirror is not None:
+            try:
+                if mirror.updatable:
+                    with self.tracer.span('git mirror update', cat='subprocess', mirror=mirror.path):
+                        mirror.update()
+                    fetch_from = mirror.path
+                with self.tracer.span('git clone --shared', cat='subprocess'):
+                    mirror.clone(davai_tests_dir)
+            except subprocess.CalledProcessError:
+                print("Could not use DAVAI-tests mirror '{}': clone from remote.".format(mirror.path))
+                fetch_from = 'origin'
+                shutil.rmtree(davai_tests_dir, ignore_errors=True)
+                mirror = None
+        if mirror is None:
+            with self.tracer.span('git clone', cat='subprocess', origin=remote):
+                subprocess.check_call(['git', 'clone', remote, davai_tests_dir])
+        with self.tracer.span('git fetch', cat='subprocess', remote=fetch_from):
+            subprocess.check_call(['git', 'fetch', fetch_from, version, '-q'], cwd=davai_tests_dir)
+        with self.tracer.span('git checkout', cat='subprocess'):
+            self._checkout_davai_tests(version, repository=davai_tests_dir)
 
     def check_sources_to_test(self, sources_to_test):
         assertion_test = any([s.issubset(set(sources_to_test.keys())) for s in self.sources_to_test_minimal_keys])
@@ -194,42 +351,64 @@ class ThisXP(object):
     def _setup_conf_sources(self, sources_to_test):
         """Sources config: information on sources to be tested."""
         self.check_sources_to_test(sources_to_test)
-        with io.open(self.sources_to_test_file, 'w') as f:
+        with io.open(self._path(self.sources_to_test_file), 'w') as f:
             yaml.dump(sources_to_test, f)
 
     def _setup_conf_usecase(self, usecase):
         """Usecase config : set of jobs/tests."""
         filename = os.path.join('conf', '{}.yaml'.format(self.usecase))
         os.symlink(os.path.join('..', self.davai_tests_dir, filename),
-                   filename)
+                   self._path(filename))
 
-    def _setup_conf_general(self, host=guess_host()):
+    def _setup_conf_general(self, host=None):
         """General config file for the jobs."""
+        if host is None:
+            host = guess_host()
         host_general_config_file = os.path.join('..', self.davai_tests_dir, 'conf', '{}.ini'.format(host))
         os.symlink(host_general_config_file,
-                   self.general_config_file)
+                   self._path(self.general_config_file))
 
     def _setup_tasks(self):
         """Link tasks."""
         os.symlink(os.path.join(self.davai_tests_dir, 'src', 'tasks'),
-                   'tasks')
+                   self._path('tasks'))
 
     def _setup_packages(self):
         """Link necessary packages in XP."""
         # davai_taskutil from DAVAI-tests locally checkedout
         os.symlink(os.path.join(self.davai_tests_dir, 'src', 'davai_taskutil'),
-                   'davai_taskutil')
+                   self._path('davai_taskutil'))
         # other packages
         packages = {p:expandpath(config['packages'][p]) for p in config['packages']}
         for package, path in packages.items():
-            os.symlink(expandpath(path), package)
+            os.symlink(expandpath(path), self._path(package))
+
+    def _setup_imports(self):
+        """
+        Precompile the linked packages in the shared bytecode cache (and pack them, if config
+        [pycache][zip]), and record it for the jobs, which will be pointed at it.
+        """
+        shared = SharedBytecode()
+        if not shared.enabled:
+            return
+        packages = {p: expandpath(config['packages'][p]) for p in config['packages']}
+        try:
+            imports = shared.prepare(packages, zip_packages=config.getboolean('pycache', 'zip', fallback=False))
+        except (subprocess.CalledProcessError, OSError) as e:
+            print("Could not precompile linked packages ({}): jobs will compile them.".format(e))
+            return
+        dump_json_atomically(imports, self._path(self.imports_file), indent=2)
 
     def _setup_logs(self):
         """Deport 'logs' directory."""
         logs_directory = expandpath(config['paths']['logs'])
         logs = os.path.join(logs_directory, self.xpid)
         os.makedirs(logs)
-        os.symlink(logs, 'logs')
+        os.symlink(logs, self._path('logs'))
+
+    def _setup_state(self):
+        """Resolve and write state manifest."""
+        return self.state
 
     def _setup_final_prompt(self):
         """Final prompt for the setup of the experiment."""
@@ -249,64 +428,138 @@ class ThisXP(object):
 # properties ----------------------------------------------------------------------------------------------------------
 
     def cwd_is_an_xp(self):
-        """Whether the cwd is an actual experiment or not."""
-        return os.path.exists(self.general_config_file)
+        """Whether the XP path (by default the cwd) is an actual experiment or not."""
+        return os.path.exists(self._path(self.general_config_file))
 
     def assert_cwd_is_an_xp(self):
         """Assert that the cwd is an actual experiment."""
-        assert self.cwd_is_an_xp(), "Current working directory is not a Davai experiment directory"
+        assert self.cwd_is_an_xp(), "'{}' is not a Davai experiment directory".format(self.xp_path)
 
     @property
     def conf(self):
         if not hasattr(self, '_conf'):
             config = configparser.ConfigParser()
-            config.read(self.general_config_file)
+            config.read(self._path(self.general_config_file))
             self._conf = config
         return self._conf
 
+    def _load_sources_to_test(self):
+        """Read and complete sources config."""
+        with io.open(self._path(self.sources_to_test_file), 'r') as f:
+            c = yaml.load(f, _yaml_loader)
+        self.check_sources_to_test(c)
+        # complete particular config
+        if 'IAL_git_ref' in c:
+            # sources to be tested taken from IAL_git_ref@IAL_repository
+            if c.get('comment', None) is None:
+                c['comment'] = c['IAL_git_ref']
+            repo = c.get('IAL_repository', config['paths']['IAL_repository'])
+            c['IAL_repository'] = expandpath(repo)
+        elif 'IAL_bundle' in c:
+            # sources to be tested taken from IAL_bundle@IAL_bundle_repository
+            if c.get('comment', None) is None:
+                c['comment'] = c['IAL_bundle']
+            repo = c.get('IAL_bundle_repository', config['paths']['IAL_bundle_repository'])
+            c['IAL_bundle_repository'] = expandpath(repo)
+        elif 'IAL_bundle_file' in c:
+            # sources to be tested taken from IAL_bundle_file
+            if c.get('comment', None) is None:
+                c['comment'] = c['IAL_bundle_file']
+        return c
+
+    @property
+    def jobs_list_file(self):
+        return os.path.join('conf', '{}.yaml'.format(self.usecase))
+
+    def _load_all_jobs(self):
+        """Read jobs list according to *usecase*."""
+        with io.open(self._path(self.jobs_list_file), 'r') as fin:
+            return yaml.load(fin, _yaml_loader)
+
+    @property
+    def jobs_env(self):
+        """Extra environment variables of the jobs: shared bytecode of linked packages, start of build..."""
+        if not hasattr(self, '_imports_env'):
+            self._imports_env = imports_env(load_imports(self._path(self.imports_file)))
+        return dict(self._imports_env, **self._env)
+
+    def _git_davai_tests_version(self):
+        output = subprocess.check_output(['git', 'log' , '-n1', '--decorate', '--oneline'],
+                                         cwd=self._path(self.davai_tests_dir)
+                                         ).decode('utf-8').split('\n')
+        return output[0]
+
+    def _state_key(self):
+        """Key of validity of the state manifest: HEAD of DAVAI-tests and mtimes of config files."""
+        conf_files = (self.sources_to_test_file, self.jobs_list_file, self.general_config_file,
+                      CONFIG_HOST_FILE, CONFIG_USER_FILE)
+        return {'tests_commit': git_head(self._path(self.davai_tests_dir)),
+                'conf': [[f, os.path.getmtime(self._path(f)) if os.path.exists(self._path(f)) else None]
+                         for f in conf_files]}
+
+    def _resolve_state(self, key):
+        """Resolve the state of the experiment from DAVAI-tests and config files."""
+        all_jobs = self._load_all_jobs()
+        jobs = ['.'.join([family, job]) for family, jobs in all_jobs.items() for job in jobs]
+        return {'key': key,
+                'xpid': self.xpid,
+                'usecase': self.usecase,
+                'sources_to_test': self._load_sources_to_test(),
+                'tests_commit': key['tests_commit'],
+                'all_jobs': all_jobs,
+                'jobs': jobs,
+                'shelves': needed_shelves(self.conf, jobs)}
+
+    @property
+    def state(self):
+        """
+        State of the experiment: xpid, resolved sources, tests version and jobs.
+        Read from the state manifest if up-to-date, otherwise resolved and (re-)written.
+        """
+        if not hasattr(self, '_state'):
+            key = self._state_key()
+            state = None
+            state_file = self._path(self.state_file)
+            if os.path.exists(state_file):
+                try:
+                    with io.open(state_file, 'r') as s:
+                        state = json.load(s)
+                except ValueError:
+                    pass
+                if state is not None and state.get('key') != key:
+                    state = None
+            if state is None:
+                state = self._resolve_state(key)
+                try:
+                    dump_json_atomically(state, state_file, indent=2, default=str)
+                except (IOError, OSError) as e:
+                    print("Could not write state manifest '{}': {}".format(state_file, e))
+            self._state = state
+        return self._state
+
     @property
     def sources_to_test(self):
         """Sources config: information on sources to be tested."""
-        if not hasattr(self, '_sources_to_test'):
-            with io.open(self.sources_to_test_file, 'r') as f:
-                c = yaml.load(f, yaml.Loader)
-            self.check_sources_to_test(c)
-            # complete particular config
-            if 'IAL_git_ref' in c:
-                # sources to be tested taken from IAL_git_ref@IAL_repository
-                if c.get('comment', None) is None:
-                    c['comment'] = c['IAL_git_ref']
-                repo = c.get('IAL_repository', config['paths']['IAL_repository'])
-                c['IAL_repository'] = expandpath(repo)
-            elif 'IAL_bundle' in c:
-                # sources to be tested taken from IAL_bundle@IAL_bundle_repository
-                if c.get('comment', None) is None:
-                    c['comment'] = c['IAL_bundle']
-                repo = c.get('IAL_bundle_repository', config['paths']['IAL_bundle_repository'])
-                c['IAL_bundle_repository'] = expandpath(repo)
-            elif 'IAL_bundle_file' in c:
-                # sources to be tested taken from IAL_bundle_file
-                if c.get('comment', None) is None:
-                    c['comment'] = c['IAL_bundle_file']
-            self._sources_to_test = c
-        return self._sources_to_test
+        return self.state['sources_to_test']
 
     @property
     def all_jobs(self):
         """Get all jobs according to *usecase* (found in config)."""
-        if not hasattr(self, '_all_jobs'):
-            jobs_list_file = 'conf/{}.yaml'.format(self.usecase)
-            with io.open(jobs_list_file, 'r') as fin:
-                self._all_jobs = yaml.load(fin, yaml.Loader)
-        return self._all_jobs
+        return self.state['all_jobs']
 
     @property
     def davai_tests_version(self):
-        cmd = ['git', 'log' , '-n1', '--decorate', '--oneline']
-        output = subprocess.check_output(['git', 'log' , '-n1', '--decorate', '--oneline'],
-                                         cwd=os.path.join(self.xp_path, self.davai_tests_dir)
-                                         ).decode('utf-8').split('\n')
-        return output[0]
+        """Version of the DAVAI-tests, with its decorations (branches, tags) resolved on demand."""
+        if not hasattr(self, '_davai_tests_version'):
+            self._davai_tests_version = self._git_davai_tests_version()
+        return self._davai_tests_version
+
+    @property
+    def shelves(self):
+        """Shelves needed by the jobs, as a dict {shelf: [jobs]}."""
+        if 'shelves' not in self.state:  # state manifest written by a former version
+            self.state['shelves'] = needed_shelves(self.conf, self.state['jobs'])
+        return self.state['shelves']
 
 # utilities ----------------------------------------------------------------------------------------------------------
 
@@ -316,6 +569,13 @@ class ThisXP(object):
             for job in jobs:
                 print('.'.join([family, job]))
 
+    def _mkjob_cmd(self, task, name, **extra_parameters):
+        """Command line to mkjob for one job."""
+        cmd = ['python3', self.mkjob, '-j',
+               'task={}'.format(task.strip()), 'name={}'.format(name.strip())]
+        cmd.extend(['{}={}'.format(k,v) for k,v in extra_parameters.items()])
+        return cmd
+
     def _launch(self, task, name,
                drymode=False,
                **extra_parameters):
@@ -326,16 +586,82 @@ class ThisXP(object):
         :param name: name of the job, to get its confog characteristics (profile, ...)
         :param extra_parameters: extra parameters to be passed to mkjob on the fly
         """
-        cmd = ['python3', 'vortex/bin/mkjob.py', '-j',
-               'task={}'.format(task.strip()), 'name={}'.format(name.strip())]
-        cmd.extend(['{}={}'.format(k,v) for k,v in extra_parameters.items()])
+        cmd = self._mkjob_cmd(task, name, **extra_parameters)
         print("Executing: '{}'".format(' '.join(cmd)))
         if not drymode:
-            subprocess.check_call(cmd)
+            with self.tracer.span(task, cat='job', job_name=name):
+                self._check_call(cmd)
 
-    def launch_ciboulai_init(self):
+    def _check_call(self, cmd):
+        """
+        As subprocess.check_call(), run from within the experiment, with its own environment variables,
+        but keeping track of the process so that it can be terminated.
+        Once the launches are cancelled, no process is started anymore.
+        """
+        env = self.jobs_env
+        with self._processes_lock:
+            if self._cancelled.is_set():
+                raise RuntimeError("Launches cancelled: '{}' not executed".format(' '.join(cmd)))
+            p = subprocess.Popen(cmd, cwd=self.xp_path, env=dict(os.environ, **env) if env else None)
+            self._processes.add(p)
+        try:
+            retcode = p.wait()
+        finally:
+            with self._processes_lock:
+                self._processes.discard(p)
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, cmd)
+
+    def _terminate_launched(self):
+        """Cancel the launches: terminate the launching processes still running, and start no other."""
+        with self._processes_lock:
+            self._cancelled.set()
+            for p in self._processes:
+                p.terminate()
+
+    @property
+    def _in_process_mkjob(self):
+        """mkjob machinery loaded within this interpreter."""
+        with self._mkjob_lock:
+            if not hasattr(self, '_mkjob_runner'):
+                self._mkjob_runner = _InProcessMkjob(self._path(self.mkjob), cwd=self.xp_path)
+        return self._mkjob_runner
+
+    def _launch_batch(self, jobs, drymode=False):
+        """
+        Launch a series of jobs from within this interpreter, so that the mkjob machinery
+        (and Vortex behind it) is loaded only once.
+        If the machinery cannot be loaded, fall back to one subprocess per job for the remaining jobs;
+        other errors are raised, as the job may have been submitted already.
+
+        :param jobs: list of (task, name) couples
+        """
+        for i, (task, name) in enumerate(jobs):
+            cmd = self._mkjob_cmd(task, name)
+            print("Executing: '{}'".format(' '.join(cmd)))
+            if drymode:
+                continue
+            try:
+                mkjob = self._in_process_mkjob
+            except (IOError, OSError, SyntaxError) as e:
+                mkjob, error = None, e
+            if mkjob is not None:
+                try:
+                    with self.tracer.span(task, cat='job', job_name=name, in_process=True):
+                        mkjob(cmd[2:], env=self.jobs_env)
+                    continue
+                except ImportError as e:  # raised by the imports of the script, before any submission
+                    error = e
+            print("Could not load mkjob machinery in process ({}: {}): fall back to subprocesses.".format(
+                  type(error).__name__, error))
+            for task, name in jobs[i:]:
+                self._launch(task, name)
+            break
+
+    def launch_ciboulai_init(self, drymode=False):
         """(Re-)Initialize Ciboulai dashboard."""
         self._launch('ciboulai_xpsetup', 'ciboulai_xpsetup',
+                     drymode=drymode,
                      profile='rd',
                      usecase=self.usecase,
                      tests_version=self.davai_tests_version.replace("'", '"'),
@@ -343,9 +669,35 @@ class ThisXP(object):
 
     def launch_build(self,
                      drymode=False,
-                     preexisting_pack=False):
-        """Launch build job."""
-        os.environ['DAVAI_START_BUILD'] = str(time.time())
+                     preexisting_pack=False,
+                     use_cache=True):
+        """
+        Launch build job.
+        If the same sources have already been built with the same build config on this host
+        (according to the build cache), and its pack is still there, it is reused, linked as the pack of
+        this experiment: depending on config [build_cache][on_hit], the build is launched with
+        *preexisting_pack* (nothing to recompile), or skipped.
+        """
+        self._env['DAVAI_START_BUILD'] = str(time.time())
+        host = guess_host()
+        cache = BuildCache()
+        packs = build_packs(self.sources_to_test, self.conf)
+        use_cache = use_cache and cache.enabled and packs is not None
+        cache_key = cache.key(self.sources_to_test, self.conf, host) if use_cache else None
+        hit = cache.lookup(cache_key)
+        if hit is not None and not cache.packs_exist(hit):
+            print("Build cache: the pack of the build of these sources by '{}' is not found anymore.".format(
+                  hit['xpid']))
+            cache.forget(cache_key)
+            hit = None
+        if hit is not None and not preexisting_pack:
+            print("Build cache: these sources have already been built by '{}' ({}): reuse its pack.".format(
+                  hit['xpid'], hit['date']))
+            if not drymode:
+                link_packs(hit['packs'], packs)
+            if config.get('build_cache', 'on_hit', fallback='preexisting') == 'skip':
+                return
+            preexisting_pack = True
         if self.conf['DEFAULT']['compiling_system'] == 'gmkpack':
             if 'IAL_git_ref' in self.sources_to_test:
                 # build from a single IAL Git reference
@@ -362,25 +714,225 @@ class ThisXP(object):
         else:
             raise NotImplementedError("compiling_system == {}".format(self.conf['DEFAULT']['compiling_system']))
         # run build monitoring
-        if guess_host() != 'atos_bologna':  # FIXME: dirty
+        if host != 'atos_bologna':  # FIXME: dirty
             set_default_mtooldir()
         self._launch('build.wait4build', 'build',
                      drymode=drymode,
                      profile='rd')
-
-    def launch_jobs(self, only_job=None, drymode=False):
-        """Launch jobs, either all, or only the one requested."""
-        only_job_launched = False
+        if not drymode:
+            cache.record(cache_key, self.xpid, self.sources_to_test, host, packs=packs)
+
+    def jobs_to_launch(self, only_job=None,
+                       patterns=None,
+                       families=None,
+                       jobs_file=None,
+                       regex=False,
+                       failed_only=False):
+        """
+        List of (task, name) of the jobs to be launched: all of them, or a selection.
+        Jobs are selected if they match any of the selection criteria *only_job*, *patterns*,
+        *families* and *jobs_file*; the selection is then restricted to failed jobs if *failed_only*.
+
+        :param only_job: one job, as 'family.job'
+        :param patterns: patterns (globs, or regular expressions if *regex*) to be matched by 'family.job'
+        :param families: families of jobs
+        :param jobs_file: file containing patterns, one per line ('#' for comments)
+        :param regex: patterns are regular expressions rather than globs
+        :param failed_only: only the jobs which tasks summaries report as failed, or missing
+        """
+        patterns = list(patterns or [])
+        if jobs_file is not None:
+            with io.open(jobs_file, 'r') as f:
+                patterns.extend([line.split('#')[0].strip() for line in f if line.split('#')[0].strip()])
+        if regex:
+            matchers = [re.compile(p).search for p in patterns]
+        else:
+            matchers = [re.compile(fnmatch.translate(p)).match for p in patterns]
+        families = set(families or [])
+        select = only_job is not None or len(patterns) > 0 or len(families) > 0
+        to_launch = []
+        matched = set()
         for family, jobs in self.all_jobs.items():
             for job in jobs:
                 task = '.'.join([family, job])
                 name = job
-                if only_job in (None, task):
-                    self._launch(task, name, drymode=drymode)
-                    if only_job is not None:
-                        only_job_launched = True
-        if only_job is not None and not only_job_launched:
+                selected = not select
+                if task == only_job:
+                    matched.add(only_job)
+                    selected = True
+                if family in families:
+                    matched.add(family)
+                    selected = True
+                for p, m in zip(patterns, matchers):
+                    if m(task):
+                        matched.add(p)
+                        selected = True
+                if selected:
+                    to_launch.append((task, name))
+        if only_job is not None and only_job not in matched:
             raise ValueError("Unknown job: {}".format(only_job))
+        unmatched = [c for c in patterns + sorted(families) if c not in matched]
+        if unmatched:
+            raise ValueError("No job matching: {}".format(', '.join(unmatched)))
+        if failed_only:
+            tasks_status = self.tasks_status()
+            to_launch = [(task, name) for task, name in to_launch
+                         if not any(task_succeeded(tasks_status.get(t)) for t in (task, name))]
+            print("{} failed or missing job(s) to be re-launched.".format(len(to_launch)))
+        return to_launch
+
+    def prepare_jobs(self, batch=False, **selection):
+        """
+        Prepare the launch of jobs: resolve the jobs to be launched and, in batch mode,
+        load the mkjob machinery ahead.
+
+        :param selection: selection of jobs, cf. jobs_to_launch()
+        """
+        to_launch = self.jobs_to_launch(**selection)
+        if batch:
+            try:
+                self._in_process_mkjob.preload()
+            except Exception as e:
+                print("Could not preload mkjob machinery ({}: {}).".format(type(e).__name__, e))
+        return to_launch
+
+    def prefetch_shelves(self, drymode=False):
+        """
+        Start bringing the shelves needed by the jobs, and missing in marketplace cache,
+        from archive (config [prefetch]), in background; return the prefetcher, to wait for readiness.
+        """
+        prefetcher = ShelvesPrefetcher(self.shelves)
+        prefetcher.start(drymode=drymode)
+        return prefetcher
+
+    def _touch_shelves(self, jobs):
+        """Mark the shelves needed by the *jobs* (list of (task, name)) as used now, in the shelves catalog."""
+        tasks = set(task for task, _ in jobs)
+        shelves = [s for s, needing in self.shelves.items() if tasks.intersection(needing)]
+        if not shelves:
+            return
+        try:
+            from .shelf import catalog
+            catalog().touch(*shelves)
+        except Exception as e:
+            print("Could not mark shelves as used ({}: {}).".format(type(e).__name__, e))
+
+    def launch_jobs(self, drymode=False, batch=False, to_launch=None, **selection):
+        """
+        Launch jobs, either all, or a selection.
+
+        :param batch: generate and submit all jobs from within this interpreter
+        :param to_launch: list of (task, name) of the jobs, as resolved by prepare_jobs()
+        :param selection: selection of jobs, cf. jobs_to_launch(); ignored if *to_launch* is given
+        """
+        if to_launch is None:
+            to_launch = self.jobs_to_launch(**selection)
+        if not drymode:
+            self._touch_shelves(to_launch)
+        if batch:
+            self._launch_batch(to_launch, drymode=drymode)
+        else:
+            for task, name in to_launch:
+                self._launch(task, name, drymode=drymode)
+
+    def launch_jobs_array(self, group_size=1, scheduler=None, export_only=False, drymode=False, **selection):
+        """
+        Launch jobs, either all or a selection, as one array job: each array task runs one job,
+        or a group of *group_size* jobs. The plan is written as a JSON manifest, with the array job script.
+
+        :param scheduler: 'slurm', or 'local' to run the array tasks locally
+            (defaults to config [array_jobs][scheduler])
+        :param export_only: only write the plan and script, do not submit
+        :param selection: selection of jobs, cf. jobs_to_launch()
+        """
+        to_launch = self.jobs_to_launch(**selection)
+        if not to_launch:
+            print("No job to launch.")
+            return
+        sched = array_scheduler(scheduler)
+        plan = JobArrayPlan(self, to_launch, group_size=group_size)
+        plan.write(sched)
+        print("Array job of {} job(s) in {} array task(s):".format(len(to_launch), len(plan.groups)))
+        print("  plan:   {}".format(plan.manifest_file))
+        print("  script: {}".format(plan.script_file))
+        if export_only or drymode:
+            return plan
+        self._touch_shelves(to_launch)
+        with self.tracer.span(plan.name, cat='job', jobs=len(to_launch), array_tasks=len(plan.groups)):
+            submitted = sched.submit(plan)
+        if isinstance(submitted, dict):
+            failed = sorted(i for i, rc in submitted.items() if rc)
+            print("Array tasks run locally: {} OK, {} failed{}".format(
+                  len(submitted) - len(failed), len(failed), ' ({})'.format(failed) if failed else ''))
+            if failed:
+                raise subprocess.CalledProcessError(1, plan.script_file)
+        else:
+            print("Submitted array job: {}".format(submitted))
+        return plan
+
+    def _timed_phase(self, phase, func, *args, **kwargs):
+        """Run one phase of the experiment, reporting its elapsed time (and tracing it)."""
+        start = time.time()
+        try:
+            with self.tracer.span(phase):
+                result = func(*args, **kwargs)
+        except Exception:
+            print("davai-run_xp: {} failed after {:.1f}s".format(phase, time.time() - start))
+            raise
+        print("davai-run_xp: {} OK ({:.1f}s)".format(phase, time.time() - start))
+        return result
+
+    def run(self, preexisting_pack=False, drymode=False, batch=False, use_cache=True):
+        """
+        Run the whole experiment: Ciboulai init, build and tests.
+        Ciboulai init and build run concurrently, while the tests jobs are being prepared
+        and the missing shelves prefetched; the tests are submitted once all of them succeeded
+        and the shelves are ready.
+        """
+        with self.tracer.span('run_xp', drymode=drymode, batch=batch, preexisting_pack=preexisting_pack):
+            self._run(preexisting_pack=preexisting_pack, drymode=drymode, batch=batch, use_cache=use_cache)
+
+    def _run(self, preexisting_pack=False, drymode=False, batch=False, use_cache=True):
+        start = time.time()
+        failures = {'Ciboulai init': "Ciboulai init failed: fix before running tests. Exit.",
+                    'Build': "Build failed: cannot run tests. Exit.",
+                    'Tests preparation': "Tests preparation failed: cannot run tests. Exit."}
+        prefetcher = None
+        if self.shelves and config.getboolean('prefetch', 'enabled', fallback=True):
+            try:
+                prefetcher = self.prefetch_shelves(drymode=drymode)
+            except Exception as e:
+                print("Could not prefetch shelves ({}: {}).".format(type(e).__name__, e))
+        executor = ThreadPoolExecutor(max_workers=len(failures))
+        preparation = executor.submit(self._timed_phase, 'Tests preparation',
+                                      self.prepare_jobs,
+                                      batch=batch)
+        phases = {executor.submit(self._timed_phase, 'Ciboulai init',
+                                  self.launch_ciboulai_init,
+                                  drymode=drymode): 'Ciboulai init',
+                  executor.submit(self._timed_phase, 'Build',
+                                  self.launch_build,
+                                  drymode=drymode,
+                                  preexisting_pack=preexisting_pack,
+                                  use_cache=use_cache): 'Build',
+                  preparation: 'Tests preparation'}
+        for future in as_completed(phases):
+            if future.exception() is not None:
+                print("davai-run_xp: " + failures[phases[future]])
+                # do not wait for the other phases: stop their launches, and let them end in background
+                self._terminate_launched()
+                executor.shutdown(wait=False, cancel_futures=True)
+                if prefetcher is not None:
+                    prefetcher.cancel()
+                raise future.exception()
+        executor.shutdown(wait=True)
+        if prefetcher is not None:
+            self._timed_phase('Shelves readiness', prefetcher.wait)
+        self._timed_phase('Tests submission', self.launch_jobs,
+                          drymode=drymode,
+                          batch=batch,
+                          to_launch=preparation.result())
+        print("davai-run_xp: total elapsed time {:.1f}s".format(time.time() - start))
 
     def afterlaunch_prompt(self):
         print("=" * 100)
@@ -388,20 +940,29 @@ class ThisXP(object):
         print("=== {:^92} ===".format("Checkout Ciboulai for results on: {}".format(self.conf['DEFAULT']['davai_server'])))
         print("=" * 100)
 
-    def status(self, task=None):
-        """Print status of tasks, read from cache files."""
-        # First we need MTOOLDIR set up for retrieving paths
-        set_default_mtooldir()
-        # Then set Vortex in path
-        vortexpath = expandpath(config['packages']['vortex'])
-        sys.path.extend([vortexpath, os.path.join(vortexpath, 'src'), os.path.join(vortexpath, 'site')])
-        # vortex/davai
-        import vortex
-        import davai
-        # process stack or task
-        stack = davai.util.SummariesStack(vortex.ticket(), self.vapp, self.vconf, self.xpid)
-        if task is None:
-            stack.tasks_status(print_it=True)
-        else:
-            stack.task_summary_fullpath(task)
+    @property
+    def summaries(self):
+        """Reader of the tasks summaries, in cache."""
+        if getattr(self, '_summaries', None) is None:
+            self._summaries = SummariesReader(summaries_stack_dir(self.vapp, self.vconf, self.xpid))
+        return self._summaries
+
+    def tasks_status(self):
+        """Status of tasks, read from cache files, as a dict {task: status}."""
+        return self.summaries.tasks_status()
+
+    def status(self, task=None, watch=False, interval=5.):
+        """
+        Print status of tasks, read from cache files.
 
+        :param task: print the path to the detailed summary of this task instead
+        :param watch: keep printing the transitions of status of tasks, as summaries change
+        :param interval: polling interval (seconds) in watch mode, if inotify is not available
+        """
+        if task is not None:
+            print(self.summaries.task_summary_path(task))
+        elif watch:
+            print("Watching '{}' (Ctrl-C to stop)".format(self.summaries.directory))
+            self.summaries.watch(interval=interval)
+        else:
+            self.summaries.print_status(self.tasks_status())
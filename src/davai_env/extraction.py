@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Incremental, parallel and resumable extraction of tarfiles.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import stat
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .compression import codec_of, open_decompressed
+
+# members smaller than this are read in memory and written by the pool of workers,
+# when extracting from a compressed (hence sequential) tarfile
+IN_MEMORY_MAX_SIZE = 16 * 1024 * 1024
+COPY_BUFSIZE = 1024 * 1024
+
+
+class IncrementalExtractor(object):
+    """
+    Extract a tarfile into a directory:
+      - skipping the members already present with the same size and mtime,
+      - writing files on a pool of threads,
+      - recording progress in a journal, so that an interrupted extraction resumes where it stopped.
+    """
+
+    def __init__(self, tarfilename, path, workers=None, on_written=None):
+        """
+        :param tarfilename: tarfile to be extracted (.tar, .tgz, .tar.zst)
+        :param path: directory in which to extract
+        :param workers: number of threads writing files (defaults to 4 x number of CPUs, as writing
+            on a parallel filesystem is rather bound by latency)
+        :param on_written: function called with the path of each file written, once complete
+        """
+        self.tarfilename = os.path.abspath(tarfilename)
+        self.path = os.path.abspath(path)
+        self.workers = workers or 4 * (os.cpu_count() or 1)
+        self.on_written = on_written
+        self.journal = os.path.join(self.path, '.{}.progress'.format(os.path.basename(tarfilename)))
+        self._lock = threading.Lock()
+        self.written = 0
+        self.written_bytes = 0
+        self.skipped = 0
+
+    # journal of progress ------------------------------------------------------------------------
+
+    @property
+    def _identity(self):
+        st = os.stat(self.tarfilename)
+        return {'tarfile': self.tarfilename, 'size': st.st_size, 'mtime': st.st_mtime}
+
+    def _resume(self):
+        """Members already extracted by an interrupted extraction of the same tarfile."""
+        done = set()
+        if os.path.exists(self.journal):
+            with io.open(self.journal, 'r') as j:
+                lines = j.readlines()
+            try:
+                identity = json.loads(lines[0]) if lines else None
+            except ValueError:
+                identity = None
+            if identity == self._identity:
+                done = set(line.rstrip('\n') for line in lines[1:] if line.endswith('\n'))
+                print("Resume interrupted extraction: {} members already extracted.".format(len(done)))
+        with io.open(self.journal, 'w') as j:
+            j.write(json.dumps(self._identity) + '\n')
+            j.writelines([d + '\n' for d in sorted(done)])
+        self._journal = io.open(self.journal, 'a')
+        return done
+
+    def _done(self, name, size=0):
+        with self._lock:
+            self._journal.write(name + '\n')
+            self._journal.flush()
+            self.written += 1
+            self.written_bytes += size
+
+    # members --------------------------------------------------------------------------------------
+
+    def _target(self, name):
+        """
+        Path of the extraction of member *name*. Only its parent directory is resolved: the member itself
+        may be a symbolic link already extracted, which is not to be followed.
+        """
+        target = os.path.normpath(os.path.join(self.path, name))
+        parent = os.path.realpath(os.path.dirname(target))
+        root = os.path.realpath(self.path)
+        if target == self.path:
+            return target
+        if not (parent + os.sep).startswith(root + os.sep):
+            raise ValueError("Member extracts outside of target directory: '{}'".format(name))
+        return os.path.join(parent, os.path.basename(target))
+
+    def _uptodate(self, member, target):
+        """Whether *target* is already an extraction of *member*."""
+        try:
+            st = os.lstat(target)
+        except OSError:
+            return False
+        if member.isreg():
+            return stat.S_ISREG(st.st_mode) and st.st_size == member.size and int(st.st_mtime) == int(member.mtime)
+        elif member.issym():
+            return os.path.islink(target) and os.readlink(target) == member.linkname
+        elif member.islnk():
+            try:
+                return os.path.samestat(st, os.lstat(self._target(member.linkname)))
+            except OSError:
+                return False
+        elif member.isdir():
+            return stat.S_ISDIR(st.st_mode)
+        return False
+
+    def _write(self, member, target, data=None, fd=None):
+        """
+        Write a regular file member into *target*, atomically, from either its *data*
+        or the descriptor *fd* of the uncompressed tarfile.
+        """
+        d = os.path.dirname(target)
+        if not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+        part = target + '.part'
+        with io.open(part, 'wb') as out:
+            if data is not None:
+                out.write(data)
+            else:
+                offset, end = member.offset_data, member.offset_data + member.size
+                while offset < end:
+                    chunk = os.pread(fd, min(COPY_BUFSIZE, end - offset), offset)
+                    if not chunk:
+                        raise IOError("Unexpected end of tarfile for member '{}'".format(member.name))
+                    out.write(chunk)
+                    offset += len(chunk)
+        os.chmod(part, member.mode & 0o7777)
+        os.utime(part, (member.mtime, member.mtime))
+        os.replace(part, target)
+        if self.on_written is not None:
+            self.on_written(target)
+        self._done(member.name, member.size)
+
+    def _write_stream(self, member, target, fileobj):
+        """Write a regular file member into *target*, atomically, from a file object."""
+        d = os.path.dirname(target)
+        if not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+        part = target + '.part'
+        with io.open(part, 'wb') as out:
+            while True:
+                chunk = fileobj.read(COPY_BUFSIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+        os.chmod(part, member.mode & 0o7777)
+        os.utime(part, (member.mtime, member.mtime))
+        os.replace(part, target)
+        if self.on_written is not None:
+            self.on_written(target)
+        self._done(member.name, member.size)
+
+    def _link(self, member, target):
+        """Extract a hard link member, once its target has been extracted."""
+        if os.path.lexists(target):
+            os.remove(target)
+        os.link(self._target(member.linkname), target)
+        self._done(member.name)
+
+    def _other(self, t, member, target):
+        """Extract a non-regular member (directory, symbolic link, ...); hard links are deferred."""
+        if member.isdir():
+            os.makedirs(target, exist_ok=True)
+        else:
+            if os.path.lexists(target):
+                os.remove(target)
+            t.extract(member, path=self.path, set_attrs=not member.issym())
+        self._done(member.name)
+
+    # extraction -----------------------------------------------------------------------------------
+
+    def extract(self):
+        """Extract, incrementally and in parallel."""
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        done = self._resume()
+        directories = []
+        # hard links are made once all the files have been written, their targets included
+        links = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = []
+                if codec_of(self.tarfilename) is None:
+                    # uncompressed: random access, members are copied in parallel from their offsets
+                    fd = os.open(self.tarfilename, os.O_RDONLY)
+                    try:
+                        with tarfile.open(self.tarfilename, 'r') as t:
+                            for member in t.getmembers():
+                                target = self._select(member, done, directories)
+                                if target is None:
+                                    continue
+                                if member.isreg():
+                                    futures.append(executor.submit(self._write, member, target, fd=fd))
+                                elif member.islnk():
+                                    links.append((member, target))
+                                else:
+                                    self._other(t, member, target)
+                            for f in futures:
+                                f.result()
+                    finally:
+                        os.close(fd)
+                else:
+                    # compressed: sequential reading; small members are written by the pool
+                    with open_decompressed(self.tarfilename) as z:
+                        with tarfile.open(fileobj=z, mode='r|') as t:
+                            for member in t:
+                                target = self._select(member, done, directories)
+                                if target is None:
+                                    continue
+                                if member.isreg():
+                                    if member.size <= IN_MEMORY_MAX_SIZE:
+                                        data = t.extractfile(member).read()
+                                        futures.append(executor.submit(self._write, member, target, data=data))
+                                        # bound memory
+                                        if len(futures) >= 4 * self.workers:
+                                            futures.pop(0).result()
+                                    else:
+                                        self._write_stream(member, target, t.extractfile(member))
+                                elif member.islnk():
+                                    links.append((member, target))
+                                else:
+                                    self._other(t, member, target)
+                            for f in futures:
+                                f.result()
+            for member, target in links:
+                self._link(member, target)
+        except (ValueError, tarfile.TarError):
+            # invalid tarfile: nothing to resume
+            self._journal.close()
+            os.remove(self.journal)
+            raise
+        finally:
+            self._journal.close()
+        # directories attributes at the end, as their content modifies them
+        for member, target in reversed(directories):
+            os.chmod(target, member.mode & 0o7777)
+            os.utime(target, (member.mtime, member.mtime))
+        os.remove(self.journal)
+
+    def _select(self, member, done, directories):
+        """Target of *member* if it is to be extracted, None if it is to be skipped."""
+        target = self._target(member.name)
+        if member.isdir():
+            directories.append((member, target))
+        if member.name in done or self._uptodate(member, target):
+            self.skipped += 1
+            return None
+        return target
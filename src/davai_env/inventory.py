@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Inventory of all the experiments in the experiments root directory: usecase, sources, tests version
+and status of tests of each XP, scanned in parallel and cached in an index refreshed incrementally.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import time
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from . import config, DAVAI_RC_DIR, DAVAI_XPID_RE
+from .util import expandpath, dump_json_atomically, git_head, vconf2usecase
+from .summaries import SummariesReader, summaries_stack_dir, task_succeeded
+
+XP_INDEX_FILE = os.path.join(DAVAI_RC_DIR, 'xp_index.json')
+INDEX_VERSION = 2
+_yaml_loader = getattr(yaml, 'CLoader', yaml.Loader)
+#: keys of the sources config which identify the tested sources
+SOURCES_KEYS = ('IAL_git_ref', 'IAL_bundle', 'IAL_bundle_file')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def find_xps(experiments_rootdir):
+    """Paths of the experiments (<rootdir>/<xpid>/<vapp>/<vconf>) in *experiments_rootdir*, by xpid."""
+    xps = {}
+    if not os.path.isdir(experiments_rootdir):
+        return xps
+    for xpid in os.listdir(experiments_rootdir):
+        if not DAVAI_XPID_RE.match(xpid):
+            continue
+        xp_dir = os.path.join(experiments_rootdir, xpid)
+        for vapp in os.listdir(xp_dir):
+            vapp_dir = os.path.join(xp_dir, vapp)
+            if not os.path.isdir(vapp_dir):
+                continue
+            for vconf in os.listdir(vapp_dir):
+                if os.path.isdir(os.path.join(vapp_dir, vconf, 'conf')):
+                    xps[xpid] = os.path.join(vapp_dir, vconf)
+    return xps
+
+
+class XPRecord(object):
+    """Summary of one experiment, from its state manifest (or config files), its tasks summaries and logs."""
+
+    def __init__(self, xp_path, logs_rootdir):
+        self.xp_path = xp_path
+        self.vconf = os.path.basename(xp_path)
+        self.vapp = os.path.basename(os.path.dirname(xp_path))
+        self.xpid = os.path.basename(os.path.dirname(os.path.dirname(xp_path)))
+        self.logs_dir = os.path.join(logs_rootdir, self.xpid)
+        self.summaries = SummariesReader(summaries_stack_dir(self.vapp, self.vconf, self.xpid))
+
+    def signature(self):
+        """Cheap signature of what a record depends on: mtimes of the state manifest, config and summaries."""
+        summaries_dir = self.summaries.directory
+        summaries = []
+        if os.path.isdir(summaries_dir):
+            summaries = sorted((e.name, _mtime(e.path)) for e in os.scandir(summaries_dir))
+        return [_mtime(os.path.join(self.xp_path, '.state.json')),
+                _mtime(os.path.join(self.xp_path, 'conf', 'sources.yaml')),
+                _mtime(self.logs_dir),
+                summaries]
+
+    def _state(self):
+        """State manifest of the XP if any, otherwise minimal state read from its config files."""
+        try:
+            with io.open(os.path.join(self.xp_path, '.state.json'), 'r') as s:
+                return json.load(s)
+        except (IOError, OSError, ValueError):
+            pass
+        state = {'usecase': vconf2usecase(self.vconf),
+                 'tests_commit': git_head(os.path.join(self.xp_path, 'DAVAI-tests'))}
+        try:
+            with io.open(os.path.join(self.xp_path, 'conf', 'sources.yaml'), 'r') as f:
+                state['sources_to_test'] = yaml.load(f, Loader=_yaml_loader)
+        except (IOError, OSError, yaml.YAMLError):
+            pass
+        return state
+
+    def record(self):
+        """Resolve the record of the experiment, as a dict."""
+        state = self._state()
+        sources = state.get('sources_to_test') or {}
+        tasks = self.summaries.tasks_status()
+        succeeded = sum(1 for s in tasks.values() if task_succeeded(s))
+        if not tasks:
+            result = 'none'
+        elif succeeded == len(tasks):
+            result = 'pass'
+        else:
+            result = 'fail'
+        return {'xpid': self.xpid,
+                'path': self.xp_path,
+                'usecase': state.get('usecase'),
+                'sources': {k: v for k, v in sources.items() if k in SOURCES_KEYS},
+                'tests_commit': state.get('tests_commit'),
+                'tasks': len(tasks),
+                'succeeded': succeeded,
+                'result': result,
+                # the XP directory and its conf/ stand for the creation of XPs not run yet
+                'last_activity': max([m for m in (_mtime(self.logs_dir), _mtime(self.summaries.directory),
+                                                  _mtime(os.path.join(self.xp_path, '.state.json')),
+                                                  _mtime(os.path.join(self.xp_path, 'conf')),
+                                                  _mtime(self.xp_path))
+                                      if m is not None] or [None])}
+
+
+class XPInventory(object):
+    """Index of the experiments, refreshed incrementally: only changed XPs are re-read, in parallel."""
+
+    def __init__(self, experiments_rootdir=None, logs_rootdir=None, index_file=XP_INDEX_FILE):
+        self.experiments_rootdir = experiments_rootdir or expandpath(config['paths']['experiments'])
+        self.logs_rootdir = logs_rootdir or expandpath(config['paths']['logs'])
+        self.index_file = index_file
+
+    def _load(self):
+        try:
+            with io.open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if index.get('version') != INDEX_VERSION or index.get('rootdir') != self.experiments_rootdir:
+            return {}
+        return index['xps']
+
+    def refresh(self, workers=None, rebuild=False):
+        """Refresh the index and return the records of the experiments, by xpid."""
+        previous = {} if rebuild else self._load()
+        xps = find_xps(self.experiments_rootdir)
+
+        def refreshed(xpid):
+            xp = XPRecord(xps[xpid], self.logs_rootdir)
+            signature = xp.signature()
+            entry = previous.get(xpid)
+            if entry is not None and entry['signature'] == json.loads(json.dumps(signature)):
+                return xpid, entry, False
+            return xpid, {'signature': signature, 'record': xp.record()}, True
+
+        with ThreadPoolExecutor(max_workers=workers or 4 * (os.cpu_count() or 1)) as executor:
+            results = list(executor.map(refreshed, sorted(xps)))
+        entries = {xpid: entry for xpid, entry, _ in results}
+        if any(changed for _, _, changed in results) or set(entries) != set(previous):
+            try:
+                dump_json_atomically({'version': INDEX_VERSION,
+                                      'rootdir': self.experiments_rootdir,
+                                      'xps': entries},
+                                     self.index_file, default=str)
+            except (IOError, OSError) as e:
+                print("Could not write experiments index '{}': {}".format(self.index_file, e))
+        return {xpid: entry['record'] for xpid, entry in entries.items()}
+
+    @staticmethod
+    def select(records, ref=None, usecase=None, result=None):
+        """
+        Select records, sorted by last activity (most recent last).
+
+        :param ref: pattern (fnmatch) of the tested IAL git ref or bundle
+        :param usecase: usecase of the experiments
+        :param result: overall result of tests among ('pass', 'fail', 'none')
+        """
+        selected = []
+        for r in records.values():
+            if ref is not None and not any(fnmatch.fnmatch(str(v), ref) for v in r['sources'].values()):
+                continue
+            if usecase is not None and (r['usecase'] or '').upper() != usecase.upper():
+                continue
+            if result is not None and r['result'] != result:
+                continue
+            selected.append(r)
+        return sorted(selected, key=lambda r: (r['last_activity'] or 0, r['xpid']))
+
+    @staticmethod
+    def print_records(records):
+        print("{:<26} {:<8} {:<32} {:<16} {:>9} {:<6} {}".format(
+              'xpid', 'usecase', 'sources', 'tests commit', 'tasks', 'result', 'last activity'))
+        for r in records:
+            sources = ' '.join(str(v) for _, v in sorted(r['sources'].items()))
+            print("{:<26} {:<8} {:<32} {:<16} {:>9} {:<6} {}".format(
+                  r['xpid'], r['usecase'] or '-', sources or '-', (r['tests_commit'] or '-')[:12],
+                  '{}/{}'.format(r['succeeded'], r['tasks']), r['result'],
+                  time.ctime(r['last_activity']) if r['last_activity'] else '-'))
+        print("{} experiment(s)".format(len(records)))
+
+
+def list_xps(ref=None, usecase=None, result=None, workers=None, rebuild=False, **_):
+    """Print the inventory of experiments, possibly filtered (cf. XPInventory.select())."""
+    inventory = XPInventory()
+    records = inventory.refresh(workers=workers, rebuild=rebuild)
+    inventory.print_records(inventory.select(records, ref=ref, usecase=usecase, result=result))
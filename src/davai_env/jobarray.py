@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Export of a set of jobs of an experiment as one array job (each array task running one job,
+or a group of jobs), with a JSON manifest of the plan mapping array indexes to jobs;
+submission to the scheduler, or to a local stand-in for it.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import time
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .util import dump_json_atomically
+
+
+def task_command_template():
+    """
+    Template of the command run by an array task for each of its jobs (config [array_jobs][task_command]).
+    It must run the job in place: the usual mkjob command alone would submit each job on its own.
+    """
+    template = config.get('array_jobs', 'task_command', fallback='').strip()
+    if not template or template == '{mkjob_cmd}':
+        raise ValueError(" ".join(["Array jobs need a command running each job in place within the array task:",
+                                   "set config [array_jobs][task_command] for this site",
+                                   "('{mkjob_cmd}' alone would submit each job on its own)."]))
+    return template
+
+
+class JobArrayPlan(object):
+    """Plan of an array job: array index -> jobs (task, name) to be run by this array task."""
+
+    def __init__(self, xp, jobs, group_size=1):
+        """
+        :param xp: the ThisXP experiment
+        :param jobs: list of (task, name) of the jobs
+        :param group_size: number of jobs run (sequentially) by each array task
+        """
+        assert group_size >= 1, "group_size must be >= 1"
+        self.xp = xp
+        self.template = task_command_template()
+        self.jobs = list(jobs)
+        self.group_size = group_size
+        self.name = 'davai_{}_{}'.format(xp.xpid, time.strftime('%Y%m%d%H%M%S'))
+        self.directory = os.path.join(xp.xp_path, 'array_jobs')
+
+    @property
+    def groups(self):
+        return [self.jobs[i:i + self.group_size] for i in range(0, len(self.jobs), self.group_size)]
+
+    def command(self, task, name):
+        """Command run by an array task for one job."""
+        return self.template.format(mkjob_cmd=' '.join(shlex.quote(c) for c in self.xp._mkjob_cmd(task, name)),
+                               mkjob=self.xp.mkjob, task=task, name=name, xp_path=self.xp.xp_path)
+
+    @property
+    def manifest_file(self):
+        return os.path.join(self.directory, self.name + '.json')
+
+    @property
+    def script_file(self):
+        return os.path.join(self.directory, self.name + '.sh')
+
+    def manifest(self):
+        return {'name': self.name,
+                'xpid': self.xp.xpid,
+                'xp_path': self.xp.xp_path,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'group_size': self.group_size,
+                'tasks': [{'index': i,
+                           'jobs': [{'task': task, 'name': name, 'command': self.command(task, name)}
+                                    for task, name in group]}
+                          for i, group in enumerate(self.groups)]}
+
+    def script(self, scheduler):
+        """Array job script: header of the scheduler, then the jobs of each array index."""
+        manifest = self.manifest()
+        lines = ['#!/bin/bash'] + scheduler.header(self) + [
+                 '# plan: {}'.format(self.manifest_file),
+                 'index=${{{}}}'.format(scheduler.index_variable),
+                 'cd {}'.format(shlex.quote(self.xp.xp_path))]
+        lines.extend('export {}={}'.format(k, shlex.quote(v)) for k, v in sorted(self.xp.jobs_env.items()))
+        lines.extend(['rc=0',
+                      'case $index in'])
+        for t in manifest['tasks']:
+            lines.append('  {})'.format(t['index']))
+            for j in t['jobs']:
+                lines.append('    echo "[array task $index] {}"'.format(j['task']))
+                lines.append('    {} || rc=1'.format(j['command']))
+            lines.append('    ;;')
+        lines.extend(['  *)',
+                      '    echo "Unknown array index: $index" >&2; exit 2',
+                      '    ;;',
+                      'esac',
+                      'exit $rc'])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, scheduler):
+        """Write the manifest and the array job script."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        dump_json_atomically(self.manifest(), self.manifest_file, indent=2)
+        with io.open(self.script_file, 'w') as s:
+            s.write(self.script(scheduler))
+        os.chmod(self.script_file, 0o755)
+
+
+class SlurmScheduler(object):
+    """Submit array jobs to SLURM."""
+
+    index_variable = 'SLURM_ARRAY_TASK_ID'
+
+    def __init__(self, max_parallel=None, options=None):
+        """
+        :param max_parallel: maximum number of array tasks running simultaneously
+        :param options: extra sbatch options, as a string (e.g. '--partition=normal --time=02:00:00')
+        """
+        self.max_parallel = max_parallel
+        self.options = options or ''
+
+    def header(self, plan):
+        array = '0-{}'.format(len(plan.groups) - 1)
+        if self.max_parallel:
+            array += '%{}'.format(self.max_parallel)
+        header = ['#SBATCH --job-name={}'.format(plan.name),
+                  '#SBATCH --array={}'.format(array),
+                  '#SBATCH --output={}'.format(os.path.join(plan.xp.xp_path, 'logs', plan.name + '_%a.out'))]
+        header.extend('#SBATCH {}'.format(o) for o in shlex.split(self.options))
+        return header
+
+    def submit(self, plan):
+        """Submit the array job; return its id."""
+        output = subprocess.check_output(['sbatch', '--parsable', plan.script_file]).decode('utf-8')
+        return output.strip().split(';')[0]
+
+
+class LocalScheduler(SlurmScheduler):
+    """
+    Local stand-in for the scheduler: run the array tasks as local processes, *max_parallel* at a time,
+    with the same environment variable of the array index.
+    """
+
+    def submit(self, plan):
+        """Run the array tasks; return their return codes, by index."""
+        logs = os.path.join(plan.xp.xp_path, 'logs')
+
+        def run_task(index):
+            env = dict(os.environ)
+            env[self.index_variable] = str(index)
+            out = os.path.join(logs if os.path.isdir(logs) else plan.directory,
+                               '{}_{}.out'.format(plan.name, index))
+            with io.open(out, 'wb') as o:
+                return subprocess.call(['bash', plan.script_file], env=env, stdout=o, stderr=subprocess.STDOUT)
+
+        with ThreadPoolExecutor(max_workers=self.max_parallel or os.cpu_count() or 1) as executor:
+            return dict(enumerate(executor.map(run_task, range(len(plan.groups)))))
+
+
+SCHEDULERS = {'slurm': SlurmScheduler,
+              'local': LocalScheduler}
+
+
+def scheduler(name=None, max_parallel=None):
+    """Scheduler *name* (defaults to config [array_jobs][scheduler])."""
+    if name is None:
+        name = config.get('array_jobs', 'scheduler', fallback='slurm')
+    if max_parallel is None:
+        max_parallel = config.getint('array_jobs', 'max_parallel', fallback=0) or None
+    options = config.get('array_jobs', 'sbatch_options', fallback='')
+    return SCHEDULERS[name](max_parallel=max_parallel, options=options)
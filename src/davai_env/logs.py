@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Logs of experiments: compaction of the logs of finished experiments into an archive of gzip members
+(one per log file, appended) with an index of the tokens found in each member, and parallel search
+of both active and archived logs across experiments.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import gzip
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config, DAVAI_XPID_RE
+from .util import expandpath, dump_json_atomically, format_size, locked
+
+ARCHIVE_FILENAME = '.logs_archive.gz'
+INDEX_FILENAME = '.logs_archive.index.json'
+INDEX_VERSION = 1
+DEFAULT_WORKERS = 8
+#: tokens of the index: words of at least 3 characters, lowercased, pure numbers excepted
+_token_re = re.compile(rb'\w{3,}')
+_regex_metachars = set('.^$*+?{}[]\\|()')
+
+
+def _tokens(content):
+    return set(t.decode('ascii', 'replace') for t in _token_re.findall(content.lower()) if not t.isdigit())
+
+
+def _literal_runs(pattern):
+    """
+    Words which any text matching *pattern* must contain (as substrings of its tokens);
+    none if the pattern is not a plain literal.
+    """
+    if any(c in _regex_metachars for c in pattern):
+        return []
+    return [r for r in re.findall(r'[a-z0-9_]{3,}', pattern.lower()) if not r.isdigit()]
+
+
+def _read(path):
+    with io.open(path, 'rb') as f:
+        return f.read()
+
+
+class XPLogs(object):
+    """Logs of one experiment: active log files, and archive of compacted ones."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.xpid = os.path.basename(directory)
+        self.archive = os.path.join(directory, ARCHIVE_FILENAME)
+        self.index_file = os.path.join(directory, INDEX_FILENAME)
+
+    def active_files(self, index=None):
+        """Log files not archived yet (according to *index*, if given), as relative paths."""
+        archived = set()
+        if index is not None:
+            archived = set((m['name'], m['mtime'], m['size']) for m in index['members'])
+        files = []
+        for d, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for f in sorted(filenames):
+                path = os.path.relpath(os.path.join(d, f), self.directory)
+                if path in (ARCHIVE_FILENAME, INDEX_FILENAME, ARCHIVE_FILENAME + '.lock'):
+                    continue
+                if archived:
+                    st = os.stat(os.path.join(d, f))
+                    if (path, st.st_mtime, st.st_size) in archived:
+                        continue  # kept after compaction
+                files.append(path)
+        return files
+
+    def last_modified(self, files):
+        """Last modification of log *files*."""
+        return max([os.path.getmtime(os.path.join(self.directory, f)) for f in files] or [0])
+
+    def load_index(self):
+        try:
+            with io.open(self.index_file, 'r') as i:
+                index = json.load(i)
+            if index.get('version') == INDEX_VERSION:
+                return index
+        except (IOError, OSError, ValueError):
+            pass
+        return {'version': INDEX_VERSION, 'members': [], 'tokens': {}}
+
+    def compact(self, level=6, remove=True):
+        """
+        Append the active log files to the archive (one gzip member each) and index their tokens;
+        then remove them, unless not *remove*. The mtime of the logs directory is preserved,
+        not to make the experiment look active again.
+
+        :return: number of files and bytes compacted, and compressed size
+        """
+        stat = os.stat(self.directory)
+        size_in = size_out = 0
+        with locked(self.archive):
+            index = self.load_index()
+            files = self.active_files(index)
+            if not files:
+                return 0, 0, 0
+            tokens = {t: set(m) for t, m in index['tokens'].items()}
+            with io.open(self.archive, 'ab') as a:
+                for f in files:
+                    path = os.path.join(self.directory, f)
+                    content = _read(path)
+                    data = gzip.compress(content, compresslevel=level)
+                    member = len(index['members'])
+                    index['members'].append({'name': f, 'offset': a.tell(), 'length': len(data),
+                                             'size': len(content), 'mtime': os.path.getmtime(path)})
+                    a.write(data)
+                    for t in _tokens(content):
+                        tokens.setdefault(t, set()).add(member)
+                    size_in += len(content)
+                    size_out += len(data)
+                a.flush()
+                os.fsync(a.fileno())
+            index['tokens'] = {t: sorted(m) for t, m in tokens.items()}
+            dump_json_atomically(index, self.index_file)
+            if remove:
+                for f in files:
+                    os.remove(os.path.join(self.directory, f))
+                for d, dirnames, filenames in os.walk(self.directory, topdown=False):
+                    if d != self.directory and not os.listdir(d):
+                        os.rmdir(d)
+        os.utime(self.directory, (stat.st_atime, stat.st_mtime))
+        return len(files), size_in, size_out
+
+    def read_member(self, member):
+        with io.open(self.archive, 'rb') as a:
+            a.seek(member['offset'])
+            return gzip.decompress(a.read(member['length']))
+
+    def candidate_members(self, index, pattern, jobs=None):
+        """Archived members which may match *pattern* (according to the tokens index) and *jobs* patterns."""
+        members = [i for i, m in enumerate(index['members'])
+                   if not jobs or any(fnmatch.fnmatch(m['name'], j) for j in jobs)]
+        for run in _literal_runs(pattern):
+            matching = set()
+            for t, m in index['tokens'].items():
+                if run in t:
+                    matching.update(m)
+            members = [i for i in members if i in matching]
+        return members
+
+    def search_tasks(self, pattern, jobs=None):
+        """Units of search work: (xpid, name, function returning the content) of files and members."""
+        index = self.load_index() if os.path.exists(self.index_file) else None
+        tasks = []
+        for f in self.active_files(index):
+            if not jobs or any(fnmatch.fnmatch(f, j) for j in jobs):
+                tasks.append((self.xpid, f, lambda path=os.path.join(self.directory, f): _read(path)))
+        if index is not None:
+            for i in self.candidate_members(index, pattern, jobs=jobs):
+                member = index['members'][i]
+                tasks.append((self.xpid, member['name'], lambda member=member: self.read_member(member)))
+        return tasks
+
+
+class LogsStore(object):
+    """Logs of all the experiments (in config [paths][logs])."""
+
+    def __init__(self, logs_rootdir=None, workers=None):
+        self.logs_rootdir = logs_rootdir or expandpath(config['paths']['logs'])
+        self.workers = workers or config.getint('logs', 'workers', fallback=DEFAULT_WORKERS)
+
+    def xps(self, xpids=None):
+        """Logs of the experiments, optionally filtered by xpid patterns."""
+        if not os.path.isdir(self.logs_rootdir):
+            return []
+        return [XPLogs(os.path.join(self.logs_rootdir, d)) for d in sorted(os.listdir(self.logs_rootdir))
+                if DAVAI_XPID_RE.match(d) and os.path.isdir(os.path.join(self.logs_rootdir, d)) and
+                (not xpids or any(fnmatch.fnmatch(d, x) for x in xpids))]
+
+    def compact(self, xpids=None, older_than=None, remove=True):
+        """Compact the logs of the experiments inactive for more than *older_than* days."""
+        if older_than is None:
+            older_than = config.getfloat('logs', 'compact_after', fallback=7)
+        level = config.getint('logs', 'level', fallback=6)
+        now = time.time()
+        to_compact = []
+        for xp in self.xps(xpids):
+            files = xp.active_files(xp.load_index())
+            if files and now - xp.last_modified(files) > older_than * 86400:
+                to_compact.append(xp)
+
+        def compact_one(xp):
+            start = time.time()
+            n, size_in, size_out = xp.compact(level=level, remove=remove)
+            print("Compacted '{}': {} files, {} -> {} ({:.1f}s)".format(
+                  xp.xpid, n, format_size(size_in), format_size(size_out), time.time() - start))
+            return size_in, size_out
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            sizes = list(executor.map(compact_one, to_compact))
+        print("{} experiment(s) compacted: {} -> {}".format(len(sizes), format_size(sum(s[0] for s in sizes)),
+                                                           format_size(sum(s[1] for s in sizes))))
+
+    def search(self, pattern, xpids=None, jobs=None, ignore_case=False, files_only=False, out=None):
+        """
+        Search *pattern* (regular expression) in the logs, active and archived, in parallel.
+
+        :param xpids: patterns of the xpids of the experiments to search in
+        :param jobs: patterns of the names of the log files to search in
+        :param files_only: only print the names of the matching logs
+        :return: number of matches
+        """
+        out = out or sys.stdout
+        regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        xps = self.xps(xpids)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            tasks = [t for tasks in executor.map(lambda x: x.search_tasks(pattern, jobs), xps) for t in tasks]
+
+            def search_one(task):
+                xpid, name, read = task
+                try:
+                    text = read().decode('utf-8', 'replace')
+                except (IOError, OSError) as e:
+                    return ["{}:{}: {}".format(xpid, name, e)], 0
+                if files_only:
+                    return (["{}:{}".format(xpid, name)], 1) if regex.search(text) else ([], 0)
+                found = ["{}:{}:{}: {}".format(xpid, name, i + 1, line)
+                         for i, line in enumerate(text.splitlines()) if regex.search(line)]
+                return found, len(found)
+
+            matches = 0
+            for lines, n in executor.map(search_one, tasks):
+                for line in lines:
+                    out.write(line + '\n')
+                matches += n
+        return matches
+
+    def print_list(self, xpids=None):
+        print("{:<26} {:>8} {:>10} {:>8} {:>10}".format('xpid', 'active', 'size', 'archived', 'archive'))
+        for xp in self.xps(xpids):
+            members = xp.load_index()['members']
+            files = xp.active_files(xp.load_index())
+            print("{:<26} {:>8} {:>10} {:>8} {:>10}".format(
+                  xp.xpid, len(files),
+                  format_size(sum(os.path.getsize(os.path.join(xp.directory, f)) for f in files)),
+                  len(members),
+                  format_size(os.path.getsize(xp.archive)) if os.path.exists(xp.archive) else '-'))
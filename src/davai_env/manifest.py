@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Content manifest of a shelf: path, size, mtime and optionally hash of each of its files.
+Comparing the manifests of two copies of a shelf tells which files are to be transferred.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import stat
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .util import dump_json_atomically
+
+MANIFEST_FILENAME = '.manifest.json'
+HASH_ALGORITHM = 'sha256'
+HASH_BUFSIZE = 1024 * 1024
+
+
+def file_hash(filename):
+    """Hash of the content of a file."""
+    h = hashlib.new(HASH_ALGORITHM)
+    with io.open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_BUFSIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ShelfManifest(object):
+    """
+    Content manifest of a shelf: {path: {'size':, 'mtime':[, 'hash':]}}, paths relative to the shelf.
+    Symbolic links are recorded as such, not as their targets: {path: {'link':, 'size': 0, 'mtime':}}.
+    """
+
+    def __init__(self, files=None):
+        self.files = files if files is not None else {}
+
+    @classmethod
+    def scan(cls, directory, hashes=False, previous=None, workers=None):
+        """
+        Build manifest of the files in *directory*.
+
+        :param hashes: compute hashes of files (in parallel)
+        :param previous: a previous manifest, which hashes are reused for unchanged files
+        :param workers: number of hashing threads
+        """
+        files = {}
+        for d, _, filenames in os.walk(directory):
+            for f in filenames:
+                path = os.path.relpath(os.path.join(d, f), directory)
+                if path == MANIFEST_FILENAME or path.endswith(('.part', '.part.segments')):
+                    continue
+                filename = os.path.join(d, f)
+                st = os.lstat(filename)
+                if stat.S_ISLNK(st.st_mode):
+                    files[path] = {'link': os.readlink(filename), 'size': 0, 'mtime': int(st.st_mtime)}
+                    continue
+                files[path] = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+                if previous is not None:
+                    p = previous.files.get(path, {})
+                    if 'hash' in p and cls._same(p, files[path]):
+                        files[path]['hash'] = p['hash']
+        manifest = cls(files)
+        if hashes:
+            manifest.compute_hashes(directory, workers=workers)
+        return manifest
+
+    def compute_hashes(self, directory, workers=None, only_missing=True):
+        """Compute hashes of files, in parallel."""
+        paths = [p for p, e in self.files.items() if 'link' not in e and not (only_missing and 'hash' in e)]
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            for path, h in zip(paths, executor.map(lambda p: file_hash(os.path.join(directory, p)), paths)):
+                self.files[path]['hash'] = h
+
+    @classmethod
+    def load(cls, filename):
+        with io.open(filename, 'r') as m:
+            return cls(json.load(m)['files'])
+
+    @classmethod
+    def of(cls, directory):
+        """Manifest stored in shelf *directory*, or None."""
+        filename = os.path.join(directory, MANIFEST_FILENAME)
+        if os.path.exists(filename):
+            return cls.load(filename)
+
+    def dump(self, filename):
+        dump_json_atomically({'hash_algorithm': HASH_ALGORITHM, 'files': self.files}, filename, indent=0,
+                             sort_keys=True)
+
+    def write(self, directory):
+        """Write manifest in shelf *directory*."""
+        self.dump(os.path.join(directory, MANIFEST_FILENAME))
+
+    @property
+    def size(self):
+        return sum(e['size'] for e in self.files.values())
+
+    @property
+    def links(self):
+        """Paths of the symbolic links."""
+        return sorted(p for p, e in self.files.items() if 'link' in e)
+
+    @staticmethod
+    def _same(a, b):
+        if 'link' in a or 'link' in b:
+            return a.get('link') == b.get('link')
+        if a['size'] != b['size'] or a['mtime'] != b['mtime']:
+            return False
+        if 'hash' in a and 'hash' in b:
+            return a['hash'] == b['hash']
+        return True
+
+    def changed_from(self, other):
+        """Paths of the files new or changed in this manifest, compared to *other*."""
+        return sorted([p for p, e in self.files.items()
+                       if p not in other.files or not self._same(e, other.files[p])])
+
+    def verify(self, directory, workers=None):
+        """
+        Check the files in *directory* against this manifest, hashing them in parallel if the manifest
+        holds hashes. Return a dict {path: problem}.
+        """
+        problems = {}
+        to_hash = []
+        for path, e in self.files.items():
+            filename = os.path.join(directory, path)
+            if 'link' in e:
+                if not os.path.islink(filename):
+                    problems[path] = 'missing link'
+                elif os.readlink(filename) != e['link']:
+                    problems[path] = 'link differs'
+            elif not os.path.exists(filename):
+                problems[path] = 'missing'
+            elif os.path.getsize(filename) != e['size']:
+                problems[path] = 'size differs'
+            elif 'hash' in e:
+                to_hash.append(path)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            for path, h in zip(to_hash, executor.map(lambda p: file_hash(os.path.join(directory, p)), to_hash)):
+                if h != self.files[path]['hash']:
+                    problems[path] = 'hash differs'
+        return problems
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Local bare mirrors of the DAVAI-tests origin repositories, shared by experiments:
+new experiments are cloned from the mirror, sharing its objects, instead of cloning the remote.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import re
+import subprocess
+
+from . import config, DAVAI_RC_DIR
+from .util import expandpath, locked
+
+
+class DavaiTestsMirror(object):
+    """A local bare mirror of a DAVAI-tests origin repository."""
+
+    def __init__(self, origin, mirrors_dir=None):
+        """
+        :param origin: URL or path of the origin repository
+        :param mirrors_dir: directory in which mirrors are stored
+            (defaults to config[paths][davai_tests_mirrors])
+        """
+        if mirrors_dir is None:
+            mirrors_dir = config.get('paths', 'davai_tests_mirrors',
+                                     fallback=os.path.join(DAVAI_RC_DIR, 'mirrors'))
+        self.origin = origin
+        self.mirrors_dir = expandpath(mirrors_dir)
+        name = re.sub(r'[^\w.-]+', '_', origin.strip('/'))
+        if name.endswith('.git'):
+            name = name[:-len('.git')]
+        self.path = os.path.join(self.mirrors_dir, name + '.git')
+
+    @classmethod
+    def for_origin(cls, origin):
+        """Mirror for *origin*, or None if mirrors are disabled in config."""
+        if config.get('paths', 'davai_tests_mirrors', fallback=None) == '':
+            return None
+        return cls(origin)
+
+    @property
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'HEAD'))
+
+    @property
+    def updatable(self):
+        """Whether the mirror can be updated by the user (a site-wide mirror may not)."""
+        if self.exists:
+            return os.access(self.path, os.W_OK)
+        else:
+            return not os.path.exists(self.mirrors_dir) or os.access(self.mirrors_dir, os.W_OK)
+
+    def update(self):
+        """Create the mirror, or update it incrementally (one update at a time)."""
+        if not os.path.exists(self.mirrors_dir):
+            os.makedirs(self.mirrors_dir, exist_ok=True)
+        with locked(self.path):
+            if not self.exists:
+                print("Create DAVAI-tests mirror: '{}'".format(self.path))
+                subprocess.check_call(['git', 'clone', '--mirror', '-q', self.origin, self.path])
+                # objects of the mirror are shared by experiments: they must never be pruned
+                subprocess.check_call(['git', 'config', 'gc.pruneExpire', 'never'], cwd=self.path)
+                subprocess.check_call(['git', 'config', 'gc.reflogExpireUnreachable', 'never'], cwd=self.path)
+            else:
+                print("Update DAVAI-tests mirror: '{}'".format(self.path))
+                subprocess.check_call(['git', 'fetch', '--prune', '-q', 'origin'], cwd=self.path)
+
+    def clone(self, directory):
+        """
+        Clone the mirror into *directory*, sharing its objects,
+        and set the origin of the clone back to the actual origin.
+        """
+        subprocess.check_call(['git', 'clone', '--shared', '-q', self.path, directory])
+        subprocess.check_call(['git', 'remote', 'set-url', 'origin', self.origin], cwd=directory)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Content-addressed store of the files of shelves, in the marketplace cache:
+identical files of several shelves are hardlinks to one single object of the store.
+
+Files of shelves are input data that must not be modified in place:
+a deduplicated file modified in place would be modified in all the shelves that share it.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .manifest import file_hash, MANIFEST_FILENAME
+
+
+class ObjectStore(object):
+    """
+    Content-addressed store of files. As hardlinks share metadata, objects are addressed by
+    hash of content, mtime and mode of files: <root>/<hh>/<hash>-<mtime>-<mode>.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def object_path(self, filename, h=None):
+        """Path of the object corresponding to *filename*, of hash *h* if known."""
+        st = os.stat(filename)
+        if h is None:
+            h = file_hash(filename)
+        return os.path.join(self.root, h[:2], '{}-{}-{:o}'.format(h, int(st.st_mtime), st.st_mode & 0o7777))
+
+    def dedup_file(self, filename, h=None):
+        """
+        Make *filename* a hardlink to its object in store, registering it if new.
+        Return the number of bytes saved.
+        """
+        obj = self.object_path(filename, h)
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                os.link(filename, obj)
+                return 0
+            except FileExistsError:  # registered concurrently
+                pass
+        st = os.stat(filename)
+        if os.path.samestat(st, os.stat(obj)):
+            return 0
+        tmp = filename + '.dedup'
+        os.link(obj, tmp)
+        os.replace(tmp, filename)
+        return st.st_size
+
+    def dedup_tree(self, directory, manifest=None, workers=None):
+        """
+        Deduplicate the files in *directory* (in parallel); return the number of bytes saved.
+
+        :param manifest: manifest of the directory, which hashes are used for unchanged files
+        """
+        to_dedup = []
+        for d, _, files in os.walk(directory):
+            for f in files:
+                filename = os.path.join(d, f)
+                path = os.path.relpath(filename, directory)
+                if path == MANIFEST_FILENAME or os.path.islink(filename):
+                    continue
+                h = None
+                if manifest is not None and 'hash' in manifest.files.get(path, {}):
+                    e, st = manifest.files[path], os.stat(filename)
+                    if e['size'] == st.st_size and e['mtime'] == int(st.st_mtime):
+                        h = e['hash']
+                to_dedup.append((filename, h))
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            return sum(executor.map(lambda a: self.dedup_file(*a), to_dedup))
+
+    def prune(self):
+        """Remove the objects not used by any shelf anymore; return the number of bytes freed."""
+        freed = 0
+        if not os.path.exists(self.root):
+            return freed
+        for d, _, files in os.walk(self.root):
+            for f in files:
+                obj = os.path.join(d, f)
+                st = os.stat(obj)
+                if st.st_nlink == 1:
+                    os.remove(obj)
+                    freed += st.st_size
+        return freed
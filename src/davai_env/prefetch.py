@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Shelves needed by the jobs of an experiment (as found in its config), and their prefetch
+from archive into marketplace cache in the background, while the build runs;
+with a check of their readiness before the tests are submitted.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import re
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+
+#: default of config [prefetch][keys]: keys of the XP config which values are shelves
+DEFAULT_KEYS = 'input_shelf*'
+_shelf_re = re.compile(r'^[\w.+-]+@[\w.+-]+$')
+
+
+def needed_shelves(conf, jobs, keys=None):
+    """
+    Shelves needed by the *jobs* (list of 'family.job'), according to the XP config *conf*:
+    values of the keys matching *keys* (patterns, defaults to config [prefetch][keys]), in the
+    section of each job ('family.job', or 'job') or in DEFAULT; as a dict {shelf: [jobs]}.
+    """
+    if keys is None:
+        keys = config.get('prefetch', 'keys', fallback=DEFAULT_KEYS)
+    patterns = [k.strip() for k in keys.split(',') if k.strip()]
+    shelves = {}
+    for job in jobs:
+        sections = [s for s in (job, job.split('.', 1)[-1]) if conf.has_section(s)]
+        items = conf.items(sections[0], raw=True) if sections else conf.defaults().items()
+        for k, v in items:
+            if any(fnmatch.fnmatch(k, p) for p in patterns) and _shelf_re.match(v.strip()):
+                shelves.setdefault(v.strip(), []).append(job)
+    return shelves
+
+
+class ShelvesPrefetcher(object):
+    """Bring the missing shelves from archive into marketplace cache, in background threads."""
+
+    def __init__(self, shelves, archive=None, transport=None, workers=None):
+        """
+        :param shelves: names of the needed shelves
+        :param archive: archive machine name (or directory, with transport 'local');
+            defaults to config [prefetch][archive]; if none, shelves are only checked, not fetched
+        :param transport: transport to archive (defaults to config [prefetch][transport])
+        :param workers: maximum number of shelves fetched simultaneously
+        """
+        from .shelf import Shelf
+        self.shelves = {s: Shelf(s) for s in sorted(shelves)}
+        self.archive = archive or config.get('prefetch', 'archive', fallback='') or None
+        self.transport = transport or config.get('prefetch', 'transport', fallback='lftp')
+        self.workers = workers or config.getint('prefetch', 'workers', fallback=2)
+        self._executor = None
+        self._futures = {}
+        self._stop = threading.Event()
+
+    def present(self, name):
+        return self.shelves[name].present
+
+    def missing(self):
+        """Needed shelves which are not (completely) in marketplace cache."""
+        return [name for name in self.shelves if not self.present(name)]
+
+    def start(self, drymode=False):
+        """
+        Mark the present shelves as used (not to be evicted meanwhile),
+        and start fetching the missing ones (unless *drymode*).
+        """
+        from .shelf import catalog
+        missing = self.missing()
+        present = [name for name in self.shelves if name not in missing]
+        if present:
+            catalog().touch(*present)
+        if not missing:
+            return
+        if self.archive is None or drymode:
+            print("Shelves missing in marketplace cache{}: {}".format(
+                  '' if drymode else ' (no archive to prefetch from, cf. config [prefetch])', ', '.join(missing)))
+            return
+        print("Prefetch {} shelves in background: {}".format(len(missing), ', '.join(missing)))
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._futures = {name: self._executor.submit(self.shelves[name].arch2mkt, self.archive,
+                                                     transport=self.transport,
+                                                     stop=self._stop)
+                         for name in missing}
+
+    def cancel(self):
+        """
+        Cancel the prefetches: those not started yet are dropped, ongoing ones are stopped
+        (partial copies are resumed by a later fetch), without waiting for them.
+        """
+        self._stop.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def wait(self):
+        """
+        Wait for the prefetches, and check the readiness of the needed shelves.
+        Missing shelves raise an error if config [prefetch][on_missing] is 'fail', or are reported.
+
+        :return: list of the shelves still missing
+        """
+        for name, f in sorted(self._futures.items()):
+            try:
+                f.result()
+            except Exception as e:
+                print("Prefetch of shelf '{}' failed: {}: {}".format(name, type(e).__name__, e))
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        missing = self.missing()
+        if missing:
+            message = "Shelves missing in marketplace cache: {}".format(', '.join(missing))
+            if config.get('prefetch', 'on_missing', fallback='warn') == 'fail':
+                raise ValueError(message)
+            print(message + " (jobs will fetch them on demand)")
+        else:
+            print("{} needed shelves ready in marketplace cache.".format(len(self.shelves)))
+        return missing
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Bytecode of the packages linked in experiments (vortex, epygram, ...), precompiled once per version
+of each package in a shared cache directory (as PYTHONPYCACHEPREFIX), and optionally packed
+as zip archives: jobs then neither compile nor stat the bytecode in the packages trees.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import sys
+import json
+import hashlib
+import zipfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config, DAVAI_RC_DIR
+from .util import expandpath, dump_json_atomically, git_head, locked
+
+DEFAULT_DIRECTORY = os.path.join(DAVAI_RC_DIR, 'pycache')
+#: subdirectories of the root of a project (vortex, epygram) in which its packages are found
+PROJECT_IMPORT_DIRS = ('.', 'src', 'site')
+
+
+def _import_roots(path):
+    """Directories to be put in sys.path to import a linked package: its parent, or its project subdirs."""
+    if os.path.exists(os.path.join(path, '__init__.py')):
+        return [os.path.dirname(path)]
+    return [os.path.normpath(os.path.join(path, d)) for d in PROJECT_IMPORT_DIRS
+            if os.path.isdir(os.path.join(path, d))]
+
+
+def _packages_in(path):
+    """Top-level Python packages provided by a linked package."""
+    if os.path.exists(os.path.join(path, '__init__.py')):
+        return [path]
+    return sorted(os.path.join(root, d) for root in _import_roots(path) for d in os.listdir(root)
+                  if os.path.exists(os.path.join(root, d, '__init__.py')))
+
+
+def _modules_signature(path):
+    """Digest of the (path, size, mtime) of the modules in the tree of *path*."""
+    h = hashlib.sha1()
+    for root, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and d != '__pycache__')
+        for f in sorted(filenames):
+            if f.endswith('.py'):
+                st = os.stat(os.path.join(root, f))
+                h.update('{}:{}:{}\n'.format(os.path.relpath(os.path.join(root, f), path),
+                                              st.st_size, st.st_mtime).encode('utf-8'))
+    return h.hexdigest()
+
+
+class SharedBytecode(object):
+    """Shared cache of precompiled bytecode (and zip archives) of linked packages."""
+
+    def __init__(self, directory=None, workers=None):
+        """
+        :param directory: cache directory (defaults to config [pycache][directory])
+        :param workers: number of processes compiling a package (0: as many as CPUs)
+        """
+        if directory is None:
+            directory = config.get('pycache', 'directory', fallback=DEFAULT_DIRECTORY)
+        if workers is None:
+            workers = config.getint('pycache', 'workers', fallback=0)
+        self.directory = expandpath(directory)
+        self.workers = workers
+        self.prefix = os.path.join(self.directory, 'prefix')
+
+    @property
+    def enabled(self):
+        return config.getboolean('pycache', 'enabled', fallback=True)
+
+    @staticmethod
+    def version(path):
+        """
+        Version of a linked package: its real path, its commit if it is a Git repository,
+        and the sizes and mtimes of its modules (which may be modified without commit).
+        """
+        realpath = os.path.realpath(path)
+        key = json.dumps([realpath, git_head(realpath), sys.version_info[:2], _modules_signature(realpath)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def _stamp(self, package, path):
+        return os.path.join(self.directory, 'stamps', '{}-{}.json'.format(package, self.version(path)))
+
+    def compile(self, package, path):
+        """Precompile *package* (at *path*) into the shared prefix, unless this version already is."""
+        realpath = os.path.realpath(path)
+        stamp = self._stamp(package, path)
+        if not os.path.isdir(os.path.dirname(stamp)):
+            os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with locked(stamp):
+            if os.path.exists(stamp):
+                return
+            print("Precompile '{}' ({})".format(package, realpath))
+            env = dict(os.environ, PYTHONPYCACHEPREFIX=self.prefix)
+            subprocess.check_call([sys.executable, '-m', 'compileall', '-q', '-j', str(self.workers), realpath],
+                                  env=env, stdout=subprocess.DEVNULL)
+            dump_json_atomically({'package': package, 'path': realpath, 'python': sys.version.split()[0]},
+                                 stamp)
+
+    def pack(self, package, path):
+        """
+        Pack the bytecode of *package* (at *path*) in a zip archive, unless this version already is.
+        Return the archive, or None if the package contains no Python package to be packed.
+        """
+        packages = _packages_in(os.path.realpath(path))
+        if not packages:
+            return None
+        archive = os.path.join(self.directory, 'zips', '{}-{}.zip'.format(package, self.version(path)))
+        if not os.path.isdir(os.path.dirname(archive)):
+            os.makedirs(os.path.dirname(archive), exist_ok=True)
+        with locked(archive):
+            if not os.path.exists(archive):
+                print("Pack '{}' in '{}'".format(package, archive))
+                tmp = archive + '.tmp'
+                with zipfile.PyZipFile(tmp, 'w', optimize=0) as z:
+                    for p in packages:
+                        z.writepy(p)
+                os.replace(tmp, archive)
+        return archive
+
+    def prepare(self, packages, zip_packages=False):
+        """
+        Precompile (and pack, if *zip_packages*) the *packages* {name: path}, concurrently.
+
+        Bytecode is compiled under the real paths of the packages: the real import roots are recorded,
+        for jobs to import the packages from there rather than through the links in the experiment.
+
+        :return: the imports setup, as a dict: {'pycache_prefix':, 'import_roots': [dirs], 'zips': [archives]}
+        """
+        def prepare_one(item):
+            package, path = item
+            self.compile(package, path)
+            return self.pack(package, path) if zip_packages else None
+
+        packages = {p: path for p, path in packages.items() if os.path.isdir(path)}
+        with ThreadPoolExecutor(max_workers=max(len(packages), 1)) as executor:
+            zips = list(executor.map(prepare_one, sorted(packages.items())))
+        roots = []
+        for _, path in sorted(packages.items()):
+            roots.extend(r for r in _import_roots(os.path.realpath(path)) if r not in roots)
+        return {'pycache_prefix': self.prefix,
+                'import_roots': roots,
+                'zips': [z for z in zips if z is not None]}
+
+
+def imports_env(imports):
+    """Environment variables pointing jobs at the shared bytecode, from the imports setup."""
+    env = {}
+    if imports.get('pycache_prefix'):
+        env['PYTHONPYCACHEPREFIX'] = imports['pycache_prefix']
+    paths = imports.get('zips', []) + imports.get('import_roots', [])
+    if paths:
+        env['PYTHONPATH'] = os.pathsep.join(paths + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    return env
+
+
+def load_imports(filename):
+    """Imports setup of an experiment; empty if none."""
+    try:
+        with io.open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
@@ -7,87 +7,300 @@ A Shelf object helps to move a shelf between archive, marketplace cache and tarf
 from __future__ import print_function, absolute_import, unicode_literals, division
 
 import os
+import io
+import sys
+import time
+import contextlib
 import configparser
-import tempfile
-import subprocess
-import tarfile
 
 from . import config, guess_host
 from .util import expandpath
+from .compression import CODECS, ParallelBlockWriter
+from .extraction import IncrementalExtractor
+from .tarindex import IndexingTarFile, TarIndex
+from .transfer import Transfer, LftpTransport, LocalTransport
+from .manifest import ShelfManifest
+from .objectstore import ObjectStore
+from .catalog import ShelvesCatalog
+from .util import parse_size
 
-# set variables
-host = guess_host()
-vortex_cache_config = os.path.join(config['packages']['vortex'],
-                                   'conf', 'cache-{}.ini'.format(host))
-cache_config = configparser.ConfigParser()
-cache_config.read(expandpath(vortex_cache_config))
-cache_config.read(expandpath(cache_config['marketplace-vortex']['externalconf_davai_path']))
-marketplacecache_rootdir = cache_config['marketplace_xp']['rootdir']
+# marketplace cache root directory, read from Vortex cache config files at first need
+_marketplacecache_rootdir = None
+
+
+def marketplacecache_rootdir():
+    """Root directory of the marketplace cache, from Vortex cache config files."""
+    global _marketplacecache_rootdir
+    if _marketplacecache_rootdir is None:
+        vortex_cache_config = os.path.join(config['packages']['vortex'],
+                                           'conf', 'cache-{}.ini'.format(guess_host()))
+        cache_config = configparser.ConfigParser()
+        cache_config.read(expandpath(vortex_cache_config))
+        cache_config.read(expandpath(cache_config['marketplace-vortex']['externalconf_davai_path']))
+        _marketplacecache_rootdir = cache_config['marketplace_xp']['rootdir']
+    return _marketplacecache_rootdir
+
+
+def shelves_rootdir():
+    """Directory of the shelves in marketplace cache."""
+    return os.path.join(marketplacecache_rootdir(), Shelf.vtx_vapp_vconf)
+
+
+def object_store():
+    """Content-addressed store of files of shelves, in marketplace cache."""
+    return ObjectStore(os.path.join(marketplacecache_rootdir(), '.davai_objects'))
+
+
+def catalog():
+    """Catalog of the shelves in marketplace cache."""
+    return ShelvesCatalog(shelves_rootdir(), object_store=object_store())
+
+
+def list_shelves(**_):
+    """List the shelves in marketplace cache."""
+    catalog().print_list()
+
+
+def gc_shelves(budget=None, dry_run=False, **_):
+    """Evict least recently used shelves from marketplace cache, to fit in *budget* (defaults to config)."""
+    if budget is None:
+        budget = config.get('shelves', 'cache_budget')
+    return catalog().gc(parse_size(budget), dry_run=dry_run)
 
 
 class Shelf(object):
     """A shelf is a Vortex pseudo-experiment in which are stored input data as in a Vortex experiment."""
 
     vtx_vapp_vconf = os.path.join('vortex', 'davai', 'shelves')
-    rootdir = os.path.join(marketplacecache_rootdir, vtx_vapp_vconf)
 
     def __init__(self, shelf):
-        if shelf.endswith('.tar') or shelf.endswith('.tgz'):
-            self.name = shelf[:-4]
-            self.tarfile = shelf
+        for ext in ['.tar'] + sorted(CODECS.values(), key=len, reverse=True):
+            if shelf.endswith(ext):
+                self.name = os.path.basename(shelf[:-len(ext)])
+                self.tarfile = shelf
+                break
         else:
             self.name = shelf
             self.tarfile = shelf + '.tar'
-        self.radical, self.user = shelf.split('@')
+        self.radical, self.user = self.name.split('@')
         if self.user == 'davai':
             self.user = config['defaults']['davai_alias_user']
             self.vtx_vapp_vconf = os.path.join(config['defaults']['davai_alias_arch_subdir'], self.vtx_vapp_vconf)
 
-    def mkt2tar(self, out_dir=None, gz_compression=False, **_):
-        """Tar (and compress) a shelf into a tar/tgz."""
-        openmode = 'w'
-        if gz_compression:
-            self.tarfile = self.tarfile.replace('.tar', '.tgz')
-            openmode = 'w:gz'
-        current = os.getcwd()
+    @property
+    def rootdir(self):
+        """Directory of the shelves in marketplace cache."""
+        return shelves_rootdir()
+
+    @property
+    def object_store(self):
+        """Content-addressed store of files of shelves, in marketplace cache."""
+        return object_store()
+
+    @staticmethod
+    def _dedup_default(dedup):
+        if dedup is None:
+            dedup = config.getboolean('shelves', 'dedup', fallback=False)
+        return dedup
+
+    @property
+    def mkt_dir(self):
+        """Directory of the shelf in marketplace cache."""
+        return os.path.join(self.rootdir, self.name)
+
+    @property
+    def incomplete_marker(self):
+        """Marker of the shelf being brought into marketplace cache, removed once it is complete."""
+        return os.path.join(self.rootdir, '.{}.incomplete'.format(self.name))
+
+    @property
+    def present(self):
+        """Whether the shelf is (completely) in marketplace cache."""
+        return os.path.isdir(self.mkt_dir) and not os.path.exists(self.incomplete_marker)
+
+    @contextlib.contextmanager
+    def _bringing(self):
+        """Mark the shelf as incomplete while it is being brought into marketplace cache, until success."""
+        if not os.path.isdir(self.rootdir):
+            os.makedirs(self.rootdir, exist_ok=True)
+        io.open(self.incomplete_marker, 'w').close()
+        yield
+        os.remove(self.incomplete_marker)
+
+    def mkt2tar(self, out_dir=None, gz_compression=False, codec=None, level=6, workers=None, **_):
+        """
+        Tar (and compress) a shelf into a tar/tgz (or .tar.zst).
+
+        :param out_dir: directory in which to write the tarfile (defaults to current directory)
+        :param gz_compression: compress with gzip
+        :param codec: compression codec among ('gzip', 'zstd'), overwrites *gz_compression*
+        :param level: compression level
+        :param workers: number of compression threads (defaults to the number of CPUs)
+        """
+        if codec is None and gz_compression:
+            codec = 'gzip'
+        if codec is not None:
+            self.tarfile = os.path.basename(self.tarfile).replace('.tar', CODECS[codec])
         if out_dir is None:
-            out_dir = current
-        os.chdir(self.rootdir)
-        out_filename = os.path.join(out_dir, self.tarfile)
-        with tarfile.open(out_filename, openmode) as t:
-            t.add(self.name)
-        os.chdir(current)
-
-    def tar2mkt(self, **_):
-        """Extracts a tar/tgz shelf into marketplacecache."""
+            out_dir = os.getcwd()
+        out_filename = os.path.join(out_dir, os.path.basename(self.tarfile))
+        start = time.time()
+        with io.open(out_filename, 'wb') as out:
+            if codec is None:
+                with IndexingTarFile.open(fileobj=out, mode='w') as t:
+                    t.add(self.mkt_dir, arcname=self.name)
+                size_in = size_out = out.tell()
+                index = TarIndex(out_filename, t.index)
+            else:
+                with ParallelBlockWriter(out, codec=codec, level=level, workers=workers) as z:
+                    with IndexingTarFile.open(fileobj=z, mode='w|') as t:
+                        t.add(self.mkt_dir, arcname=self.name)
+                size_in, size_out = z.bytes_in, z.bytes_out
+                index = TarIndex(out_filename, t.index, codec=codec,
+                                 block_size=z.block_size, blocks=z.block_offsets)
+        index.write()
+        self._report_throughput('mkt2tar', out_filename, size_in, size_out, time.time() - start)
+
+    @staticmethod
+    def _report_throughput(action, filename, size_in, size_out, elapsed):
+        """Print volume and throughput of an action."""
+        mb = 1024. * 1024.
+        print("{}: '{}' {:.1f} MB (tarfile: {:.1f} MB) in {:.1f}s => {:.1f} MB/s".format(
+              action, filename, size_in / mb, size_out / mb, elapsed, size_in / mb / max(elapsed, 1e-6)))
+
+    def tar2mkt(self, workers=None, dedup=None, **_):
+        """
+        Extracts a tar/tgz (or .tar.zst) shelf into marketplacecache.
+        Files already present with the same size and mtime are skipped, and an interrupted
+        extraction resumes where it stopped.
+
+        :param workers: number of threads writing files
+        :param dedup: deduplicate files as they arrive, against the content-addressed store
+            (defaults to config [shelves][dedup])
+        """
         assert os.path.exists(self.tarfile)
-        with tarfile.open(self.tarfile, 'r') as t:
-            t.extractall(path=self.rootdir)
+        start = time.time()
+        on_written = self.object_store.dedup_file if self._dedup_default(dedup) else None
+        extractor = IncrementalExtractor(self.tarfile, self.rootdir, workers=workers, on_written=on_written)
+        with self._bringing():
+            extractor.extract()
+            ShelfManifest.scan(self.mkt_dir, previous=ShelfManifest.of(self.mkt_dir)).write(self.mkt_dir)
+        catalog().register(self.name)
+        print("tar2mkt: {} member(s) extracted, {} member(s) up-to-date and skipped.".format(
+              extractor.written, extractor.skipped))
+        self._report_throughput('tar2mkt', self.tarfile, extractor.written_bytes, os.path.getsize(self.tarfile),
+                                time.time() - start)
+
+    def extract(self, members=(), out_dir=None, to_stdout=False, **_):
+        """
+        Extract individual *members* of a tar/tgz (or .tar.zst) shelf, using the index written aside
+        by mkt2tar, without reading the whole tarfile.
+
+        :param members: member names (relative to the shelf, or including it); directories
+            are extracted with their content
+        :param out_dir: directory in which to extract (defaults to current directory)
+        :param to_stdout: write the content of the members on stdout instead
+        """
+        index = TarIndex.of(self.tarfile)
+        assert index is not None, "No (up-to-date) index '{}': re-export shelf with mkt2tar".format(
+            TarIndex.filename_of(self.tarfile))
+        names = [m if m == self.name or m.startswith(self.name + '/') else os.path.join(self.name, m)
+                 for m in members]
+        if out_dir is None:
+            out_dir = os.getcwd()
+        for name in index.select(names):
+            if to_stdout:
+                if index.resolve(name)['size']:
+                    for chunk in index.read(name):
+                        sys.stdout.buffer.write(chunk)
+            else:
+                print(index.extract(name, out_dir))
+        if to_stdout:
+            sys.stdout.buffer.flush()
+
+    def dedup(self, workers=None, **_):
+        """Deduplicate the files of the shelf in marketplace cache against the content-addressed store."""
+        saved = self.object_store.dedup_tree(self.mkt_dir, manifest=ShelfManifest.of(self.mkt_dir),
+                                             workers=workers)
+        print("dedup: {:.1f} MB saved in '{}'".format(saved / 1024. / 1024., self.name))
+        return saved
 
-    def _mkt_arch(self, archive, to='arch'):
-        if to == 'arch':
-            mirror_args = ['-R', self.name, self.radical]
+    def _transport(self, archive, transport='lftp'):
+        if transport == 'lftp':
+            return LftpTransport(archive, self.user)
+        elif transport == 'local':
+            return LocalTransport(archive, self.user)
         else:
-            mirror_args = ['', self.radical, self.name]
-        lftp_script = [
-            '#!/usr/bin/bash',
-            'cd {}'.format(self.rootdir),
-            'lftp {}@{} <<EOG'.format(self.user, archive),
-            'cd {}'.format(self.vtx_vapp_vconf),
-            'mirror {} {} {}'.format(*mirror_args),
-            'bye',
-            'EOG',
-            ]
-        temp_request = tempfile.mkstemp()[1]
-        print("Temp request:", temp_request)
-        with open(temp_request, 'w') as req:
-            req.writelines([line + '\n' for line in lftp_script])
-        subprocess.check_call(['bash', temp_request])
-
-    def mkt2arch(self, archive, **_):
-        """For a shelf = radical@user, mirrors *shelf* from marketplacecache to *radical* in user@archive"""
-        self._mkt_arch(archive, to='arch')
-
-    def arch2mkt(self, archive, **_):
-        """For a shelf = radical@user, mirrors *radical* from user@archive into marketplacecache as *shelf*"""
-        self._mkt_arch(archive, to='mkt')
+            raise ValueError("Unknown transport: '{}'".format(transport))
+
+    def _mkt_arch(self, archive, to='arch', transport='lftp', parallel=None, segments=None, retries=None,
+                  sync=False, hashes=False, stop=None):
+        transfer = Transfer(self._transport(archive, transport),
+                            parallel=parallel,
+                            segments=segments,
+                            retries=retries,
+                            stop=stop)
+        args = (self.mkt_dir,
+                os.path.join(self.vtx_vapp_vconf, self.radical))
+        if sync:
+            transfer.sync(*args, to=to, hashes=hashes)
+        else:
+            transfer.mirror(*args, to=to)
+
+    def mkt2arch(self, archive, transport='lftp', parallel=None, segments=None, retries=None,
+                 sync=False, hashes=False, **_):
+        """
+        For a shelf = radical@user, mirrors *shelf* from marketplacecache to *radical* in user@archive.
+        If *sync*, transfer only files new or changed according to the shelf manifests.
+        """
+        self._mkt_arch(archive, to='arch', transport=transport,
+                       parallel=parallel, segments=segments, retries=retries,
+                       sync=sync, hashes=hashes)
+
+    def arch2mkt(self, archive, transport='lftp', parallel=None, segments=None, retries=None,
+                 sync=False, dedup=None, stop=None, **_):
+        """
+        For a shelf = radical@user, mirrors *radical* from user@archive into marketplacecache as *shelf*.
+        If *sync*, transfer only files new or changed according to the shelf manifests.
+        If *dedup* (defaults to config [shelves][dedup]), deduplicate files against the content-addressed store.
+        Once *stop* (event) is set, the transfer is interrupted (InterruptedError), to be resumed later.
+        """
+        with self._bringing():
+            self._mkt_arch(archive, to='mkt', transport=transport,
+                           parallel=parallel, segments=segments, retries=retries,
+                           sync=sync, stop=stop)
+            if self._dedup_default(dedup):
+                self.dedup()
+        catalog().register(self.name)
+
+    def pin(self, **_):
+        """Pin shelf in marketplace cache: it will never be evicted."""
+        catalog().pin(self.name)
+
+    def unpin(self, **_):
+        """Unpin shelf in marketplace cache."""
+        catalog().pin(self.name, pinned=False)
+
+    def manifest(self, hashes=False, workers=None, **_):
+        """(Re-)Build the manifest of the shelf in marketplace cache."""
+        directory = self.mkt_dir
+        manifest = ShelfManifest.scan(directory, hashes=hashes, previous=ShelfManifest.of(directory),
+                                      workers=workers)
+        manifest.write(directory)
+        print("Manifest of '{}': {} files, {:.1f} MB{}".format(self.name, len(manifest.files),
+                                                             manifest.size / 1024. / 1024.,
+                                                             ', with hashes' if hashes else ''))
+        return manifest
+
+    def verify(self, workers=None, **_):
+        """Verify the shelf in marketplace cache against its manifest."""
+        manifest = ShelfManifest.of(self.mkt_dir)
+        assert manifest is not None, "No manifest in shelf '{}'".format(self.mkt_dir)
+        problems = manifest.verify(self.mkt_dir, workers=workers)
+        for path, problem in sorted(problems.items()):
+            print("{}: {}".format(path, problem))
+        with_hashes = all('hash' in e for e in manifest.files.values())
+        print("Verify '{}': {} files, {} problem(s){}".format(self.name, len(manifest.files), len(problems),
+                                                            '' if with_hashes else ' (sizes only: no hashes)'))
+        if problems:
+            raise ValueError("Shelf '{}' does not match its manifest".format(self.name))
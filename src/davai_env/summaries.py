@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Light reader of the tasks summaries of an experiment, as stored by the tasks in Vortex cache
+(summaries_stack), without importing Vortex: status of tasks and live watch of their transitions.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import time
+import select
+import collections
+
+from . import config
+from .util import expandpath, default_mtooldir
+
+#: default location of the summaries stack, and suffix of the task summaries in it
+DEFAULT_SUMMARIES_STACK = '{mtooldir}/cache/vortex/{vapp}/{vconf}/{xpid}/summaries_stack'
+DEFAULT_TASK_SUMMARY_SUFFIX = '.itself.json'
+MISSING = 'Missing'
+
+
+def task_succeeded(status):
+    """
+    Whether a task status, as read from tasks summaries, means success.
+    A status may be a summary (dict with key 'Status'), a dict with keys 'symbol'/'short'/'text', or a string;
+    None stands for a missing summary.
+    """
+    if isinstance(status, dict) and 'Status' in status:
+        status = status['Status']
+    if isinstance(status, dict):
+        status = status.get('short', status.get('symbol'))
+    return status is not None and str(status).strip().lower() in ('ended', 'ok', 'e', '+')
+
+
+def status_text(status):
+    """Short text of a task status (cf. task_succeeded() for what a status may be)."""
+    if isinstance(status, dict) and 'Status' in status:
+        status = status['Status']
+    if isinstance(status, dict):
+        status = status.get('short', status.get('text', status.get('symbol')))
+    return MISSING if status is None else str(status)
+
+
+def summaries_stack_dir(vapp, vconf, xpid):
+    """Directory of the summaries stack of an experiment, from config [status][summaries_stack]."""
+    mtooldir = os.environ.get('MTOOLDIR') or default_mtooldir()
+    template = config.get('status', 'summaries_stack', fallback=DEFAULT_SUMMARIES_STACK)
+    return expandpath(template.format(mtooldir=mtooldir, vapp=vapp, vconf=vconf, xpid=xpid))
+
+
+class SummariesReader(object):
+    """
+    Read the status of tasks from the task summaries files of a summaries stack.
+    Files are re-parsed only when they changed since last read.
+    """
+
+    def __init__(self, directory, suffix=None):
+        self.directory = directory
+        self.suffix = suffix or config.get('status', 'task_summary_suffix', fallback=DEFAULT_TASK_SUMMARY_SUFFIX)
+        self._cache = {}  # {task: ((mtime, size), status)}
+
+    def task_summary_path(self, task):
+        return os.path.join(self.directory, task + self.suffix)
+
+    def _read(self, filename):
+        """Status read from a summary file; None if it is being written. OSError if it vanished."""
+        try:
+            with io.open(filename, 'r') as f:
+                summary = json.load(f)
+        except ValueError:
+            return None  # being written
+        return summary.get('Status', summary) if isinstance(summary, dict) else summary
+
+    def tasks_status(self):
+        """Status of tasks, as a dict {task: status}."""
+        status = {}
+        if not os.path.isdir(self.directory):
+            return status
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(self.suffix):
+                continue
+            task = entry.name[:-len(self.suffix)]
+            try:
+                st = entry.stat()
+                signature = (st.st_mtime, st.st_size)
+                cached = self._cache.get(task)
+                if cached is None or cached[0] != signature:
+                    cached = (signature, self._read(entry.path))
+                    self._cache[task] = cached
+            except OSError:
+                continue  # replaced or removed meanwhile: skipped until next read
+            status[task] = cached[1]
+        return status
+
+    @staticmethod
+    def counts(tasks_status):
+        """Number of tasks per status text."""
+        return collections.Counter(status_text(s) for s in tasks_status.values())
+
+    @classmethod
+    def print_status(cls, tasks_status):
+        width = max([len(t) for t in tasks_status] + [4])
+        for task in sorted(tasks_status):
+            print("{:<{w}}  {}".format(task, status_text(tasks_status[task]), w=width))
+        cls.print_counts(tasks_status)
+
+    @classmethod
+    def print_counts(cls, tasks_status):
+        counts = cls.counts(tasks_status)
+        print("{} task(s): {}".format(len(tasks_status),
+                                      ', '.join('{} {}'.format(n, s) for s, n in sorted(counts.items()))))
+
+    def watch(self, interval=5., timeout=None):
+        """
+        Print live transitions of tasks status and counts, each time summaries change (until *timeout*,
+        in seconds, or keyboard interrupt).
+        Changes are waited for with inotify if available, else by polling every *interval* seconds.
+        """
+        previous = self.tasks_status()
+        self.print_status(previous)
+        end = None if timeout is None else time.time() + timeout
+        with _DirectoryWatcher(self.directory) as watcher:
+            try:
+                while end is None or time.time() < end:
+                    wait = interval if end is None else max(0, min(interval, end - time.time()))
+                    if not watcher.wait(wait):
+                        continue
+                    current = self.tasks_status()
+                    transitions = [(t, status_text(previous.get(t)), status_text(s))
+                                   for t, s in sorted(current.items())
+                                   if status_text(previous.get(t)) != status_text(s)]
+                    if transitions:
+                        stamp = time.strftime('%H:%M:%S')
+                        for task, before, after in transitions:
+                            print("{} {}: {} -> {}".format(stamp, task, before, after))
+                        self.print_counts(current)
+                    previous = current
+            except KeyboardInterrupt:
+                pass
+        return previous
+
+
+class _DirectoryWatcher(object):
+    """Wait for changes in a directory: with inotify (Linux) if available, else by polling its content."""
+
+    # inotify events: IN_MODIFY | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_CLOSE_WRITE
+    _mask = 0x00000002 | 0x00000080 | 0x00000100 | 0x00000200 | 0x00000008
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._fd = None
+        self._libc = None
+        self._watching = False
+        self._snapshot = None
+
+    def __enter__(self):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self._libc, self._fd = libc, fd
+        except (OSError, AttributeError, ImportError):
+            pass
+        self._add_watch()
+        self._snapshot = self._poll_snapshot()
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            os.close(self._fd)
+
+    def _add_watch(self):
+        """Watch directory with inotify, once it exists; False if not (yet) possible."""
+        if self._fd is None or not os.path.isdir(self.directory):
+            return False
+        if self._libc.inotify_add_watch(self._fd, os.fsencode(self.directory), self._mask) < 0:
+            os.close(self._fd)
+            self._fd = None  # fallback to polling
+            return False
+        self._watching = True
+        return True
+
+    def _poll_snapshot(self):
+        if not os.path.isdir(self.directory):
+            return None
+        snapshot = {}
+        for e in os.scandir(self.directory):
+            try:
+                st = e.stat()
+            except OSError:
+                continue  # removed meanwhile
+            snapshot[e.name] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def wait(self, timeout):
+        """Wait up to *timeout* seconds for a change; return whether something changed."""
+        if self._fd is not None and not self._watching and self._add_watch():
+            return True  # directory just appeared
+        if self._watching:
+            ready, _, _ = select.select([self._fd], [], [], timeout)
+            if not ready:
+                return False
+            time.sleep(0.1)  # gather the events of a burst of writes
+            try:
+                while os.read(self._fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+            return True
+        time.sleep(timeout)
+        snapshot = self._poll_snapshot()
+        changed = snapshot != self._snapshot
+        self._snapshot = snapshot
+        return changed
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Sidecar index of the members of a shelf tarfile, for random access to individual members:
+the offset of each member data in the (uncompressed) tar stream, and for compressed tarfiles
+the offsets of the independently compressed blocks, so that only the blocks spanning a member
+have to be read and decompressed.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import zlib
+import tarfile
+
+from .compression import _zstandard
+from .util import dump_json_atomically
+
+INDEX_SUFFIX = '.index.json'
+READ_BUFSIZE = 1024 * 1024
+
+
+class IndexingTarFile(tarfile.TarFile):
+    """A TarFile (in write mode) which records the offsets of the data of its members."""
+
+    def __init__(self, *args, **kwargs):
+        self.index = {}
+        super(IndexingTarFile, self).__init__(*args, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        super(IndexingTarFile, self).addfile(tarinfo, fileobj=fileobj)
+        padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE if tarinfo.isreg() else 0
+        entry = {'type': tarinfo.type.decode('ascii'),
+                 'offset': self.offset - padded,
+                 'size': tarinfo.size if tarinfo.isreg() else 0,
+                 'mtime': tarinfo.mtime,
+                 'mode': tarinfo.mode}
+        if tarinfo.issym() or tarinfo.islnk():
+            entry['linkname'] = tarinfo.linkname
+        self.index[tarinfo.name] = entry
+
+
+class TarIndex(object):
+    """Index of the members of a tarfile, written aside as <tarfile>.index.json."""
+
+    def __init__(self, tarfilename, members, codec=None, block_size=None, blocks=None):
+        """
+        :param tarfilename: the indexed tarfile
+        :param members: dict {name: entry} as recorded by IndexingTarFile
+        :param codec: compression codec of the tarfile, if any
+        :param block_size: size of the uncompressed blocks, if compressed
+        :param blocks: offsets of the compressed blocks in the tarfile, if compressed
+        """
+        self.tarfilename = tarfilename
+        self.members = members
+        self.codec = codec
+        self.block_size = block_size
+        self.blocks = blocks or []
+
+    @staticmethod
+    def filename_of(tarfilename):
+        return tarfilename + INDEX_SUFFIX
+
+    @classmethod
+    def of(cls, tarfilename):
+        """Load the index of *tarfilename*; None if missing or not matching the tarfile."""
+        filename = cls.filename_of(tarfilename)
+        if not os.path.exists(filename):
+            return None
+        with io.open(filename, 'r') as f:
+            content = json.load(f)
+        if content.get('tarfile_size') != os.path.getsize(tarfilename):
+            return None  # outdated: tarfile has been rewritten since
+        return cls(tarfilename, content['members'],
+                   codec=content.get('codec'),
+                   block_size=content.get('block_size'),
+                   blocks=content.get('blocks'))
+
+    def write(self):
+        dump_json_atomically({'tarfile_size': os.path.getsize(self.tarfilename),
+                              'codec': self.codec,
+                              'block_size': self.block_size,
+                              'blocks': self.blocks,
+                              'members': self.members},
+                             self.filename_of(self.tarfilename))
+
+    def resolve(self, name):
+        """Entry of member *name*, following hard links. Raises KeyError if not found."""
+        entry = self.members[name]
+        while entry['type'] == tarfile.LNKTYPE.decode('ascii'):
+            entry = self.members[entry['linkname']]
+        return entry
+
+    def select(self, names):
+        """Member names matching *names*: exact names, or directories which members are beneath."""
+        selected = []
+        for name in names:
+            name = name.rstrip('/')
+            if name in self.members:
+                selected.append(name)
+            matching = sorted(m for m in self.members if m.startswith(name + '/'))
+            if not matching and name not in self.members:
+                raise KeyError("No member '{}' in '{}'".format(name, self.tarfilename))
+            selected.extend(matching)
+        return selected
+
+    def _uncompressed_range(self, f, offset, size):
+        """Read *size* bytes at *offset* of the uncompressed stream, by chunks."""
+        if self.codec is None:
+            f.seek(offset)
+            while size > 0:
+                chunk = f.read(min(size, READ_BUFSIZE))
+                if not chunk:
+                    raise EOFError("Unexpected end of '{}'".format(self.tarfilename))
+                size -= len(chunk)
+                yield chunk
+            return
+        tarfile_size = os.fstat(f.fileno()).st_size
+        block, skip = divmod(offset, self.block_size)
+        while size > 0:
+            start = self.blocks[block]
+            end = self.blocks[block + 1] if block + 1 < len(self.blocks) else tarfile_size
+            f.seek(start)
+            compressed = f.read(end - start)
+            if self.codec == 'zstd':
+                data = _zstandard().ZstdDecompressor().decompress(compressed)
+            else:
+                data = zlib.decompressobj(31).decompress(compressed)
+            chunk = data[skip:skip + size]
+            size -= len(chunk)
+            skip = 0
+            block += 1
+            yield chunk
+
+    def read(self, name):
+        """Generator over the data of member *name*, by chunks."""
+        entry = self.resolve(name)
+        with io.open(self.tarfilename, 'rb') as f:
+            for chunk in self._uncompressed_range(f, entry['offset'], entry['size']):
+                yield chunk
+
+    def extract(self, name, path):
+        """Extract member *name* into directory *path*; return the extracted path."""
+        entry = self.resolve(name)
+        target = os.path.join(path, name)
+        if entry['type'] == tarfile.DIRTYPE.decode('ascii'):
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            return target
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        if os.path.lexists(target):
+            os.remove(target)
+        if entry['type'] == tarfile.SYMTYPE.decode('ascii'):
+            os.symlink(entry['linkname'], target)
+            return target
+        with io.open(target, 'wb') as out:
+            for chunk in self.read(name):
+                out.write(chunk)
+        os.chmod(target, entry['mode'])
+        os.utime(target, (entry['mtime'], entry['mtime']))
+        return target
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Timing instrumentation of the lifecycle of an experiment: spans of phases and subprocesses,
+appended to a per-XP trace file as JSON lines of Chrome trace events ("complete" events),
+and summary of a trace file.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import sys
+import json
+import time
+import threading
+import contextlib
+import collections
+
+from . import config, guess_host, __version__
+
+TRACE_FILENAME = '.trace.jsonl'
+
+
+class Tracer(object):
+    """Record spans as Chrome trace events, one JSON line per event, in *filename*."""
+
+    def __init__(self, filename=None):
+        """
+        :param filename: trace file; if None (or tracing disabled in config [tracing]), spans are not recorded
+        """
+        if not config.getboolean('tracing', 'enabled', fallback=True):
+            filename = None
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._started = False
+        self._start = time.time()
+
+    @classmethod
+    def for_xp(cls, xp_path):
+        """Tracer of an experiment."""
+        return cls(os.path.join(xp_path, TRACE_FILENAME))
+
+    @property
+    def enabled(self):
+        return self.filename is not None
+
+    def _write(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            try:
+                with io.open(self.filename, 'a') as t:
+                    if not self._started:
+                        # metadata event: name the process after the command, for trace viewers
+                        self._started = True
+                        t.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                                            'args': {'name': ' '.join([os.path.basename(sys.argv[0])] +
+                                                                      sys.argv[1:]),
+                                                     'host': guess_host(),
+                                                     'davai_env': __version__,
+                                                     'start': self._start}}) + '\n')
+                    t.write(line)
+            except (IOError, OSError):
+                self.filename = None  # e.g. XP directory not writable: stop tracing
+
+    @contextlib.contextmanager
+    def span(self, name, cat='phase', **args):
+        """Context manager recording a span of *name* in category *cat*, with extra *args*."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        except BaseException as e:
+            args['error'] = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            self._write({'name': name, 'cat': cat, 'ph': 'X',
+                         'ts': int(start * 1e6),
+                         'dur': int((time.time() - start) * 1e6),
+                         'pid': os.getpid(),
+                         'tid': threading.current_thread().ident,
+                         'args': args})
+
+
+def read_trace(filename, last=False):
+    """
+    Read events of a trace file.
+
+    :param last: only the events of the last command recorded
+    """
+    events = []
+    with io.open(filename, 'r') as t:
+        for line in t:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue  # truncated line of an interrupted command
+    if last:
+        starts = [e for e in events if e.get('ph') == 'M']
+        if starts:
+            events = [e for e in events if e.get('pid') == starts[-1]['pid'] and
+                      (e.get('ph') == 'M' or e['ts'] >= starts[-1]['args']['start'] * 1e6 - 1)]
+    return events
+
+
+def summarize(events, category=None):
+    """Print the total, count, mean and max duration of spans by name (and category)."""
+    commands = [e for e in events if e.get('ph') == 'M']
+    for c in commands:
+        print("{} {} (host: {}, davai-env {})".format(time.ctime(c['args']['start']), c['args']['name'],
+                                                        c['args'].get('host'), c['args'].get('davai_env')))
+    durations = collections.OrderedDict()
+    errors = collections.Counter()
+    for e in sorted((e for e in events if e.get('ph') == 'X'), key=lambda e: e['ts']):
+        if category is not None and e.get('cat') != category:
+            continue
+        key = (e.get('cat'), e['name'])
+        durations.setdefault(key, []).append(e['dur'] / 1e6)
+        if 'error' in e.get('args', {}):
+            errors[key] += 1
+    width = max([len(name) for _, name in durations] + [4])
+    print("{:<10} {:<{w}} {:>6} {:>10} {:>10} {:>10} {:>6}".format(
+          'category', 'span', 'count', 'total(s)', 'mean(s)', 'max(s)', 'errors', w=width))
+    for (cat, name), d in sorted(durations.items(), key=lambda i: -sum(i[1])):
+        print("{:<10} {:<{w}} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>6}".format(
+              cat, name, len(d), sum(d), sum(d) / len(d), max(d), errors[(cat, name)], w=width))
+
+
+def export_chrome(events, filename):
+    """Export events as a Chrome trace file (JSON), to be loaded in chrome://tracing or Perfetto."""
+    with io.open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# -*- coding:Utf-8 -*-
+"""
+Transfers of shelves between marketplace cache and archive:
+a transfer engine (retries, resume, throughput report) over pluggable transports.
+"""
+from __future__ import print_function, absolute_import, unicode_literals, division
+
+import os
+import io
+import json
+import time
+import threading
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .manifest import ShelfManifest, MANIFEST_FILENAME, file_hash
+
+COPY_BUFSIZE = 1024 * 1024
+# files smaller than this are not split into segments
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def tree_size(directory):
+    """Total size of the files in *directory*."""
+    size = 0
+    for d, _, files in os.walk(directory):
+        for f in files:
+            size += os.lstat(os.path.join(d, f)).st_size
+    return size
+
+
+def _check_hash(filename, expected):
+    if file_hash(filename) != expected:
+        os.remove(filename)
+        raise IOError("Hash mismatch of transferred file '{}'".format(filename))
+
+
+def _make_link(target, filename):
+    """(Re-)Create symbolic link *filename* to *target*."""
+    if os.path.lexists(filename):
+        os.remove(filename)
+    elif not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    os.symlink(target, filename)
+
+
+class Transport(object):
+    """
+    Abstract transport between a local directory and a remote (archive) directory.
+    Paths on the remote are relative to the transport's home on the archive.
+    Once its *stop* event (if any) is set, ongoing transfers are stopped as soon as possible
+    (raising InterruptedError), and can be resumed later.
+    """
+
+    stop = None
+
+    def _stopped(self):
+        if self.stop is not None and self.stop.is_set():
+            raise InterruptedError("Transfer stopped")
+
+    def mirror(self, local_dir, remote_dir, to, parallel=1, segments=1):
+        """
+        Mirror *local_dir* to *remote_dir* (to='arch') or the opposite (to='mkt'),
+        resuming from what is already there.
+
+        :param parallel: number of files transferred in parallel
+        :param segments: number of segments in which large files are transferred in parallel
+        :return: number of bytes transferred, or None if unknown
+        """
+        raise NotImplementedError()
+
+    def put(self, local_dir, remote_dir, paths, parallel=1, segments=1, hashes=None):
+        """
+        Transfer files *paths* (relative to *local_dir*) to *remote_dir*.
+
+        :param hashes: expected hashes of (some of) the files, {path: hash}, to be checked if possible
+        """
+        raise NotImplementedError()
+
+    def get(self, remote_dir, local_dir, paths, parallel=1, segments=1, hashes=None):
+        """
+        Transfer files *paths* (relative to *remote_dir*) to *local_dir*.
+
+        :param hashes: expected hashes of (some of) the files, {path: hash}, to be checked if possible
+        """
+        raise NotImplementedError()
+
+
+class LftpTransport(Transport):
+    """Transport through 'lftp' to user@archive."""
+
+    def __init__(self, archive, user):
+        self.archive = archive
+        self.user = user
+
+    def mirror(self, local_dir, remote_dir, to, parallel=1, segments=1):
+        options = ['--continue', '--parallel={}'.format(parallel)]
+        if segments > 1:
+            options.append('--use-pget-n={}'.format(segments))
+        if to == 'arch':
+            options.insert(0, '-R')
+            src, dst = os.path.basename(local_dir), os.path.basename(remote_dir)
+        else:
+            src, dst = os.path.basename(remote_dir), os.path.basename(local_dir)
+        lftp_script = [
+            'lcd {}'.format(os.path.dirname(local_dir)),
+            'cd {}'.format(os.path.dirname(remote_dir)),
+            'mirror {} {} {}'.format(' '.join(options), src, dst),
+            ]
+        self._run(lftp_script)
+
+    def _run(self, lftp_script):
+        p = subprocess.Popen(['lftp', '{}@{}'.format(self.user, self.archive)],
+                             stdin=subprocess.PIPE,
+                             universal_newlines=True)
+        script = '\n'.join(lftp_script + ['bye']) + '\n'
+        while True:
+            try:
+                p.communicate(script, timeout=None if self.stop is None else 1)
+                break
+            except subprocess.TimeoutExpired:
+                script = None  # already being sent
+                if self.stop.is_set():
+                    p.terminate()
+                    p.wait()
+                    self._stopped()
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+
+    def put(self, local_dir, remote_dir, paths, parallel=1, segments=1, hashes=None):
+        if not paths:
+            return
+        self._run(['lcd {}'.format(local_dir),
+                   'mkdir -p -f {}'.format(remote_dir),
+                   'cd {}'.format(remote_dir),
+                   'mput -d -P {} {}'.format(parallel, ' '.join('"{}"'.format(p) for p in paths))])
+
+    def get(self, remote_dir, local_dir, paths, parallel=1, segments=1, hashes=None):
+        if not paths:
+            return
+        os.makedirs(local_dir, exist_ok=True)
+        self._run(['lcd {}'.format(local_dir),
+                   'cd {}'.format(remote_dir),
+                   'mget -d -P {} {}'.format(parallel, ' '.join('"{}"'.format(p) for p in paths))])
+        for p in paths:
+            if hashes and p in hashes:
+                _check_hash(os.path.join(local_dir, p), hashes[p])
+
+
+class LocalTransport(Transport):
+    """
+    Transport to an "archive" which is a local directory, e.g. to stand in for the actual archive in tests.
+    The archive of user *user* is <root>/<user>.
+    """
+
+    def __init__(self, root, user):
+        self.root = os.path.abspath(root)
+        self.user = user
+
+    def _remote(self, remote_dir):
+        return os.path.join(self.root, self.user, remote_dir)
+
+    def mirror(self, local_dir, remote_dir, to, parallel=1, segments=1):
+        if to == 'arch':
+            src, dst = local_dir, self._remote(remote_dir)
+        else:
+            src, dst = self._remote(remote_dir), local_dir
+        assert os.path.isdir(src), "Source directory not found: '{}'".format(src)
+        to_copy = []
+        for d, _, files in os.walk(src):
+            rel = os.path.relpath(d, src)
+            os.makedirs(os.path.join(dst, rel), exist_ok=True)
+            for f in files:
+                s, t = os.path.join(d, f), os.path.normpath(os.path.join(dst, rel, f))
+                if os.path.islink(s):  # copied as a link, not as its target
+                    if not (os.path.islink(t) and os.readlink(t) == os.readlink(s)):
+                        _make_link(os.readlink(s), t)
+                    continue
+                st = os.stat(s)
+                if os.path.exists(t) and os.path.getsize(t) == st.st_size and \
+                   int(os.path.getmtime(t)) == int(st.st_mtime):
+                    continue
+                to_copy.append((s, t, st))
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return sum(executor.map(lambda c: self._copy(*c, segments=segments, stop=self.stop), to_copy))
+
+    def _copy_files(self, src_dir, dst_dir, paths, parallel=1, segments=1, hashes=None):
+        to_copy = []
+        for p in paths:
+            s, t = os.path.join(src_dir, p), os.path.join(dst_dir, p)
+            if not os.path.exists(s):
+                raise IOError("File not found: '{}'".format(s))
+            os.makedirs(os.path.dirname(t), exist_ok=True)
+            to_copy.append((s, t, os.stat(s), (hashes or {}).get(p)))
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return sum(executor.map(lambda c: self._copy(*c[:3], segments=segments, expected_hash=c[3],
+                                                         stop=self.stop),
+                                    to_copy))
+
+    def put(self, local_dir, remote_dir, paths, parallel=1, segments=1, hashes=None):
+        return self._copy_files(local_dir, self._remote(remote_dir), paths, parallel=parallel, segments=segments,
+                                hashes=hashes)
+
+    def get(self, remote_dir, local_dir, paths, parallel=1, segments=1, hashes=None):
+        return self._copy_files(self._remote(remote_dir), local_dir, paths, parallel=parallel, segments=segments,
+                                hashes=hashes)
+
+    @staticmethod
+    def _copy(src, dst, st, segments=1, expected_hash=None, stop=None):
+        """
+        Copy *src* to *dst* through *dst*.part, resuming a partial copy if any;
+        return the number of bytes copied. The copy is interrupted once *stop* (event) is set.
+        A sequential copy is resumed from the length of the .part file, which is only ever
+        written up to the bytes actually copied; a copy in segments records its completed
+        segments in a .part.segments journal. The copy is checked (size, and hash if
+        *expected_hash*) before it replaces *dst*.
+        """
+        part = dst + '.part'
+        journal_file = part + '.segments'
+        source = [st.st_size, int(st.st_mtime)]
+        journal = None
+        if os.path.exists(journal_file):
+            try:
+                with io.open(journal_file, 'r') as j:
+                    journal = json.load(j)
+            except (IOError, OSError, ValueError):
+                journal = None
+            if journal is None or journal.get('source') != source or not os.path.exists(part):
+                journal = None
+                os.remove(journal_file)
+                if os.path.exists(part):
+                    os.remove(part)
+        if journal is not None:
+            ranges = [r for r in journal['segments'] if r not in journal['done']]
+        else:
+            done = os.path.getsize(part) if os.path.exists(part) else 0
+            if done > st.st_size:
+                os.remove(part)
+                done = 0
+            remaining = st.st_size - done
+            if segments > 1 and remaining >= MIN_SEGMENT_SIZE:
+                bounds = [done + i * remaining // segments for i in range(segments + 1)]
+                ranges = [[bounds[i], bounds[i + 1]] for i in range(segments)]
+                journal = {'source': source, 'segments': ranges, 'done': []}
+                with io.open(journal_file, 'w') as j:
+                    json.dump(journal, j)
+            else:
+                ranges = [[done, st.st_size]]
+        copied = sum(end - start for start, end in ranges)
+        with io.open(src, 'rb') as s, io.open(part, 'r+b' if os.path.exists(part) else 'wb') as t:
+            if journal is None:
+                LocalTransport._copy_range(s.fileno(), t.fileno(), *ranges[0], stop=stop)
+            else:
+                lock = threading.Lock()
+
+                def copy_segment(r):
+                    LocalTransport._copy_range(s.fileno(), t.fileno(), *r, stop=stop)
+                    os.fsync(t.fileno())
+                    with lock:
+                        journal['done'].append(r)
+                        with io.open(journal_file, 'w') as j:
+                            json.dump(journal, j)
+
+                with ThreadPoolExecutor(max_workers=segments) as executor:
+                    list(executor.map(copy_segment, ranges))
+        if os.path.getsize(part) != st.st_size:
+            raise IOError("Size mismatch of copied file '{}': {} instead of {}".format(
+                          part, os.path.getsize(part), st.st_size))
+        if expected_hash is not None:
+            _check_hash(part, expected_hash)
+        if journal is not None:
+            os.remove(journal_file)
+        shutil.copymode(src, part)
+        os.utime(part, (st.st_atime, st.st_mtime))
+        os.replace(part, dst)
+        return copied
+
+    @staticmethod
+    def _copy_range(fd_in, fd_out, start, end, stop=None):
+        offset = start
+        while offset < end:
+            if stop is not None and stop.is_set():
+                raise InterruptedError("Transfer stopped")
+            chunk = os.pread(fd_in, min(COPY_BUFSIZE, end - offset), offset)
+            if not chunk:
+                raise IOError("Unexpected end of file while copying")
+            os.pwrite(fd_out, chunk, offset)
+            offset += len(chunk)
+
+
+class Transfer(object):
+    """Transfer engine: mirror a directory through a transport, with retries and throughput report."""
+
+    def __init__(self, transport, parallel=None, segments=None, retries=None, retry_delay=10, stop=None):
+        """
+        :param transport: a Transport
+        :param parallel: number of files transferred in parallel
+        :param segments: number of segments in which large files are transferred in parallel
+        :param retries: number of retries after a failed attempt, which resume where it stopped
+        :param retry_delay: delay before first retry (s), doubled at each retry
+        :param stop: event which, once set, stops the transfer (raising InterruptedError), without retry
+        """
+        self.transport = transport
+        self.transport.stop = stop
+        self.stop = stop
+        self.parallel = parallel if parallel is not None else config.getint('transfers', 'parallel', fallback=4)
+        self.segments = segments if segments is not None else config.getint('transfers', 'segments', fallback=1)
+        self.retries = retries if retries is not None else config.getint('transfers', 'retries', fallback=3)
+        self.retry_delay = retry_delay
+
+    def _retrying(self, func, *args, **kwargs):
+        """Call *func*, retrying in case of failure."""
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            self.transport._stopped()
+            try:
+                return func(*args, **kwargs)
+            except InterruptedError:
+                raise
+            except (subprocess.CalledProcessError, IOError, OSError) as e:
+                if attempt == self.retries:
+                    raise
+                print("Transfer failed ({}): retry in {}s, resuming ({}/{})".format(e, delay, attempt + 1,
+                                                                                   self.retries))
+                if self.stop is not None:
+                    self.stop.wait(delay)
+                else:
+                    time.sleep(delay)
+                delay *= 2
+
+    @staticmethod
+    def _report(to, transferred, elapsed, local_dir):
+        mb = 1024. * 1024.
+        action = 'mkt2arch' if to == 'arch' else 'arch2mkt'
+        if transferred is None:
+            volume = tree_size(local_dir)
+            print("{}: shelf volume {:.1f} MB in {:.1f}s => {:.1f} MB/s".format(
+                  action, volume / mb, elapsed, volume / mb / max(elapsed, 1e-6)))
+        else:
+            print("{}: {:.1f} MB transferred in {:.1f}s => {:.1f} MB/s".format(
+                  action, transferred / mb, elapsed, transferred / mb / max(elapsed, 1e-6)))
+
+    def mirror(self, local_dir, remote_dir, to):
+        """Mirror *local_dir* to *remote_dir* (to='arch') or the opposite (to='mkt')."""
+        start = time.time()
+        transferred = self._retrying(self.transport.mirror, local_dir, remote_dir, to,
+                                     parallel=self.parallel,
+                                     segments=self.segments)
+        self._report(to, transferred, time.time() - start, local_dir)
+        return transferred
+
+    def remote_manifest(self, remote_dir):
+        """Manifest of the shelf on archive, or None if there is none."""
+        tmp = tempfile.mkdtemp(prefix='davai_manifest.')
+        try:
+            self.transport.get(remote_dir, tmp, [MANIFEST_FILENAME])
+            return ShelfManifest.of(tmp)
+        except (subprocess.CalledProcessError, IOError, OSError):
+            return None
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def sync(self, local_dir, remote_dir, to, hashes=False):
+        """
+        Synchronise *local_dir* to *remote_dir* (to='arch') or the opposite (to='mkt'),
+        transferring only the files new or changed according to the shelf manifests.
+        Falls back to a mirror if there is no manifest on archive.
+
+        :param hashes: compute hashes of files (pushing only) to compare contents
+        """
+        start = time.time()
+        remote = self.remote_manifest(remote_dir)
+        if remote is None:
+            print("No manifest of shelf on archive: mirror.")
+            transferred = self.mirror(local_dir, remote_dir, to)
+            if to == 'arch':
+                manifest = ShelfManifest.scan(local_dir, hashes=hashes, previous=ShelfManifest.of(local_dir))
+                manifest.write(local_dir)
+                self._retrying(self.transport.put, local_dir, remote_dir, [MANIFEST_FILENAME])
+            else:
+                ShelfManifest.scan(local_dir).write(local_dir)
+            return transferred
+        if to == 'arch':
+            local = ShelfManifest.scan(local_dir, hashes=hashes, previous=ShelfManifest.of(local_dir))
+            local.write(local_dir)
+            # symbolic links are only recorded in the manifest, and recreated from it when fetched
+            paths = [p for p in local.changed_from(remote) if 'link' not in local.files[p]]
+            print("Sync: {} file(s) to transfer, among {}.".format(len(paths), len(local.files)))
+            self._retrying(self.transport.put, local_dir, remote_dir, paths,
+                           parallel=self.parallel, segments=self.segments,
+                           hashes={p: local.files[p]['hash'] for p in paths if 'hash' in local.files[p]})
+            self._retrying(self.transport.put, local_dir, remote_dir, [MANIFEST_FILENAME])
+            transferred = sum(local.files[p]['size'] for p in paths)
+        else:
+            local = ShelfManifest.scan(local_dir) if os.path.exists(local_dir) else ShelfManifest()
+            changed = remote.changed_from(local)
+            paths = [p for p in changed if 'link' not in remote.files[p]]
+            print("Sync: {} file(s) to transfer, among {}.".format(len(paths), len(remote.files)))
+            self._retrying(self.transport.get, remote_dir, local_dir, paths,
+                           parallel=self.parallel, segments=self.segments,
+                           hashes={p: remote.files[p]['hash'] for p in paths if 'hash' in remote.files[p]})
+            for p in paths:
+                mtime = remote.files[p]['mtime']
+                os.utime(os.path.join(local_dir, p), (mtime, mtime))
+            for p in changed:
+                if 'link' in remote.files[p]:
+                    _make_link(remote.files[p]['link'], os.path.join(local_dir, p))
+            remote.write(local_dir)
+            transferred = sum(remote.files[p]['size'] for p in paths)
+        self._report(to, transferred, time.time() - start, local_dir)
+        return transferred
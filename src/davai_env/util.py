@@ -7,10 +7,20 @@ from __future__ import print_function, absolute_import, unicode_literals, divisi
 
 import os
 import io
+import re
+import json
+import stat
+import fcntl
 import datetime
+import tempfile
+import contextlib
 
 from . import config
 
+#: umask of the process, read once (reading it means setting it, which is not thread-safe)
+_umask = os.umask(0o022)
+os.umask(_umask)
+
 
 def expandpath(path):
     """Expand user and env var in a path)."""
@@ -42,3 +52,80 @@ def usecase2vconf(usecase):
     """Convert usecase to vconf."""
     return usecase.lower()
 
+def write_atomically(text, filename):
+    """
+    Write *text* in *filename*, through a temporary file so that readers never see a partial file.
+    The file keeps its mode if it exists, or gets the usual mode of new files (not the private one of temporary files).
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(filename) + '.',
+                               dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with io.open(fd, 'w') as f:
+            f.write(text)
+        try:
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+        except (IOError, OSError):
+            mode = 0o666 & ~_umask
+        os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def dump_json_atomically(obj, filename, **kwargs):
+    """Dump *obj* as JSON in *filename*, through a temporary file so that readers never see a partial file."""
+    write_atomically(json.dumps(obj, **kwargs), filename)
+
+def git_head(repository):
+    """
+    Commit of HEAD of a Git *repository*, read directly from the .git files,
+    i.e. much cheaper than spawning git. Returns None if not found.
+    """
+    gitdir = os.path.join(repository, '.git')
+    if os.path.isfile(gitdir):  # worktree or submodule: 'gitdir: <path>'
+        with io.open(gitdir, 'r') as g:
+            gitdir = os.path.join(repository, g.read().strip()[len('gitdir:'):].strip())
+    try:
+        with io.open(os.path.join(gitdir, 'HEAD'), 'r') as h:
+            head = h.read().strip()
+    except (IOError, OSError):
+        return None
+    if not head.startswith('ref:'):
+        return head  # detached HEAD
+    ref = head[len('ref:'):].strip()
+    ref_file = os.path.join(gitdir, ref)
+    if os.path.exists(ref_file):
+        with io.open(ref_file, 'r') as r:
+            return r.read().strip()
+    packed_refs = os.path.join(gitdir, 'packed-refs')
+    if os.path.exists(packed_refs):
+        with io.open(packed_refs, 'r') as p:
+            for line in p:
+                if line.strip().endswith(' ' + ref):
+                    return line.split()[0]
+
+@contextlib.contextmanager
+def locked(filename):
+    """Context manager holding an exclusive lock associated with *filename* (through *filename*.lock)."""
+    with io.open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def parse_size(size):
+    """Parse a size in bytes, possibly with a unit suffix among K, M, G, T (powers of 1024), e.g. '500G'."""
+    m = re.match(r'^\s*(\d+(\.\d*)?)\s*([KMGT]?)i?B?\s*$', str(size), re.IGNORECASE)
+    if not m:
+        raise ValueError("Invalid size: '{}'".format(size))
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(3).upper() or ' '))
+
+def format_size(size):
+    """Format a size in bytes in human-readable form."""
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(size) < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.
+    return '{:.1f}T'.format(size)